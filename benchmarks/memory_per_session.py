@@ -0,0 +1,87 @@
+"""
+Measure memory held per active session for the legacy string history versus
+the compact TurnStore with interned tenant config.
+
+    python benchmarks/memory_per_session.py --sessions 2000 --turns 20
+"""
+import argparse
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server.memory import Role, TurnStore, intern_config  # noqa: E402
+
+AI_NAME = "Sidhant Goswami"
+TENANT_CONFIG = {
+    "salesperson_name": AI_NAME,
+    "salesperson_role": "Business Development Representative",
+    "company_name": "Sleep Haven",
+    "company_business": "Sleep Haven is a premium mattress company that provides customers with the most comfortable and supportive sleeping experience possible. "
+    * 4,
+    "company_values": "Our mission at Sleep Haven is to help people achieve a better night's sleep by providing them with the best possible sleep solutions. "
+    * 4,
+    "conversation_purpose": "find out whether they are looking to achieve better sleep via buying a premier mattress.",
+    "conversation_type": "call",
+}
+
+
+def fresh(text):
+    # every request decodes its own copy of the tenant row from the database
+    return "".join(list(text))
+
+
+def utterance(session, turn):
+    return f"This is message {turn} of session {session}, asking about mattress sizes, prices and delivery times."
+
+
+def legacy_session(session, turns):
+    config = {key: fresh(value) for key, value in TENANT_CONFIG.items()}
+    history = []
+    for turn in range(turns):
+        if turn % 2 == 0:
+            history.append("User: " + utterance(session, turn) + " <END_OF_TURN>")
+        else:
+            history.append(AI_NAME + ": " + utterance(session, turn) + " <END_OF_TURN>")
+    return config, history
+
+
+def compact_session(session, turns):
+    config = intern_config({key: fresh(value) for key, value in TENANT_CONFIG.items()})
+    history = TurnStore()
+    for turn in range(turns):
+        history.append(Role.USER if turn % 2 == 0 else Role.AI, utterance(session, turn))
+    return config, history
+
+
+def measure(build, sessions, turns):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    held = [build(session, turns) for session in range(sessions)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    total = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    del held
+    return total / sessions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sessions", type=int, default=2000)
+    parser.add_argument("--turns", type=int, default=20)
+    args = parser.parse_args()
+
+    # warm up the tokenizer so its tables are not counted against a session
+    compact_session(0, 2)
+
+    legacy = measure(legacy_session, args.sessions, args.turns)
+    compact = measure(compact_session, args.sessions, args.turns)
+    print(f"sessions={args.sessions} turns/session={args.turns}")
+    print(f"legacy strings + per-request config : {legacy / 1024:8.1f} KiB/session")
+    print(f"TurnStore + interned config         : {compact / 1024:8.1f} KiB/session")
+    print(f"saved                               : {(1 - compact / legacy) * 100:8.1f} %")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Compare replies from the stage-slimmed prompts with replies from the full
+prompts on recorded sessions, and report the input tokens saved.
+
+Rows use the batch format (config, product_catalog, conversation_history,
+human_input), optionally with the conversation_stage_id the turn ran at.
+Each row is answered twice from the same state, once with each prompt.
+For meaningful agreement numbers, route the utterance and tool planner
+models with temperature 0 in the tenant's model_routing config.
+
+    python benchmarks/prompt_slimming_eval.py --input sessions.jsonl --output eval.jsonl
+    python benchmarks/prompt_slimming_eval.py --input sessions.jsonl --tokens-only
+"""
+import argparse
+import asyncio
+import difflib
+import json
+import os
+import sys
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv  # noqa: E402
+
+from server.batch import BatchRunner, read_rows  # noqa: E402
+from server.memory import count_tokens  # noqa: E402
+from server.metrics import metrics  # noqa: E402
+
+
+def prompt_tokens_used() -> float:
+    return sum(series["sum"] for series in metrics.snapshot().get("prompt_tokens_total", []))
+
+
+def similarity(a: str, b: str) -> float:
+    return difflib.SequenceMatcher(None, a.lower().split(), b.lower().split()).ratio()
+
+
+def first_prompt_tokens(sales_agent) -> int:
+    """Tokens of the first prompt of the turn, built without calling the model."""
+    if sales_agent._tools_enabled():
+        planner = sales_agent.sales_agent_executor.agent
+        prompt = getattr(planner, "prompt", None) or planner.llm_chain.prompt
+        return count_tokens(
+            prompt.format(intermediate_steps=[], **sales_agent._agent_inputs())
+        )
+    return sum(count_tokens(message["content"]) for message in sales_agent._prep_messages())
+
+
+async def answer(sales_api, human_input, slim: bool, tokens_only: bool):
+    agent = sales_api.sales_agent
+    agent.prompt_slimming = slim
+    if human_input is not None:
+        agent.human_step(human_input)
+    if tokens_only:
+        return {"prompt_tokens": first_prompt_tokens(agent), "uses_tools": agent._tools_enabled()}
+
+    before = prompt_tokens_used()
+    ai_message = await agent.acall(inputs={})
+    return {
+        "prompt_tokens": prompt_tokens_used() - before,
+        "uses_tools": agent._tools_enabled(),
+        "reply": agent.conversation_history[-1].text,
+        "tools": sorted(action["tool"] for action in ai_message.get("agent_actions", [])),
+        "end_of_call": agent.end_of_call,
+    }
+
+
+async def evaluate_row(runner, row, tokens_only: bool):
+    template = await runner.agent_for(row)
+    history = row.get("conversation_history") or []
+    results = {}
+    stage_id = row.get("conversation_stage_id")
+    for name, slim in (("full", False), ("slim", True)):
+        sales_api = template.fork(history)
+        agent = sales_api.sales_agent
+        if stage_id is None:
+            if tokens_only:
+                raise ValueError("--tokens-only needs conversation_stage_id on every row")
+            await agent.adetermine_conversation_stage()
+            stage_id = agent.conversation_stage_id
+        else:
+            agent.conversation_stage_id = stage_id
+            agent.current_conversation_stage = agent.retrieve_conversation_stage(stage_id)
+        results[name] = await answer(sales_api, row.get("human_input"), slim, tokens_only)
+
+    full, slim = results["full"], results["slim"]
+    result = {"id": row["id"], "stage": stage_id, "full": full, "slim": slim}
+    if not tokens_only:
+        result["similarity"] = similarity(full["reply"], slim["reply"])
+        result["exact"] = full["reply"].strip() == slim["reply"].strip()
+        result["same_tools"] = full["tools"] == slim["tools"]
+        result["same_end_of_call"] = full["end_of_call"] == slim["end_of_call"]
+    return result
+
+
+def summarize(results, tokens_only: bool) -> None:
+    by_stage = defaultdict(list)
+    for result in results:
+        by_stage[result["stage"]].append(result)
+    by_stage["all"] = results
+
+    header = f"{'stage':>6} {'rows':>5} {'full tok':>9} {'slim tok':>9} {'saved':>7}"
+    if not tokens_only:
+        header += f" {'similar':>8} {'exact':>6} {'tools':>6} {'end':>6}"
+    print(header)
+    for stage in sorted(by_stage, key=lambda key: (key == "all", str(key))):
+        rows = by_stage[stage]
+        full = sum(row["full"]["prompt_tokens"] for row in rows) / len(rows)
+        slim = sum(row["slim"]["prompt_tokens"] for row in rows) / len(rows)
+        line = (
+            f"{stage:>6} {len(rows):>5} {full:>9.0f} {slim:>9.0f} "
+            f"{(1 - slim / full) * 100 if full else 0:>6.1f}%"
+        )
+        if not tokens_only:
+            line += (
+                f" {sum(row['similarity'] for row in rows) / len(rows):>8.2f}"
+                f" {sum(row['exact'] for row in rows) / len(rows):>6.0%}"
+                f" {sum(row['same_tools'] for row in rows) / len(rows):>6.0%}"
+                f" {sum(row['same_end_of_call'] for row in rows) / len(rows):>6.0%}"
+            )
+        print(line)
+
+
+async def main(args):
+    runner = BatchRunner(
+        model_name=os.getenv("GPT_MODEL", "gpt-3.5-turbo-0613"),
+        use_tools=not args.no_tools,
+    )
+    rows = read_rows(args.input)[: args.limit or None]
+    results = []
+    out = open(args.output, "w") if args.output else None
+    try:
+        # one row at a time so the token metrics of the two runs do not mix
+        for row in rows:
+            try:
+                result = await evaluate_row(runner, row, args.tokens_only)
+            except Exception as e:
+                print(f"row {row['id']}: {e}", file=sys.stderr)
+                continue
+            results.append(result)
+            if out:
+                out.write(json.dumps(result) + "\n")
+    finally:
+        if out:
+            out.close()
+    if results:
+        summarize(results, args.tokens_only)
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--input", required=True, help="recorded sessions, one JSONL row per turn")
+    parser.add_argument("--output", help="JSONL file for per-row results")
+    parser.add_argument("--limit", type=int, default=0, help="evaluate only the first N rows")
+    parser.add_argument("--no-tools", action="store_true", help="run without the tools agent")
+    parser.add_argument(
+        "--tokens-only",
+        action="store_true",
+        help="only count first-prompt tokens, without calling the model",
+    )
+    asyncio.run(main(parser.parse_args()))
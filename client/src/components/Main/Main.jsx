@@ -6,6 +6,7 @@ import { Context } from "../../context/Context";
 const Main = () => {
   const {
     onSent,
+    bargeIn,
     recentPrompt,
     showResult,
     loading,
@@ -22,6 +23,8 @@ const Main = () => {
     const handleResult = (event) => {
       const current = event.resultIndex;
       const transcript = event.results[current][0].transcript;
+      // the user started talking: stop the agent mid-reply
+      bargeIn();
       setInput(transcript);
     };
 
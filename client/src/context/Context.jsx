@@ -1,5 +1,7 @@
-import { createContext, useState } from "react";
-import axios from 'axios';
+import { createContext, useRef, useState } from "react";
+
+const CHAT_KEY = '41fd0217-b449-417a-a123-27ab7bdd3a0c';
+const CHAT_SOCKET_URL = `wss://blackspace-ai.onrender.com/ws/chat/${CHAT_KEY}?session_id=7`;
 
 function textToAudio(msg) {
   let speech = new SpeechSynthesisUtterance();
@@ -11,23 +13,17 @@ function textToAudio(msg) {
   window.speechSynthesis.speak(speech);
 }
 
-async function runChat(prompt) {
-
-  var data = {
-    'human_say': prompt,
-    'session_id': '7',
-  };
-
-  const formBody = new FormData()
-
-  for (const key in data) {
-    formBody.append(key, data[key])
+function formatResponse(response) {
+  let responseArray = response.split("**");
+  let newResponse = "";
+  for (let i = 0; i < responseArray.length; i++) {
+    if (i === 0 || i % 2 !== 1) {
+      newResponse += responseArray[i];
+    } else {
+      newResponse += "<b>" + responseArray[i] + "</b>";
+    }
   }
-  const result = await axios.post('https://blackspace-ai.onrender.com/chat/41fd0217-b449-417a-a123-27ab7bdd3a0c', formBody)
-  console.log(result);
-  const response = result?.data?.response;
-  textToAudio(response);
-  return response;
+  return newResponse.split("*").join(" </br> ");
 }
 
 export const Context = createContext();
@@ -40,10 +36,54 @@ const ContextProvider = (props) => {
   const [loading, setLoading] = useState(false);
   const [resultData, setResultData] = useState("");
 
-  const delayPara = (index, nextWord) => {
-    setTimeout(function () {
-      setResultData((prev) => prev + nextWord);
-    }, 75 * index);
+  const socketRef = useRef(null);
+  const socketReadyRef = useRef(null);
+
+  const handleMessage = (message) => {
+    if (message.type === "token") {
+      setLoading(false);
+      setResultData((prev) => prev + message.text);
+    } else if (message.type === "sentence") {
+      // chunks arrive cleaned of markdown and in order, so speak them right away
+      textToAudio(message.text);
+    } else if (message.type === "end") {
+      setLoading(false);
+      setResultData(formatResponse(message.response));
+    } else if (message.type === "error") {
+      console.error("Chat error:", message.detail);
+      setLoading(false);
+    }
+  };
+
+  // One socket per page: auth and session state live on the server for its lifetime
+  const getSocket = () => {
+    if (socketRef.current && socketRef.current.readyState <= WebSocket.OPEN) {
+      return socketReadyRef.current;
+    }
+    const socket = new WebSocket(CHAT_SOCKET_URL);
+    socketReadyRef.current = new Promise((resolve, reject) => {
+      socket.onopen = () => resolve(socket);
+      socket.onerror = reject;
+    });
+    socket.onmessage = (event) => handleMessage(JSON.parse(event.data));
+    socket.onclose = () => {
+      socketRef.current = null;
+    };
+    socketRef.current = socket;
+    return socketReadyRef.current;
+  };
+
+  const bargeIn = () => {
+    window.speechSynthesis.cancel();
+    if (socketRef.current && socketRef.current.readyState === WebSocket.OPEN) {
+      socketRef.current.send(JSON.stringify({ type: "barge_in" }));
+    }
+  };
+
+  const runChat = async (prompt) => {
+    window.speechSynthesis.cancel();
+    const socket = await getSocket();
+    socket.send(JSON.stringify({ type: "utterance", text: prompt }));
   };
 
   const newChat = () => {
@@ -55,32 +95,14 @@ const ContextProvider = (props) => {
     setResultData("");
     setLoading(true);
     setShowResult(true);
-    let response;
     if (prompt !== undefined) {
-      response = await runChat(prompt);
+      await runChat(prompt);
       setRecentPrompt(prompt);
     } else {
       setPrevPrompts((prev) => [...prev, input]);
       setRecentPrompt(input);
-      response = await runChat(input);
-    }
-
-    let responseArray = response.split("**");
-    let newResponse = "";
-    for (let i = 0; i < responseArray.length; i++) {
-      if (i === 0 || i % 2 !== 1) {
-        newResponse += responseArray[i];
-      } else {
-        newResponse += "<b>" + responseArray[i] + "</b>";
-      }
+      await runChat(input);
     }
-    let newResponse2 = newResponse.split("*").join(" </br> ");
-    let newResponseArray = newResponse2.split(" ");
-    for (let i = 0; i < newResponseArray.length; i++) {
-      const nextWord = newResponseArray[i];
-      delayPara(i, nextWord + " ");
-    }
-    setLoading(false);
     setInput("");
   };
 
@@ -88,6 +110,7 @@ const ContextProvider = (props) => {
     prevPrompts,
     setPrevPrompts,
     onSent,
+    bargeIn,
     setRecentPrompt,
     recentPrompt,
     showResult,
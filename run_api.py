@@ -1,14 +1,18 @@
+import asyncio
 import json
 import os
+import time
+import uuid
 from typing import List
 
 from io import BytesIO
 
 import uvicorn
 from dotenv import load_dotenv
-from fastapi import FastAPI, Query, UploadFile, File, Body, HTTPException, status
+from fastapi import FastAPI, Request, Query, UploadFile, File, Body, HTTPException, WebSocket, WebSocketDisconnect, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from datetime import datetime
 from supabase import create_client
@@ -16,6 +20,43 @@ from supabase import create_client
 import PyPDF2
 
 from server.api import BlackSpaceAPI
+from server.batch import BatchRunner
+from server.budget import PromptBudgetExceeded
+from server.coalesce import SingleFlight, turn_key
+from server.deadline import (
+    REQUEST_DEADLINE,
+    Admission,
+    DeadlineExceeded,
+    Overloaded,
+    cancel_on_disconnect,
+    parse_timeout,
+    run_within_deadline,
+    start_deadline,
+)
+from server.embedding_cache import hit_rate as embedding_cache_hit_rate
+from server.export import STORE_TURN_METADATA, turn_metadata
+from server.generation import SentenceSegmenter
+from server.ingestion import ingestion
+from server.logger import log_event, start_request
+from server.metering import meter
+from server.metrics import metrics, track_turn
+from server.profiling import (
+    PROFILE_SORT_KEYS,
+    admin_allowed,
+    profile_report,
+    sampler,
+    start_request_profile,
+)
+from server.reads import (
+    KEYSET,
+    cached_read,
+    decode_cursor,
+    page,
+    page_limit,
+    paginate,
+    projection,
+    read_cache,
+)
 
 # Load environment variables
 load_dotenv()
@@ -24,10 +65,22 @@ load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 CORS_ORIGINS = ["http://localhost:3000", "https://blackspace-ai.vercel.app"]
 CORS_METHODS = ["GET", "POST"]
+# How long a finished /chat result is replayed to retries sent with the same Idempotency-Key
+CHAT_DEDUPE_TTL = float(os.getenv("CHAT_DEDUPE_TTL", "30"))
+# Keep each session's conversation stage in sessions.conversation_stage_id, so an HTTP
+# turn resumes at the stage the previous one reached; enable once the column exists
+STORE_SESSION_STAGE = os.getenv("STORE_SESSION_STAGE", "False").lower() in ["true", "1", "t"]
+# langchain's verbose mode prints every prompt to stdout synchronously
+VERBOSE_CHAINS = os.getenv("VERBOSE_CHAINS", "False").lower() in ["true", "1", "t"]
 
 # Initialize FastAPI app
 app = FastAPI()
 
+# Concurrent identical /chat turns share one agent run
+chat_turns = SingleFlight(ttl=CHAT_DEDUPE_TTL)
+# Turns over MAX_INFLIGHT_TURNS are refused with 503 instead of queueing
+chat_admission = Admission()
+
 # Configure CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -37,6 +90,31 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+@app.middleware("http")
+async def tag_request(request: Request, call_next):
+    # the sampling decision is inherited by everything the request runs
+    start_request(request.headers.get("X-Request-ID") or uuid.uuid4().hex)
+    if not request.headers.get("X-Profile") or not request.url.path.startswith("/chat/"):
+        return await call_next(request)
+    if not admin_allowed(request.headers.get("X-Admin-Token")):
+        return JSONResponse(status_code=403, content={"detail": "Forbidden"})
+    profile_id = uuid.uuid4().hex
+    stop_profile = start_request_profile(profile_id)
+    if stop_profile is None:
+        return await call_next(request)
+    try:
+        response = await call_next(request)
+    except BaseException:
+        stop_profile()
+        raise
+    # call_next returns at the headers; a streamed turn runs while its body is sent
+    profiled = LeasedStreamingResponse(
+        response.body_iterator, release=stop_profile, status_code=response.status_code
+    )
+    profiled.raw_headers = [*response.raw_headers, (b"x-profile-id", profile_id.encode("ascii"))]
+    return profiled
+
 from fastapi import Header, HTTPException, Depends
 
 class AuthenticatedResponse(BaseModel):
@@ -56,21 +134,160 @@ async def say_hello():
     return {"message": "Hello World"}
 
 
+@app.get("/metrics")
+async def read_metrics():
+    return {**metrics.snapshot(), "embedding_cache_hit_rate": embedding_cache_hit_rate()}
+
+
+def require_admin(x_admin_token: str = Header(None)) -> None:
+    if not admin_allowed(x_admin_token):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+
+@app.get("/admin/profile", dependencies=[Depends(require_admin)])
+async def sample_profile(seconds: float = Query(10, gt=0)):
+    try:
+        stacks = await sampler.collapsed(seconds)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return PlainTextResponse(stacks)
+
+
+@app.get("/admin/profiles/{profile_id}", dependencies=[Depends(require_admin)])
+def read_profile(profile_id: str, sort: str = "cumulative", limit: int = Query(60, gt=0)):
+    if sort not in PROFILE_SORT_KEYS:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown sort {sort!r}. Expected one of {', '.join(PROFILE_SORT_KEYS)}"
+        )
+    report = profile_report(profile_id, limit=limit, sort=sort)
+    if report is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return PlainTextResponse(report)
+
+
+@app.exception_handler(PromptBudgetExceeded)
+async def prompt_too_large(request: Request, exc: PromptBudgetExceeded):
+    return JSONResponse(status_code=413, content={"detail": str(exc)})
+
+
+@app.exception_handler(DeadlineExceeded)
+async def deadline_exceeded(request: Request, exc: DeadlineExceeded):
+    return JSONResponse(status_code=504, content={"detail": str(exc)})
+
+
+@app.exception_handler(Overloaded)
+async def overloaded(request: Request, exc: Overloaded):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Server is busy, retry shortly"},
+        headers={"Retry-After": "1"},
+    )
+
+
+class LeasedStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse that calls `release` however the response ends, e.g. to
+    free an admission slot or stop a request profile.
+
+    The body generator's own finally does not run when the client is gone
+    before the body is started, so it is also called here.
+    """
+
+    def __init__(self, content, release, **kwargs):
+        super().__init__(content, **kwargs)
+        self.release = release
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.release()
+
+
 class MessageList(BaseModel):
     session_id: str
     human_say: str
 
 
 @app.post("/chat/{chat_id}")
-async def chat_with_sales_agent(chat_id, session_id: str = Body(None), human_say: str = Body(...), stream: bool = Query(False), file: UploadFile = File(None)):
-    sales_api = None
+async def chat_with_sales_agent(request: Request, chat_id, session_id: str = Body(None), human_say: str = Body(...), stream: bool = Query(False), segment: bool = Query(False), file: UploadFile = File(None), idempotency_key: str = Header(None, alias="Idempotency-Key")):
+    # only chat turns are bounded; /batch rows inherit no deadline
+    start_deadline(parse_timeout(request.headers.get("X-Request-Timeout")))
     user = get_user_from_key(chat_id)
 
     if user is None:
         raise HTTPException(status_code=401, detail="Unauthorized")
     
-    print(user["id"])
+    log_event("chat_request", user_id=user["id"], stream=stream)
 
+    extracted_text = ""
+
+    if file and file.filename.endswith(".pdf"):
+        file_content = await file.read()
+        pdf_reader = PyPDF2.PdfFileReader(BytesIO(file_content))
+        num_pages = pdf_reader.numPages
+
+        for page_num in range(num_pages):
+            page = pdf_reader.getPage(page_num)
+            extracted_text += page.extractText()
+
+    if stream:
+        release_slot = chat_admission.lease()
+        try:
+            session_id, sales_api, conversations_history = start_turn(user, session_id, human_say + extracted_text)
+        except BaseException:
+            release_slot()
+            raise
+
+        # StreamingResponse cancels this generator when the client disconnects
+        async def stream_response():
+            try:
+                stream_gen = sales_api.do_stream(conversations_history, human_say + extracted_text, segment=segment)
+                async for message in stream_gen:
+                    data = message if isinstance(message, dict) else {"token": message}
+                    yield json.dumps(data).encode("utf-8") + b"\n"
+            finally:
+                release_slot()
+
+        return LeasedStreamingResponse(stream_response(), release=release_slot)
+
+    async def run_turn():
+        started = time.monotonic()
+        usage = track_turn()
+        turn_session_id, sales_api, _ = start_turn(user, session_id, human_say + extracted_text)
+        response = await sales_api.do(human_say + extracted_text)
+
+        metadata = turn_metadata(response, time.monotonic() - started, usage)
+        insert_conversation(turn_session_id, response["reply"], "ai", metadata)
+        save_stage(turn_session_id, response["next_conversation_stage_id"])
+
+        response["session_id"] = turn_session_id
+
+        return response
+
+    key = turn_key(chat_id, session_id, human_say + extracted_text, idempotency_key)
+    with chat_admission.slot():
+        return await cancel_on_disconnect(
+            request.is_disconnected,
+            # the same words may be a new turn, so without a key only a running turn is shared
+            run_within_deadline(
+                "chat_turn",
+                chat_turns.do(key, run_turn, ttl=CHAT_DEDUPE_TTL if idempotency_key else 0),
+            ),
+        )
+
+
+def start_turn(user, session_id, human_say):
+    """Create the session if needed, load its history, build the agent and store the user turn."""
+    session_id, sales_api, conversations_history = open_session(user, session_id)
+
+    insert_conversation(session_id, "User: " + human_say + " <END_OF_TURN>", "human")
+
+    return session_id, sales_api, conversations_history
+
+
+def open_session(user, session_id):
+    """Create the session if needed, load its history and build the agent."""
     if session_id is None:
       new_session_payload = {
         "user_id": user["id"],
@@ -80,6 +297,10 @@ async def chat_with_sales_agent(chat_id, session_id: str = Body(None), human_say
       
       new_session = supabase_client.table("sessions").insert(new_session_payload).execute()
       session_id = new_session.data[0]["id"]
+      read_cache.invalidate(("user_sessions", str(user["id"])))
+      conversation_stage_id = "1"
+    else:
+      conversation_stage_id = load_stage(session_id)
 
 
     conversations = supabase_client.table("conversations").select("*").eq("session_id", session_id).limit(20).execute()
@@ -89,70 +310,249 @@ async def chat_with_sales_agent(chat_id, session_id: str = Body(None), human_say
     for conversation in conversations.data:
         conversations_history.append(conversation["text"])
 
+    if conversation_stage_id is None and not conversations_history:
+        conversation_stage_id = "1"
+
     sales_api = BlackSpaceAPI(
             config_path=user["config"],
-            verbose=True,
+            verbose=VERBOSE_CHAINS,
             product_catalog=user["products"],
             model_name=os.getenv("GPT_MODEL", "gpt-3.5-turbo-0613"),
             use_tools=os.getenv("USE_TOOLS_IN_API", "True").lower()
             in ["true", "1", "t"],
-            conversation_history=conversations_history
+            conversation_history=conversations_history,
+            tenant=user["id"],
+            conversation_stage_id=conversation_stage_id,
         )
 
-    extracted_text = ""
+    return session_id, sales_api, conversations_history
 
-    if file and file.filename.endswith(".pdf"):
-        file_content = await file.read()
-        pdf_reader = PyPDF2.PdfFileReader(BytesIO(file_content))
-        num_pages = pdf_reader.numPages
-
-        for page_num in range(num_pages):
-            page = pdf_reader.getPage(page_num)
-            extracted_text += page.extractText()
 
+def load_stage(session_id):
+    """Stored stage of a session, or None if it is not known."""
+    if not STORE_SESSION_STAGE:
+        return None
+    rows = supabase_client.table("sessions").select("conversation_stage_id").eq("id", session_id).execute().data
+    return rows[0].get("conversation_stage_id") if rows else None
 
-    human_input = "User: " + human_say  + extracted_text + " <END_OF_TURN>"
 
-    new_user_conversation = {
-        "session_id": session_id,
-        "text": human_input,
-        "type": "human",
-        "created_at": datetime.now().isoformat(),
-        "updated_at": datetime.now().isoformat()
-    }
+def save_stage(session_id, conversation_stage_id):
+    if not STORE_SESSION_STAGE:
+        return
+    supabase_client.table("sessions").update(
+        {"conversation_stage_id": conversation_stage_id, "updated_at": datetime.now().isoformat()}
+    ).eq("id", session_id).execute()
+    read_cache.invalidate(("sessions", str(session_id)))
 
-    supabase_client.table("conversations").insert(new_user_conversation).execute()
 
-    if stream:
-        async def stream_response():
-            stream_gen = sales_api.do_stream(conversations_history, human_say + extracted_text)
-            async for message in stream_gen:
-                data = {"token": message}
-                yield json.dumps(data).encode("utf-8") + b"\n"
-
-        return StreamingResponse(stream_response())
-    else:
-        response = await sales_api.do(human_say + extracted_text)
-
-        new_ai_conversation_payload = {
+def insert_conversation(session_id, text, conversation_type, metadata=None):
+    new_conversation = {
         "session_id": session_id,
-        "text": response["reply"],
-        "type": "ai",
+        "text": text,
+        "type": conversation_type,
         "created_at": datetime.now().isoformat(),
         "updated_at": datetime.now().isoformat()
+    }
+    if metadata is not None and STORE_TURN_METADATA:
+        new_conversation["metadata"] = metadata
+
+    supabase_client.table("conversations").insert(new_conversation).execute()
+    read_cache.invalidate(("conversations", str(session_id)))
+
+
+@app.websocket("/ws/chat/{chat_id}")
+async def chat_websocket(websocket: WebSocket, chat_id: str, session_id: str = None):
+    """
+    Persistent voice channel: authenticate and load the session once, then
+    stream every reply as it is generated.
+
+    Client messages are {"type": "utterance", "text": ...} and
+    {"type": "barge_in"}. The server sends "ready", "token", "sentence"
+    (speakable {"seq", "text"} chunks), "end", "cancelled" and "error"
+    messages. A new utterance or a barge-in cancels
+    the reply that is still being generated; the stage analysis that follows
+    a finished reply is not cancelled, and the next reply waits for it.
+    """
+    await websocket.accept()
+    try:
+        user = await run_in_threadpool(get_user_from_key, chat_id)
+    except (HTTPException, IndexError):
+        await websocket.close(code=4401)
+        return
+
+    session_id, sales_api, _ = await run_in_threadpool(open_session, user, session_id)
+    await websocket.send_json({"type": "ready", "session_id": session_id})
+
+    turn = None
+    # True while a reply is being generated, as opposed to the stage analysis after it
+    replying = False
+
+    async def run_turn(text, previous):
+        nonlocal replying
+        replying = True
+        if previous is not None:
+            # let the previous turn's stage analysis finish so this reply uses its stage
+            await asyncio.wait([previous])
+        start_request(uuid.uuid4().hex)
+        start_deadline(REQUEST_DEADLINE)
+        await run_in_threadpool(
+            insert_conversation, session_id, "User: " + text + " <END_OF_TURN>", "human"
+        )
+        reply = ""
+        end_of_call = False
+        segmenter = SentenceSegmenter()
+        started = time.monotonic()
+        usage = track_turn()
+        turn_info = {
+            "conversation_stage_id": sales_api.sales_agent.conversation_stage_id,
+            "model_name": sales_api.model_name,
         }
+        try:
+            async for message in sales_api.do_stream(None, text):
+                if isinstance(message, list):
+                    end_of_call = True
+                    continue
+                reply += message
+                await websocket.send_json({"type": "token", "text": message})
+                for chunk in segmenter.feed(message):
+                    await websocket.send_json({"type": "sentence", **chunk})
+            for chunk in segmenter.flush():
+                await websocket.send_json({"type": "sentence", **chunk})
+            replying = False
+            await websocket.send_json(
+                {"type": "end", "response": reply.strip(), "end_of_call": end_of_call}
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            replying = False
+            await websocket.send_json({"type": "error", "detail": str(e)})
+            return
+        finally:
+            # a barged-in reply is stored as far as the user heard it
+            metadata = turn_metadata(turn_info, time.monotonic() - started, usage)
+            await asyncio.shield(
+                run_in_threadpool(
+                    insert_conversation, session_id, reply.strip() + " <END_OF_TURN>", "ai", metadata
+                )
+            )
+        # the reply is out; the next turn's stage is not bound by this one's deadline
+        start_deadline(None)
+        try:
+            await sales_api.sales_agent.adetermine_conversation_stage()
+            await run_in_threadpool(save_stage, session_id, sales_api.sales_agent.conversation_stage_id)
+        except Exception as e:
+            log_event("stage_analysis_failed", session_id=session_id, error=str(e))
+            await websocket.send_json({"type": "error", "detail": str(e)})
+
+    async def cancel_turn():
+        # only an unfinished reply is interrupted; stage analysis runs to completion
+        if turn is not None and not turn.done() and replying:
+            turn.cancel()
+            try:
+                await turn
+            except asyncio.CancelledError:
+                pass
+            await websocket.send_json({"type": "cancelled"})
 
-        supabase_client.table("conversations").insert(new_ai_conversation_payload).execute()
+    try:
+        while True:
+            message = await websocket.receive_json()
+            if message.get("type") == "barge_in":
+                await cancel_turn()
+            elif message.get("type") == "utterance":
+                await cancel_turn()
+                turn = asyncio.create_task(run_turn(message.get("text", ""), turn))
+            else:
+                await websocket.send_json(
+                    {"type": "error", "detail": f"Unknown message type {message.get('type')!r}"}
+                )
+    except WebSocketDisconnect:
+        pass
+    finally:
+        if turn is not None and not turn.done():
+            turn.cancel()
+
+@app.post("/batch/{chat_id}")
+async def batch_chat(chat_id, file: UploadFile = File(...), provider_batch: int = Query(0), analyze_stage: bool = Query(True)):
+    """
+    Run a JSONL upload of {"conversation_history", "human_input"} rows for this
+    tenant and stream one JSONL result per row as it completes. Rows always
+    use the tenant's config; they may carry their own "product_catalog" and
+    the "conversation_stage_id" their history has reached.
+    """
+    user = get_user_from_key(chat_id)
 
-        response["session_id"] = session_id
+    if user is None:
+        raise HTTPException(status_code=401, detail="Unauthorized")
 
-        return response
+    rows = []
+    for index, line in enumerate((await file.read()).decode("utf-8").splitlines()):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Line {index + 1} is not valid JSON")
+        row.setdefault("id", index)
+        # tool settings (e.g. http_lookup urls) come from the tenant's stored config only
+        row["config"] = user["config"]
+        row.setdefault("product_catalog", user["products"])
+        rows.append(row)
+
+    use_tools = os.getenv("USE_TOOLS_IN_API", "True").lower() in ["true", "1", "t"]
+    runner = BatchRunner(
+        model_name=os.getenv("GPT_MODEL", "gpt-3.5-turbo-0613"),
+        use_tools=use_tools,
+        concurrency=int(os.getenv("BATCH_CONCURRENCY", "8")),
+        provider_batch_size=provider_batch,
+        analyze_stage=analyze_stage,
+        tenant=user["id"],
+    )
+
+    async def stream_results():
+        async for result in runner.run(rows):
+            yield json.dumps(result, default=str).encode("utf-8") + b"\n"
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
 
 supabase_url = os.getenv("SUPABASE_URL")
 supabase_key = os.getenv("SUPABASE_KEY")
 
 supabase_client = create_client(supabase_url, supabase_key)
 
+
+def write_usage(rows):
+    # adds to the (tenant, role, model, period_start) totals; see README
+    supabase_client.rpc("add_token_usage", {"usage": rows}).execute()
+
+
+def load_usage(tenants, period_start):
+    return (
+        supabase_client.table("token_usage")
+        .select("tenant,role,calls,prompt_tokens,completion_tokens,latency_ms")
+        .eq("period_start", period_start)
+        .in_("tenant", tenants)
+        .execute()
+        .data
+    )
+
+
+# Token usage is kept in memory, written to token_usage in batches and
+# reloaded from it, so budgets count every worker's usage
+meter.start(write_usage, load_usage)
+
+
+def require_tenant(user_id: int, authorization: str = Header(None), x_admin_token: str = Header(None)) -> None:
+    """Allow the tenant itself, by its key in Authorization, or an admin."""
+    if admin_allowed(x_admin_token):
+        return
+    if not authorization:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    users = supabase_client.table("users").select("id").eq("key", authorization).execute().data
+    if not users or users[0]["id"] != user_id:
+        raise HTTPException(status_code=403, detail="Forbidden")
+
 class ConversationCreate(BaseModel):
     session_id: int
     text: str
@@ -178,17 +578,72 @@ def create_conversation(conversation_data: ConversationCreate):
     }
     try:
         response = supabase_client.table("conversations").insert(data).execute()
+        read_cache.invalidate(("conversations", str(conversation_data.session_id)))
         return response
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
 
-@app.get("/conversations/{session_id}/")
-def read_conversation(session_id: int):
+CONVERSATION_FIELDS = ("id", "session_id", "text", "type", "created_at", "updated_at")
+USER_FIELDS = ("id", "name", "config", "products", "created_at", "updated_at")
+# catalogs can be megabytes; ask for products explicitly
+USER_DEFAULT_FIELDS = ("id", "name", "config", "created_at", "updated_at")
+SESSION_FIELDS = ("id", "user_id", "created_at", "updated_at")
+
+
+def read_page(request, table, scope, filters, fields, cursor, limit, allowed, default=None):
+    """One keyset page of `table`, served through the read cache."""
     try:
-        response = supabase_client.table("conversations").select("*").eq("session_id", session_id).execute()
-        return response
-    except Exception as e:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+        columns = projection(fields, allowed, default or allowed)
+        limit = page_limit(limit)
+        if cursor:
+            decode_cursor(cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    def load():
+        query = supabase_client.table(table).select(",".join(dict.fromkeys([*columns, *KEYSET])))
+        for column, value in filters:
+            query = query.eq(column, value)
+        try:
+            rows = paginate(query, cursor, limit).execute().data
+        except Exception as e:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+        return page(rows, limit, columns)
+
+    return cached_read(request, scope, (tuple(columns), cursor, limit), load)
+
+
+def read_rows(request, table, scope, filters, fields, allowed, default=None):
+    """Rows of `table` matching `filters`, projected and served through the read cache."""
+    try:
+        columns = projection(fields, allowed, default or allowed)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    def load():
+        query = supabase_client.table(table).select(",".join(columns))
+        for column, value in filters:
+            query = query.eq(column, value)
+        try:
+            return {"data": query.execute().data}
+        except Exception as e:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+
+    return cached_read(request, scope, (tuple(columns),), load)
+
+
+@app.get("/conversations/{session_id}/")
+def read_conversation(request: Request, session_id: int, cursor: str = None, limit: int = Query(None), fields: str = None):
+    """
+    The session's conversation rows, oldest first, `limit` per page.
+
+    Pass the returned next_cursor as `cursor` for the following page and
+    `fields` (e.g. "text,type") to select columns.
+    """
+    return read_page(
+        request, "conversations", ("conversations", str(session_id)), [("session_id", session_id)],
+        fields, cursor, limit, CONVERSATION_FIELDS,
+    )
 
 # User API Endpoints
 @app.post("/users/", status_code=status.HTTP_201_CREATED)
@@ -202,17 +657,57 @@ def create_user(user_data: UserCreate):
     }
     try:
         response = supabase_client.table("users").insert(data).execute()
-        return response
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    # embed the catalog now, so the tenant's first chat does not have to
+    ingestion.submit(response.data[0]["id"], user_data.products)
+    return response
 
-@app.get("/users/{user_id}/")
-def read_user(user_id: int):
+class CatalogUpdate(BaseModel):
+    products: str
+
+@app.put("/users/{user_id}/products", dependencies=[Depends(require_tenant)])
+def update_products(user_id: int, catalog: CatalogUpdate):
+    """Replace a tenant's catalog; chats keep the current index until the new one is built."""
+    data = {"products": catalog.products, "updated_at": datetime.now().isoformat()}
     try:
-        response = supabase_client.table("users").select("*").eq("id", user_id).execute()
-        return response
+        response = supabase_client.table("users").update(data).eq("id", user_id).execute()
     except Exception as e:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    if not response.data:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    read_cache.invalidate(("users", str(user_id)))
+    return ingestion.submit(user_id, catalog.products)
+
+@app.get("/users/{user_id}/ingestion", dependencies=[Depends(require_tenant)])
+def read_ingestion(user_id: int):
+    """Progress of the tenant's latest catalog ingestion job."""
+    job = ingestion.status(user_id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No ingestion job")
+    return job
+
+@app.get("/users/{user_id}/usage", dependencies=[Depends(require_tenant)])
+def read_usage(user_id: int):
+    """Tokens the tenant used in the current budget window, per role, and whether it is degraded."""
+    user = supabase_client.table("users").select("config").eq("id", user_id).execute().data
+    if not user:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    return meter.usage(user_id, (user[0]["config"] or {}).get("token_budget"))
+
+@app.get("/users/{user_id}/")
+def read_user(request: Request, user_id: int, fields: str = None):
+    return read_rows(
+        request, "users", ("users", str(user_id)), [("id", user_id)], fields, USER_FIELDS, USER_DEFAULT_FIELDS
+    )
+
+@app.get("/users/{user_id}/sessions")
+def read_user_sessions(request: Request, user_id: int, cursor: str = None, limit: int = Query(None), fields: str = None):
+    """The user's sessions, oldest first, paginated like conversations."""
+    return read_page(
+        request, "sessions", ("user_sessions", str(user_id)), [("user_id", user_id)],
+        fields, cursor, limit, SESSION_FIELDS,
+    )
 
 # Session API Endpoints
 @app.post("/sessions/", status_code=status.HTTP_201_CREATED)
@@ -224,17 +719,16 @@ def create_session(session_data: SessionCreate):
     }
     try:
         response = supabase_client.table("sessions").insert(data).execute()
+        read_cache.invalidate(("user_sessions", str(session_data.user_id)))
         return response
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
 
 @app.get("/sessions/{session_id}/")
-def read_session(session_id: int):
-    try:
-        response = supabase_client.table("sessions").select("*").eq("id", session_id).execute()
-        return response
-    except Exception as e:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+def read_session(request: Request, session_id: int, fields: str = None):
+    return read_rows(
+        request, "sessions", ("sessions", str(session_id)), [("id", session_id)], fields, SESSION_FIELDS
+    )
 
 # Main entry point
 if __name__ == "__main__":
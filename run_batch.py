@@ -0,0 +1,45 @@
+import argparse
+import asyncio
+import os
+
+from dotenv import load_dotenv
+
+from server.batch import BatchRunner, run_batch_file
+
+# Load environment variables
+load_dotenv()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run a JSONL batch of (config, conversation_history, human_input) rows through the sales agent."
+    )
+    parser.add_argument("--input", required=True, help="JSONL file with one row per line")
+    parser.add_argument("--output", required=True, help="JSONL file results are appended to")
+    parser.add_argument("--concurrency", type=int, default=int(os.getenv("BATCH_CONCURRENCY", "8")))
+    parser.add_argument(
+        "--provider-batch",
+        type=int,
+        default=0,
+        help="group this many tools-free rows per litellm batch_completion call",
+    )
+    parser.add_argument("--no-tools", action="store_true", help="run without the tools agent")
+    parser.add_argument("--skip-stage", action="store_true", help="skip the stage analyzer call per row")
+    parser.add_argument("--no-resume", action="store_true", help="overwrite the output instead of resuming")
+    args = parser.parse_args()
+
+    runner = BatchRunner(
+        model_name=os.getenv("GPT_MODEL", "gpt-3.5-turbo-0613"),
+        use_tools=not args.no_tools,
+        concurrency=args.concurrency,
+        provider_batch_size=args.provider_batch,
+        analyze_stage=not args.skip_stage,
+    )
+    processed = asyncio.run(
+        run_batch_file(args.input, args.output, runner, resume=not args.no_resume)
+    )
+    print(f"Processed {processed} rows into {args.output}")
+
+
+if __name__ == "__main__":
+    main()
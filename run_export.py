@@ -0,0 +1,33 @@
+import argparse
+import os
+
+from dotenv import load_dotenv
+from supabase import create_client
+
+# Load environment variables
+load_dotenv()
+
+from server.export import EXPORT_BATCH_ROWS, EXPORT_DIR, ConversationExporter
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export new conversation turns to Parquet files partitioned by tenant and day."
+    )
+    parser.add_argument("--output", default=EXPORT_DIR, help="root directory of the Parquet dataset")
+    parser.add_argument("--batch-rows", type=int, default=EXPORT_BATCH_ROWS)
+    parser.add_argument(
+        "--since",
+        help="export rows after this created_at instead of after the saved watermark",
+    )
+    args = parser.parse_args()
+
+    supabase_client = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY"))
+    exporter = ConversationExporter(supabase_client, args.output, args.batch_rows)
+    since = {"created_at": args.since, "id": 0} if args.since else None
+    rows, files = exporter.run(since=since)
+    print(f"Exported {rows} rows into {files} files under {args.output}")
+
+
+if __name__ == "__main__":
+    main()
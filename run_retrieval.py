@@ -0,0 +1,28 @@
+import argparse
+import asyncio
+
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+from server.retrieval import RETRIEVAL_DIR, RETRIEVAL_SOCKET, RetrievalServer
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the retrieval sidecar that serves catalog indexes to every API worker."
+    )
+    parser.add_argument(
+        "--socket",
+        default=RETRIEVAL_SOCKET or "/tmp/blackspace-retrieval.sock",
+        help="Unix socket to listen on; point the workers' RETRIEVAL_SOCKET at it",
+    )
+    parser.add_argument("--data-dir", default=RETRIEVAL_DIR, help="where catalog indexes are persisted")
+    args = parser.parse_args()
+
+    asyncio.run(RetrievalServer(data_dir=args.data_dir).serve(args.socket))
+
+
+if __name__ == "__main__":
+    main()
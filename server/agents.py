@@ -1,5 +1,6 @@
+import os
 from copy import deepcopy
-from typing import Any, Callable, Dict, List, Union
+from typing import Any, Callable, Dict, List, Optional, Union
 
 from langchain.agents import (
     AgentExecutor,
@@ -17,12 +18,26 @@ from langchain_core.language_models.llms import create_base_retry_decorator
 from litellm import acompletion
 from pydantic import Field
 
+from server.budget import PromptBudget
 from server.chains import SalesConversationChain, StageAnalyzerChain
+from server.composer import PROMPT_SLIMMING, compose_prompt, tools_for_stage
 from server.custom_invoke import CustomAgentExecutor
-from server.logger import time_logger
-from server.parsers import SalesConvoOutputParser
-from server.prompts import SALES_AGENT_TOOLS_PROMPT
+from server.deadline import check
+from server.generation import END_OF_TURN, strip_control_markers
+from server.hedging import HEDGE_BUDGET, hedger
+from server.logger import log_event, log_payload, payload_enabled, time_logger
+from server.memory import Role, TurnStore
+from server.parsers import SalesConvoOutputParser, agent_actions
+from server.prompts import SALES_AGENT_STRUCTURED_TOOLS_PROMPT, SALES_AGENT_TOOLS_PROMPT
+from server.routing import ModelRouter
+from server.speculation import (
+    SPECULATIVE_RETRIEVAL,
+    Prefetch,
+    finish_prefetch,
+    start_prefetch,
+)
 from server.stages import CONVERSATION_STAGES
+from server.structured_agent import StructuredToolsAgent, supports_tool_calls
 from server.templates import CustomPromptTemplateForTools
 from server.tools import get_tools, setup_knowledge_base
 
@@ -40,11 +55,20 @@ def _create_retry_decorator(llm: Any) -> Callable[[Any], Any]:
     return create_base_retry_decorator(error_types=errors, max_retries=llm.max_retries)
 
 
+CONVERSATION_STAGES_TEXT = "\n".join(
+    str(key) + ": " + str(value) for key, value in CONVERSATION_STAGES.items()
+)
+
+
 class BlackSpaceAI(Chain):
 
-    conversation_history: List[str] = []
+    conversation_history: TurnStore = TurnStore()
+    end_of_call: bool = False
     conversation_stage_id: str = "1"
     current_conversation_stage: str = CONVERSATION_STAGES.get("1")
+    # False when a conversation is resumed without its stored stage; prompts and
+    # tools are then not slimmed, since "1" would only be a guess
+    conversation_stage_known: bool = True
     stage_analyzer_chain: StageAnalyzerChain = Field(...)
     sales_agent_executor: Union[CustomAgentExecutor, None] = Field(...)
     knowledge_base: Union[RetrievalQA, None] = Field(...)
@@ -52,8 +76,10 @@ class BlackSpaceAI(Chain):
     conversation_stage_dict: Dict = CONVERSATION_STAGES
 
     model_name: str = "gpt-3.5-turbo-0613"
+    model_router: Union[ModelRouter, None] = None
 
     use_tools: bool = False
+    prompt_slimming: bool = False
     salesperson_name: str = ""
     salesperson_role: str = ""
     company_name: str = ""
@@ -80,74 +106,186 @@ class BlackSpaceAI(Chain):
     def seed_agent(self, conversation_history):
 
         self.current_conversation_stage = self.retrieve_conversation_stage("1")
-        self.conversation_history = conversation_history
+        self.conversation_history = TurnStore.from_strings(
+            conversation_history, self.salesperson_name
+        )
+        self.end_of_call = False
+
+    def restore_stage(self, conversation_stage_id: Optional[str]) -> None:
+        """Continue at a stored stage; None when the stage of the history is unknown."""
+
+        self.conversation_stage_known = conversation_stage_id is not None
+        self.conversation_stage_id = conversation_stage_id or "1"
+        self.current_conversation_stage = self.retrieve_conversation_stage(
+            self.conversation_stage_id
+        )
+
+    def _slimming_stage_id(self) -> Optional[str]:
+        """Stage the prompt and tools are slimmed to; None leaves them whole."""
+
+        return self.conversation_stage_id if self.conversation_stage_known else None
 
     @time_logger
     def determine_conversation_stage(self):
 
-        print(f"Conversation Stage ID before analysis: {self.conversation_stage_id}")
-        print("Conversation history:")
-        print(self.conversation_history)
-        stage_analyzer_output = self.stage_analyzer_chain.invoke(
-            input={
-                "conversation_history": "\n".join(self.conversation_history).rstrip(
-                    "\n"
-                ),
-                "conversation_stage_id": self.conversation_stage_id,
-                "conversation_stages": "\n".join(
-                    [
-                        str(key) + ": " + str(value)
-                        for key, value in CONVERSATION_STAGES.items()
-                    ]
+        if payload_enabled():
+            log_payload(
+                "stage_analysis_input",
+                conversation_stage_id=self.conversation_stage_id,
+                conversation_history=self.conversation_history.render(
+                    self.salesperson_name
                 ),
-            },
+            )
+        stage_analyzer_output = self.stage_analyzer_chain.invoke(
+            input=self._stage_analyzer_inputs(),
             return_only_outputs=False,
         )
-        print("Stage analyzer output")
-        print(stage_analyzer_output)
-        self.conversation_stage_id = stage_analyzer_output.get("text")
+        log_payload("stage_analyzer_output", output=stage_analyzer_output.get("text"))
+        self.conversation_stage_id = stage_analyzer_output.get("text").strip()
+        self.conversation_stage_known = True
 
         self.current_conversation_stage = self.retrieve_conversation_stage(
             self.conversation_stage_id
         )
 
-        print(f"Conversation Stage: {self.current_conversation_stage}")
+        log_event("conversation_stage", conversation_stage_id=self.conversation_stage_id)
 
     @time_logger
     async def adetermine_conversation_stage(self):
 
-        print(f"Conversation Stage ID before analysis: {self.conversation_stage_id}")
-        print("Conversation history:")
-        print(self.conversation_history)
-        stage_analyzer_output = await self.stage_analyzer_chain.ainvoke(
-            input={
-                "conversation_history": "\n".join(self.conversation_history).rstrip(
-                    "\n"
-                ),
-                "conversation_stage_id": self.conversation_stage_id,
-                "conversation_stages": "\n".join(
-                    [
-                        str(key) + ": " + str(value)
-                        for key, value in CONVERSATION_STAGES.items()
-                    ]
+        check("stage_analysis")
+        if payload_enabled():
+            log_payload(
+                "stage_analysis_input",
+                conversation_stage_id=self.conversation_stage_id,
+                conversation_history=self.conversation_history.render(
+                    self.salesperson_name
                 ),
-            },
+            )
+        stage_analyzer_output = await self.stage_analyzer_chain.ainvoke(
+            input=self._stage_analyzer_inputs(),
             return_only_outputs=False,
         )
-        print("Stage analyzer output")
-        print(stage_analyzer_output)
-        self.conversation_stage_id = stage_analyzer_output.get("text")
+        log_payload("stage_analyzer_output", output=stage_analyzer_output.get("text"))
+        self.conversation_stage_id = stage_analyzer_output.get("text").strip()
+        self.conversation_stage_known = True
 
         self.current_conversation_stage = self.retrieve_conversation_stage(
             self.conversation_stage_id
         )
 
-        print(f"Conversation Stage: {self.current_conversation_stage}")
+        log_event("conversation_stage", conversation_stage_id=self.conversation_stage_id)
+
+    def _fitted_history(self, role: str, template: str, values: Dict[str, Any]) -> str:
+        """Conversation history trimmed so the role's prompt fits its model."""
+
+        route = self.model_router.route(role) if self.model_router else None
+        budget = PromptBudget(
+            route.model if route else self.model_name,
+            route.max_tokens if route else None,
+            role=role,
+        )
+        history, _ = budget.fit(
+            template, values, self.conversation_history, self.salesperson_name
+        )
+        return history
+
+    def _stage_analyzer_inputs(self) -> Dict[str, Any]:
+
+        inputs = {
+            "conversation_stage_id": self.conversation_stage_id,
+            "conversation_stages": CONVERSATION_STAGES_TEXT,
+        }
+        inputs["conversation_history"] = self._fitted_history(
+            "stage_analyzer", self.stage_analyzer_chain.prompt.template, inputs
+        )
+        return inputs
+
+    def _utterance_inputs(self) -> Dict[str, Any]:
+
+        inputs = {
+            "conversation_stage": self.current_conversation_stage,
+            "salesperson_name": self.salesperson_name,
+            "salesperson_role": self.salesperson_role,
+            "company_name": self.company_name,
+            "company_business": self.company_business,
+            "company_values": self.company_values,
+            "conversation_purpose": self.conversation_purpose,
+            "conversation_type": self.conversation_type,
+        }
+        inputs["conversation_history"] = self._fitted_history(
+            "utterance", self._utterance_chain().prompt.template, inputs
+        )
+        return inputs
+
+    def _utterance_chain(self) -> SalesConversationChain:
+        """The utterance chain, with its prompt slimmed to the current stage."""
+
+        chain = self.sales_conversation_utterance_chain
+        if not self.prompt_slimming:
+            return chain
+        prompt = compose_prompt(
+            chain.prompt.template,
+            tuple(chain.prompt.input_variables),
+            self._slimming_stage_id(),
+        )
+        return chain.copy(update={"prompt": prompt})
+
+    def _tools_enabled(self) -> bool:
+        """Whether this turn goes through the tools agent."""
+
+        if not self.use_tools:
+            return False
+        if not self.prompt_slimming:
+            return True
+        return bool(
+            tools_for_stage(self.sales_agent_executor.tools, self._slimming_stage_id())
+        )
+
+    def _start_prefetch(self) -> Union[Prefetch, None]:
+        """Query the catalog with the user's words while the planner decides on a tool."""
+
+        if not SPECULATIVE_RETRIEVAL or not self.conversation_history:
+            return None
+        last_turn = self.conversation_history[-1]
+        if last_turn.role != Role.USER:
+            return None
+        tools = self.sales_agent_executor.tools
+        if self.prompt_slimming:
+            tools = tools_for_stage(tools, self._slimming_stage_id())
+        for tool in tools:
+            retriever = (tool.metadata or {}).get("retriever")
+            if retriever is not None:
+                return start_prefetch(retriever, last_turn.text)
+        return None
+
+    def _agent_inputs(self) -> Dict[str, Any]:
+
+        if not self._tools_enabled():
+            return {"input": "", **self._utterance_inputs()}
+        # the tools prompt fits the history itself, around the scratchpad
+        return {
+            "input": "",
+            "conversation_stage_id": self._slimming_stage_id(),
+            "conversation_stage": self.current_conversation_stage,
+            "conversation_history": self.conversation_history,
+            "salesperson_name": self.salesperson_name,
+            "salesperson_role": self.salesperson_role,
+            "company_name": self.company_name,
+            "company_business": self.company_business,
+            "company_values": self.company_values,
+            "conversation_purpose": self.conversation_purpose,
+            "conversation_type": self.conversation_type,
+        }
 
     def human_step(self, human_input):
 
-        human_input = "User: " + human_input + " <END_OF_TURN>"
-        self.conversation_history.append(human_input)
+        self.conversation_history.append(Role.USER, human_input)
+
+    def add_ai_turn(self, output: str):
+
+        text, self.end_of_call = strip_control_markers(output)
+        self.conversation_history.append(Role.AI, text)
 
     @time_logger
     def step(self, stream: bool = False):
@@ -167,63 +305,44 @@ class BlackSpaceAI(Chain):
 
     @time_logger
     async def acall(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
-    
-        inputs = {
-            "input": "",
-            "conversation_stage": self.current_conversation_stage,
-            "conversation_history": "\n".join(self.conversation_history),
-            "salesperson_name": self.salesperson_name,
-            "salesperson_role": self.salesperson_role,
-            "company_name": self.company_name,
-            "company_business": self.company_business,
-            "company_values": self.company_values,
-            "conversation_purpose": self.conversation_purpose,
-            "conversation_type": self.conversation_type,
-        }
+
+        check("agent_step")
+        inputs = self._agent_inputs()
 
         # Generate agent's utterance
-        if self.use_tools:
-            ai_message = await self.sales_agent_executor.ainvoke(inputs)
+        if self._tools_enabled():
+            prefetch = self._start_prefetch()
+            try:
+                ai_message = await self.sales_agent_executor.ainvoke(inputs)
+            finally:
+                finish_prefetch(prefetch)
+            ai_message["agent_actions"] = agent_actions(
+                ai_message.get("intermediate_steps", [])
+            )
             output = ai_message["output"]
         else:
-            ai_message = await self.sales_conversation_utterance_chain.ainvoke(
+            ai_message = await self._utterance_chain().ainvoke(
                 inputs, return_intermediate_steps=True
             )
             output = ai_message["text"]
 
         # Add agent's response to conversation history
-        agent_name = self.salesperson_name
-        output = agent_name + ": " + output
-        if "<END_OF_TURN>" not in output:
-            output += " <END_OF_TURN>"
-        self.conversation_history.append(output)
-
-        if self.verbose:
-            tool_status = "USE TOOLS INVOKE:" if self.use_tools else "WITHOUT TOOLS:"
-            print(f"{tool_status}\n#\n#\n#\n#\n------------------")
-            print(f"AI Message: {ai_message}")
-            print()
-            print(f"Output: {output.replace('<END_OF_TURN>', '')}")
+        self.add_ai_turn(output)
+
+        log_payload(
+            "agent_step",
+            use_tools=self.use_tools,
+            ai_message=ai_message,
+            output=self.conversation_history[-1].text,
+        )
 
         return ai_message
 
     @time_logger
     def _prep_messages(self):
 
-        prompt = self.sales_conversation_utterance_chain.prep_prompts(
-            [
-                dict(
-                    conversation_stage=self.current_conversation_stage,
-                    conversation_history="\n".join(self.conversation_history),
-                    salesperson_name=self.salesperson_name,
-                    salesperson_role=self.salesperson_role,
-                    company_name=self.company_name,
-                    company_business=self.company_business,
-                    company_values=self.company_values,
-                    conversation_purpose=self.conversation_purpose,
-                    conversation_type=self.conversation_type,
-                )
-            ]
+        prompt = self._utterance_chain().prep_prompts(
+            [self._utterance_inputs()]
         )
 
         inception_messages = prompt[0][0].to_messages()
@@ -242,11 +361,24 @@ class BlackSpaceAI(Chain):
 
         return self.sales_conversation_utterance_chain.llm.completion_with_retry(
             messages=messages,
-            stop="<END_OF_TURN>",
             stream=True,
-            model=self.model_name,
+            **self._utterance_generation_params(),
         )
 
+    def _utterance_generation_params(self) -> Dict[str, Any]:
+
+        if self.model_router is None:
+            return {"model": self.model_name, "stop": [END_OF_TURN]}
+        route = self.model_router.route("utterance")
+        params = {
+            "model": route.model,
+            "stop": route.stop or [END_OF_TURN],
+            "metadata": self.model_router.metadata("utterance"),
+        }
+        if route.max_tokens is not None:
+            params["max_tokens"] = route.max_tokens
+        return params
+
     async def acompletion_with_retry(self, llm: Any, **kwargs: Any) -> Any:
 
         retry_decorator = _create_retry_decorator(llm)
@@ -260,69 +392,76 @@ class BlackSpaceAI(Chain):
 
     async def _astreaming_generator(self):
 
+        check("utterance_stream")
         messages = self._prep_messages()
+        llm = self.sales_conversation_utterance_chain.llm
+        params = self._utterance_generation_params()
 
-        return await self.acompletion_with_retry(
-            llm=self.sales_conversation_utterance_chain.llm,
-            messages=messages,
-            stop="<END_OF_TURN>",
-            stream=True,
-            model=self.model_name,
+        async def open_stream(model: str) -> Any:
+            return await self.acompletion_with_retry(
+                llm=llm, messages=messages, stream=True, **{**params, "model": model}
+            )
+
+        # hedged on the first token, which is what the caller is waiting for
+        return await hedger.run_stream(
+            "utterance",
+            params["model"],
+            getattr(llm, "hedge_model", None),
+            open_stream,
+            getattr(llm, "hedge_budget", HEDGE_BUDGET),
         )
 
     def _call(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
 
-        inputs = {
-            "input": "",
-            "conversation_stage": self.current_conversation_stage,
-            "conversation_history": "\n".join(self.conversation_history),
-            "salesperson_name": self.salesperson_name,
-            "salesperson_role": self.salesperson_role,
-            "company_name": self.company_name,
-            "company_business": self.company_business,
-            "company_values": self.company_values,
-            "conversation_purpose": self.conversation_purpose,
-            "conversation_type": self.conversation_type,
-        }
+        inputs = self._agent_inputs()
 
 
-        if self.use_tools:
+        if self._tools_enabled():
             ai_message = self.sales_agent_executor.invoke(inputs)
             output = ai_message["output"]
         else:
-            ai_message = self.sales_conversation_utterance_chain.invoke(
+            ai_message = self._utterance_chain().invoke(
                 inputs, return_intermediate_steps=True
             )
             output = ai_message["text"]
 
         # Add agent's response to conversation history
-        agent_name = self.salesperson_name
-        output = agent_name + ": " + output
-        if "<END_OF_TURN>" not in output:
-            output += " <END_OF_TURN>"
-        self.conversation_history.append(output)
-
-        if self.verbose:
-            tool_status = "USE TOOLS INVOKE:" if self.use_tools else "WITHOUT TOOLS:"
-            print(f"{tool_status}\n#\n#\n#\n#\n------------------")
-            print(f"AI Message: {ai_message}")
-            print()
-            print(f"Output: {output.replace('<END_OF_TURN>', '')}")
+        self.add_ai_turn(output)
+
+        log_payload(
+            "agent_step",
+            use_tools=self.use_tools,
+            ai_message=ai_message,
+            output=self.conversation_history[-1].text,
+        )
 
         return ai_message
 
     @classmethod
     @time_logger
-    def from_llm(cls, llm: ChatLiteLLM, verbose: bool = False, **kwargs) -> "BlackSpaceAI":
-
-        stage_analyzer_chain = StageAnalyzerChain.from_llm(llm, verbose=verbose)
-        sales_conversation_utterance_chain = SalesConversationChain.from_llm(
-            llm, verbose=verbose
+    def from_llm(
+        cls,
+        llm: ChatLiteLLM,
+        verbose: bool = False,
+        router: ModelRouter = None,
+        **kwargs,
+    ) -> "BlackSpaceAI":
+
+        if router is None:
+            router = ModelRouter.from_config(default_model=llm.model)
+
+        stage_analyzer_chain = StageAnalyzerChain.from_llm(
+            router.llm("stage_analyzer"), verbose=verbose
         )
 
         # Handle custom prompts
         use_custom_prompt = kwargs.pop("use_custom_prompt", False)
         custom_prompt = kwargs.pop("custom_prompt", None)
+        # custom prompts are used as written
+        prompt_slimming = (
+            str(kwargs.pop("prompt_slimming", PROMPT_SLIMMING)).lower() in ["true", "1", "t"]
+            and not use_custom_prompt
+        )
 
         sales_conversation_utterance_chain = SalesConversationChain.from_llm(
             llm,
@@ -346,38 +485,91 @@ class BlackSpaceAI(Chain):
         sales_agent_executor = None
         knowledge_base = None
 
+        # Native tool calls where the model supports them, text protocol otherwise
+        structured_tools = str(
+            kwargs.pop("structured_tools", os.getenv("USE_STRUCTURED_TOOLS", "True"))
+        ).lower() in ["true", "1", "t"]
+        tool_configs = kwargs.pop("tools", None)
+        # tenant whose ingested catalog index ProductSearch may use
+        tenant = kwargs.pop("tenant", None)
+        # Actions accepted from one planning step, executed concurrently
+        max_actions = int(
+            kwargs.pop("max_parallel_tools", os.getenv("MAX_PARALLEL_TOOLS", "3"))
+        )
+
         if use_tools:
             product_catalog = kwargs.pop("product_catalog", None)
-            tools = get_tools(product_catalog)
-
-            prompt = CustomPromptTemplateForTools(
-                template=SALES_AGENT_TOOLS_PROMPT,
-                tools_getter=lambda x: tools,
-                input_variables=[
-                    "input",
-                    "intermediate_steps",
-                    "salesperson_name",
-                    "salesperson_role",
-                    "company_name",
-                    "company_business",
-                    "company_values",
-                    "conversation_purpose",
-                    "conversation_type",
-                    "conversation_history",
-                ],
-            )
-            llm_chain = LLMChain(llm=llm, prompt=prompt, verbose=verbose)
-            tool_names = [tool.name for tool in tools]
-            output_parser = SalesConvoOutputParser(
-                ai_prefix=kwargs.get("salesperson_name", ""), verbose=verbose
+            tools = get_tools(
+                product_catalog,
+                llm=router.llm("kb_qa"),
+                tool_configs=tool_configs,
+                tenant=tenant,
             )
-            sales_agent_with_tools = LLMSingleActionAgent(
-                llm_chain=llm_chain,
-                output_parser=output_parser,
-                stop=["\nObservation:"],
-                allowed_tools=tool_names,
+
+            input_variables = [
+                "input",
+                "intermediate_steps",
+                "salesperson_name",
+                "salesperson_role",
+                "company_name",
+                "company_business",
+                "company_values",
+                "conversation_purpose",
+                "conversation_type",
+                "conversation_history",
+                "conversation_stage_id",
+            ]
+            tool_planner_llm = router.llm("tool_planner", with_stop=False)
+            tool_planner_stop = router.route("tool_planner").stop
+
+            tool_planner_budget = PromptBudget(
+                tool_planner_llm.model,
+                router.route("tool_planner").max_tokens,
+                role="tool_planner",
             )
 
+            if structured_tools and supports_tool_calls(tool_planner_llm.model):
+                prompt = CustomPromptTemplateForTools(
+                    template=SALES_AGENT_STRUCTURED_TOOLS_PROMPT,
+                    tools_getter=lambda x: tools,
+                    input_variables=input_variables,
+                    budget=tool_planner_budget,
+                    stage_aware=prompt_slimming,
+                )
+                sales_agent_with_tools = StructuredToolsAgent(
+                    llm=tool_planner_llm,
+                    prompt=prompt,
+                    tools=tools,
+                    ai_prefix=kwargs.get("salesperson_name", ""),
+                    stop=tool_planner_stop,
+                    max_actions=max_actions,
+                )
+            else:
+                prompt = CustomPromptTemplateForTools(
+                    template=SALES_AGENT_TOOLS_PROMPT,
+                    tools_getter=lambda x: tools,
+                    input_variables=input_variables,
+                    budget=tool_planner_budget,
+                    stage_aware=prompt_slimming,
+                )
+                llm_chain = LLMChain(
+                    llm=tool_planner_llm,
+                    prompt=prompt,
+                    verbose=verbose,
+                )
+                tool_names = [tool.name for tool in tools]
+                output_parser = SalesConvoOutputParser(
+                    ai_prefix=kwargs.get("salesperson_name", ""),
+                    verbose=verbose,
+                    max_actions=max_actions,
+                )
+                sales_agent_with_tools = LLMSingleActionAgent(
+                    llm_chain=llm_chain,
+                    output_parser=output_parser,
+                    stop=["\nObservation:"] + tool_planner_stop,
+                    allowed_tools=tool_names,
+                )
+
             sales_agent_executor = CustomAgentExecutor.from_agent_and_tools(
                 agent=sales_agent_with_tools,
                 tools=tools,
@@ -391,7 +583,9 @@ class BlackSpaceAI(Chain):
             sales_agent_executor=sales_agent_executor,
             knowledge_base=knowledge_base,
             model_name=llm.model,
+            model_router=router,
             verbose=verbose,
             use_tools=use_tools,
+            prompt_slimming=prompt_slimming,
             **kwargs,
         )
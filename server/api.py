@@ -1,11 +1,23 @@
 import asyncio
+import copy
 import json
-import re
+import sys
 
 from langchain_community.chat_models import ChatLiteLLM
 from langchain_openai import ChatOpenAI
 
 from server.agents import BlackSpaceAI
+from server.deadline import run_within_deadline
+from server.generation import (
+    END_OF_TURN,
+    ControlMarkerFilter,
+    SentenceSegmenter,
+    aclose_stream,
+)
+from server.logger import log_event, log_payload
+from server.memory import Role, intern_config
+from server.metering import BUDGET_DEGRADED_MODEL, BUDGET_DISABLE_TOOLS, meter
+from server.routing import ModelRouter
 
 class BlackSpaceAPI:
     def __init__(
@@ -15,135 +27,199 @@ class BlackSpaceAPI:
         model_name: str = "gpt-3.5-turbo",
         product_catalog: str = "",
         use_tools=True,
-        conversation_history = []
+        conversation_history = [],
+        tenant=None,
+        conversation_stage_id="1",
     ):
         self.config_path = config_path
         self.verbose = verbose
         self.model_name = model_name
-        self.llm = ChatLiteLLM(temperature=0.2, model=model_name)
-        self.product_catalog = product_catalog
+        self.router = ModelRouter.from_config(
+            (config_path or {}).get("model_routing"), default_model=model_name, tenant=tenant
+        )
+        meter.install()
+        # an over-budget tenant still gets answers, from a cheaper setup
+        self.degraded = meter.over_budget(tenant, (config_path or {}).get("token_budget"))
+        if self.degraded:
+            self.router = self.router.degraded(BUDGET_DEGRADED_MODEL)
+            use_tools = use_tools and not BUDGET_DISABLE_TOOLS
+            log_event("budget_degraded", tenant=tenant, tools=use_tools)
+        self.llm = self.router.llm("utterance")
+        self.product_catalog = sys.intern(product_catalog) if product_catalog else product_catalog
         self.conversation_history = conversation_history
         self.use_tools = use_tools
+        self.tenant = tenant
         self.sales_agent = self.initialize_agent()
+        self.sales_agent.restore_stage(conversation_stage_id)
 
     def initialize_agent(self):
         config = {"verbose": self.verbose}
-        config.update(self.config_path)
+        config.update(intern_config(self.config_path))
+        config.pop("model_routing", None)
+        config.pop("token_budget", None)
 
         if self.use_tools:
-            print("USING TOOLS")
             config.update(
                 {
                     "use_tools": True,
                     "product_catalog": self.product_catalog,
+                    "tenant": self.tenant,
                     "salesperson_name": "Sidhant Goswami"
                     if not self.config_path
                     else config.get("salesperson_name", "Sidhant Goswami"),
                 }
             )
 
-        sales_agent = BlackSpaceAI.from_llm(self.llm, **config)
+        sales_agent = BlackSpaceAI.from_llm(self.llm, router=self.router, **config)
 
-        print(f"BlackSpaceAI use_tools: {sales_agent.use_tools}")
+        log_event("agent_initialized", use_tools=sales_agent.use_tools)
         sales_agent.seed_agent(self.conversation_history)
         return sales_agent
 
+    def fork(self, conversation_history, conversation_stage_id=None):
+        """
+        Per-conversation copy that shares this instance's chains and tools.
+
+        Without a stage id, a conversation with history is not slimmed to any
+        stage; one without history starts at stage "1".
+        """
+        forked = copy.copy(self)
+        forked.conversation_history = list(conversation_history)
+        forked.sales_agent = self.sales_agent.copy()
+        forked.sales_agent.seed_agent(forked.conversation_history)
+        if conversation_stage_id is None and not forked.conversation_history:
+            conversation_stage_id = "1"
+        forked.sales_agent.restore_stage(conversation_stage_id)
+        return forked
+
     async def do(self, human_input=None):
 
         if human_input is not None:
             self.sales_agent.human_step(human_input)
 
+        agent = self.sales_agent
+        stage_id = agent.conversation_stage_id if agent.conversation_stage_known else None
         ai_log = await self.sales_agent.astep(stream=False)
         await self.sales_agent.adetermine_conversation_stage()
-        if self.verbose:
-            print("=" * 10)
-            print(f"AI LOG {ai_log}")
-            
-        if (
-            self.sales_agent.conversation_history
-            and "<END_OF_CALL>" in self.sales_agent.conversation_history[-1]
-        ):
-            print("Sales Agent determined it is time to end the conversation.")
-
-            self.sales_agent.conversation_history[
-                -1
-            ] = self.sales_agent.conversation_history[-1].replace("<END_OF_CALL>", "")
-
-        reply = (
+        log_payload("ai_log", ai_log=ai_log)
+        if self.sales_agent.end_of_call:
+            log_event("end_of_call")
+
+        last_turn = (
             self.sales_agent.conversation_history[-1]
             if self.sales_agent.conversation_history
-            else ""
+            else None
         )
-
-        if (
-            self.use_tools and 
-            "intermediate_steps" in ai_log and 
-            len(ai_log["intermediate_steps"]) > 0
-        ):
-            
-            try:
-                res_str = ai_log["intermediate_steps"][0]
-                print("RES STR: ", res_str)
-                agent_action = res_str[0]
-                tool, tool_input, log = (
-                    agent_action.tool,
-                    agent_action.tool_input,
-                    agent_action.log,
-                )
-                actions = re.search(r"Action: (.*?)[\n]*Action Input: (.*)", log)
-                action_input = actions.group(2)
-                action_output =  res_str[1]
-                if tool_input == action_input:
-                    action_input=""
-                    action_output = action_output.replace("<web_search>", "<a href='https://www.google.com/search?q=")
-                    action_output = action_output.replace("</web_search>", "' target='_blank' rel='noopener noreferrer'>")
-            except Exception as e:
-                print("ERROR: ", e)
-                tool, tool_input, action, action_input, action_output = (
-                    "",
-                    "",
-                    "",
-                    "",
-                    "",
-                )
+        reply = last_turn.text if last_turn is not None else ""
+
+        actions = ai_log.get("agent_actions", []) if self.use_tools else []
+        if actions:
+            tool, tool_input = actions[0]["tool"], actions[0]["tool_input"]
+            action_input = ""
+            action_output = str(actions[0]["observation"])
+            action_output = action_output.replace("<web_search>", "<a href='https://www.google.com/search?q=")
+            action_output = action_output.replace("</web_search>", "' target='_blank' rel='noopener noreferrer'>")
         else:
-            tool, tool_input, action, action_input, action_output = "", "", "", "", ""
+            tool, tool_input, action_input, action_output = "", "", "", ""
 
-        print(reply)
+        log_payload("reply", reply=reply)
 
         payload = {
-            "bot_name": reply.split(": ")[0],
-            "response": ": ".join(reply.split(": ")[1:]).rstrip("<END_OF_TURN>"),
+            "bot_name": self.sales_agent.salesperson_name,
+            "response": reply,
             "conversational_stage": self.sales_agent.current_conversation_stage,
+            "conversation_stage_id": stage_id,
+            "next_conversation_stage_id": self.sales_agent.conversation_stage_id,
             "tool": tool,
             "tool_input": tool_input,
             "action_output": action_output,
             "action_input": action_input,
+            "actions": [
+                {"tool": a["tool"], "tool_input": a["tool_input"], "output": str(a["observation"])}
+                for a in actions
+            ],
             "model_name": self.model_name,
-            "reply" : ": ".join(reply.split(": ")[1:])
+            "model_routing": self.router.describe(),
+            "degraded": self.degraded,
+            "reply" : f"{reply} {END_OF_TURN}"
         }
         return payload
 
-    async def do_stream(self, conversation_history: [str], human_input=None):
+    async def do_stream(
+        self, conversation_history: [str] = None, human_input=None, segment=False
+    ):
+        """
+        Stream the agent's reply token by token.
+
+        Pass conversation_history to reseed the agent; long-lived callers such as
+        the WebSocket channel pass None to keep the agent's own history and stage.
+        If the consumer stops early (barge-in, disconnect) the provider stream is
+        closed and the reply is recorded as far as it was generated.
+
+        With segment=True the reply is yielded as {"seq", "text"} sentence or
+        clause chunks ready for speech instead of raw tokens.
+        """
+        tokens = self._stream_tokens(conversation_history, human_input)
+        try:
+            if not segment:
+                async for message in tokens:
+                    yield message
+                return
+
+            segmenter = SentenceSegmenter()
+            async for message in tokens:
+                if isinstance(message, list):
+                    for chunk in segmenter.flush():
+                        yield chunk
+                    yield message
+                    continue
+                for chunk in segmenter.feed(message):
+                    yield chunk
+            for chunk in segmenter.flush():
+                yield chunk
+        finally:
+            await tokens.aclose()
 
-        self.sales_agent.seed_agent(conversation_history)
+    async def _stream_tokens(self, conversation_history: [str] = None, human_input=None):
+        if conversation_history is not None:
+            self.sales_agent.seed_agent(conversation_history)
 
         if human_input is not None:
             self.sales_agent.human_step(human_input)
 
-        stream_gen = self.sales_agent.astep(stream=True)
-        for model_response in stream_gen:
-            for choice in model_response.choices:
-                message = choice["delta"]["content"]
-                if message is not None:
-                    if "<END_OF_CALL>" in message:
-                        print(
-                            "Sales Agent determined it is time to end the conversation."
-                        )
-                        yield [
-                            "BOT",
-                            "In case you'll have any questions - just text me one more time!",
-                        ]
-                    yield message
-                else:
-                    continue
+        # only the wait for the first token is bounded; the client is reading after that
+        stream = await run_within_deadline(
+            "utterance_stream", self.sales_agent.astep(stream=True)
+        )
+        markers = ControlMarkerFilter()
+        reply = ""
+        completed = False
+        try:
+            async for model_response in stream:
+                for choice in model_response.choices:
+                    message = choice["delta"]["content"]
+                    if message is None:
+                        continue
+                    message = markers.feed(message)
+                    if message:
+                        reply += message
+                        yield message
+                if markers.done:
+                    break
+            message = markers.flush()
+            if message:
+                reply += message
+                yield message
+            completed = True
+        finally:
+            if markers.done or not completed:
+                await aclose_stream(stream)
+            self.sales_agent.conversation_history.append(Role.AI, reply.strip())
+            self.sales_agent.end_of_call = markers.end_of_call
+
+        if markers.end_of_call:
+            log_event("end_of_call")
+            yield [
+                "BOT",
+                "In case you'll have any questions - just text me one more time!",
+            ]
@@ -0,0 +1,218 @@
+import asyncio
+import hashlib
+import json
+import os
+from typing import Any, AsyncIterator, Dict, Iterable, List, Set
+
+from server.api import BlackSpaceAPI
+from server.generation import strip_control_markers
+from server.metering import meter
+
+
+def tenant_key(config: Dict[str, Any], product_catalog: str) -> str:
+    """Rows with the same config and catalog share one agent."""
+    payload = json.dumps(config or {}, sort_keys=True) + "\0" + (product_catalog or "")
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def read_rows(path: str) -> List[Dict[str, Any]]:
+    """Read a JSONL batch; rows without an `id` are numbered by line."""
+    rows = []
+    with open(path) as f:
+        for index, line in enumerate(f):
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            row.setdefault("id", index)
+            rows.append(row)
+    return rows
+
+
+def completed_ids(output_path: str) -> Set[Any]:
+    """Row ids already written to an output file, used to resume a run."""
+    if not os.path.exists(output_path):
+        return set()
+    done = set()
+    with open(output_path) as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                # a partially written last line from an interrupted run
+                continue
+            if "error" not in result:
+                done.add(result.get("id"))
+    return done
+
+
+class BatchRunner:
+    """
+    Run many (config, conversation_history, human_input) rows offline.
+
+    One BlackSpaceAPI is built per tenant (config + catalog) and forked per
+    row, so chains, tools and embeddings are built once. Rows run with
+    bounded concurrency. With provider_batch_size > 0, rows of tenants that do
+    not use tools are grouped and sent through litellm.batch_completion.
+    """
+
+    def __init__(
+        self,
+        model_name: str = "gpt-3.5-turbo-0613",
+        use_tools: bool = True,
+        concurrency: int = 8,
+        provider_batch_size: int = 0,
+        analyze_stage: bool = True,
+        tenant: Any = None,
+    ):
+        self.model_name = model_name
+        # user the batch's token usage is metered and budgeted against
+        self.tenant = tenant
+        self.use_tools = use_tools
+        self.concurrency = concurrency
+        self.provider_batch_size = provider_batch_size
+        self.analyze_stage = analyze_stage
+        self._agents: Dict[str, BlackSpaceAPI] = {}
+        self._agent_locks: Dict[str, asyncio.Lock] = {}
+
+    async def agent_for(self, row: Dict[str, Any]) -> BlackSpaceAPI:
+        config = row.get("config") or {}
+        product_catalog = row.get("product_catalog", "")
+        key = tenant_key(config, product_catalog)
+        loop = asyncio.get_running_loop()
+        # a tenant crossing its budget mid-batch gets a degraded agent for the remaining rows;
+        # the first check in a window loads the stored usage synchronously
+        if await loop.run_in_executor(
+            None, meter.over_budget, self.tenant, config.get("token_budget")
+        ):
+            key += ":degraded"
+        lock = self._agent_locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            if key not in self._agents:
+                # building tools embeds the catalog synchronously
+                self._agents[key] = await loop.run_in_executor(
+                    None,
+                    lambda: BlackSpaceAPI(
+                        config_path=config,
+                        verbose=False,
+                        product_catalog=product_catalog,
+                        model_name=self.model_name,
+                        use_tools=self.use_tools,
+                        conversation_history=[],
+                        tenant=self.tenant,
+                    ),
+                )
+        return self._agents[key]
+
+    async def run_row(self, row: Dict[str, Any]) -> Dict[str, Any]:
+        try:
+            template = await self.agent_for(row)
+            sales_api = template.fork(
+                row.get("conversation_history") or [], row.get("conversation_stage_id")
+            )
+            if self.analyze_stage:
+                result = await sales_api.do(row.get("human_input"))
+            else:
+                if row.get("human_input") is not None:
+                    sales_api.sales_agent.human_step(row["human_input"])
+                await sales_api.sales_agent.astep(stream=False)
+                result = {"response": sales_api.sales_agent.conversation_history[-1].text}
+            return {"id": row["id"], **result}
+        except Exception as e:
+            return {"id": row["id"], "error": str(e)}
+
+    async def run_provider_batch(self, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Generate replies for rows of one tools-free tenant in a single batch call."""
+        import litellm
+
+        template = await self.agent_for(rows[0])
+        messages, forks = [], []
+        for row in rows:
+            sales_api = template.fork(
+                row.get("conversation_history") or [], row.get("conversation_stage_id")
+            )
+            if row.get("human_input") is not None:
+                sales_api.sales_agent.human_step(row["human_input"])
+            messages.append(sales_api.sales_agent._prep_messages())
+            forks.append(sales_api)
+
+        params = template.sales_agent._utterance_generation_params()
+        try:
+            responses = await asyncio.get_running_loop().run_in_executor(
+                None, lambda: litellm.batch_completion(messages=messages, **params)
+            )
+        except Exception as e:
+            return [{"id": row["id"], "error": str(e)} for row in rows]
+
+        results = []
+        for row, sales_api, response in zip(rows, forks, responses):
+            if isinstance(response, Exception):
+                results.append({"id": row["id"], "error": str(response)})
+                continue
+            reply = response.choices[0].message.content or ""
+            results.append(
+                {
+                    "id": row["id"],
+                    "response": strip_control_markers(reply)[0],
+                    "conversational_stage": sales_api.sales_agent.current_conversation_stage,
+                    "model_name": params["model"],
+                }
+            )
+        return results
+
+    async def run(self, rows: Iterable[Dict[str, Any]]) -> AsyncIterator[Dict[str, Any]]:
+        """Yield one result per row as rows complete (not in input order)."""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        rows = list(rows)
+
+        single_rows, groups = rows, []
+        if self.provider_batch_size > 0 and not self.use_tools:
+            by_tenant: Dict[str, List[Dict[str, Any]]] = {}
+            for row in rows:
+                by_tenant.setdefault(
+                    tenant_key(row.get("config"), row.get("product_catalog", "")), []
+                ).append(row)
+            single_rows = []
+            for tenant_rows in by_tenant.values():
+                for i in range(0, len(tenant_rows), self.provider_batch_size):
+                    groups.append(tenant_rows[i : i + self.provider_batch_size])
+
+        async def run_single(row):
+            async with semaphore:
+                return [await self.run_row(row)]
+
+        async def run_group(group):
+            async with semaphore:
+                return await self.run_provider_batch(group)
+
+        tasks = [asyncio.create_task(run_single(row)) for row in single_rows]
+        tasks += [asyncio.create_task(run_group(group)) for group in groups]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                for result in await next_done:
+                    yield result
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+async def run_batch_file(
+    input_path: str, output_path: str, runner: BatchRunner, resume: bool = True
+) -> int:
+    """
+    Run a JSONL batch into a JSONL output file and return the rows processed.
+
+    The output doubles as the checkpoint: every result is flushed as it
+    completes, and a resumed run skips rows that already succeeded.
+    """
+    rows = read_rows(input_path)
+    if resume:
+        done = completed_ids(output_path)
+        rows = [row for row in rows if row["id"] not in done]
+
+    processed = 0
+    with open(output_path, "a" if resume else "w") as out:
+        async for result in runner.run(rows):
+            out.write(json.dumps(result, default=str) + "\n")
+            out.flush()
+            processed += 1
+    return processed
@@ -0,0 +1,218 @@
+import os
+import string
+from collections import Counter
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+from server.memory import END_OF_TURN, Role, TurnStore, count_tokens, truncate_tokens
+from server.metrics import add_to_turn, metrics
+from server import prompts
+
+# Tokens kept free on top of the reply's max_tokens, for chat message framing
+# and small differences between tiktoken and the provider's tokenizer
+BUDGET_SAFETY_TOKENS = int(os.getenv("BUDGET_SAFETY_TOKENS", "64"))
+# Turns that are never dropped, only shortened
+MIN_HISTORY_TURNS = int(os.getenv("MIN_HISTORY_TURNS", "2"))
+# Longest tool observation kept in a prompt
+OBSERVATION_TOKEN_LIMIT = int(os.getenv("OBSERVATION_TOKEN_LIMIT", "1000"))
+# Used when neither litellm nor the table below knows the model
+DEFAULT_CONTEXT_WINDOW = 4096
+
+CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo-0613": 4096,
+    "gpt-3.5-turbo-16k": 16385,
+    "gpt-3.5-turbo": 16385,
+    "gpt-3.5-turbo-0125": 16385,
+    "gpt-4": 8192,
+    "gpt-4-0613": 8192,
+    "gpt-4-0125-preview": 128000,
+    "gpt-4-turbo": 128000,
+}
+# Allowance for the " [truncated]" mark added to a shortened turn
+TRUNCATION_MARK_TOKENS = 4
+# Per-turn fields that would only pollute the token count cache
+UNCACHED_FIELDS = {"agent_scratchpad", "input"}
+
+
+class PromptBudgetExceeded(ValueError):
+    """The prompt cannot be made to fit even after trimming every section."""
+
+
+@lru_cache(maxsize=4096)
+def cached_tokens(text: str) -> int:
+    """Token count of strings that repeat across turns (config values, tool lists)."""
+    return count_tokens(text)
+
+
+@lru_cache(maxsize=64)
+def template_fields(template: str) -> Tuple[Tuple[str, int], ...]:
+    """Placeholders of a template with how often each appears."""
+    fields = Counter(
+        name for _, name, _, _ in string.Formatter().parse(template) if name
+    )
+    return tuple(sorted(fields.items()))
+
+
+@lru_cache(maxsize=64)
+def template_tokens(template: str) -> int:
+    """Tokens of a template's static text, i.e. everything but the placeholders."""
+    static = "".join(literal for literal, _, _, _ in string.Formatter().parse(template))
+    return count_tokens(static)
+
+
+@lru_cache(maxsize=64)
+def context_window(model: str) -> int:
+    try:
+        import litellm
+
+        info = litellm.model_cost.get(model, {})
+        window = info.get("max_input_tokens") or info.get("max_tokens")
+        if window:
+            return int(window)
+    except Exception:
+        pass
+    return CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT_WINDOW)
+
+
+@lru_cache(maxsize=64)
+def _turn_overhead(ai_name: str) -> Tuple[int, int]:
+    """Tokens render() adds around a user and an AI turn, newline included."""
+    suffix = count_tokens(f" {END_OF_TURN}\n")
+    return count_tokens("User: ") + suffix, count_tokens(f"{ai_name}: ") + suffix
+
+
+# Static parts of the shipped templates are counted once, at import
+for _template in (
+    prompts.SALES_AGENT_TOOLS_PROMPT,
+    prompts.SALES_AGENT_STRUCTURED_TOOLS_PROMPT,
+    prompts.SALES_AGENT_INCEPTION_PROMPT,
+    prompts.STAGE_ANALYZER_INCEPTION_PROMPT,
+):
+    template_tokens(_template)
+    template_fields(_template)
+
+
+class PromptBudget:
+    """
+    Fits a prompt into the model's context window before it is sent.
+
+    The prompt size is computed from the template's precomputed static count,
+    the cached counts of the other fields and the per-turn counts the
+    TurnStore keeps, so nothing is re-tokenized per turn. When the prompt is
+    too large, sections are trimmed in a fixed order:
+
+    1. the oldest history turns, down to MIN_HISTORY_TURNS
+    2. the longest remaining turns are truncated (e.g. an uploaded PDF)
+    3. the remaining older turns, down to the last one
+
+    If it still does not fit, PromptBudgetExceeded is raised instead of
+    spending a round trip on a context-length error.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        max_output_tokens: Optional[int] = None,
+        role: str = "",
+        min_history_turns: int = MIN_HISTORY_TURNS,
+    ):
+        self.model = model
+        self.role = role
+        self.min_history_turns = min_history_turns
+        self.limit = (
+            context_window(model) - (max_output_tokens or 256) - BUDGET_SAFETY_TOKENS
+        )
+
+    def fit(
+        self,
+        template: str,
+        values: Dict[str, str],
+        history: TurnStore,
+        ai_name: str,
+        reserved_tokens: int = 0,
+    ) -> Tuple[str, Dict[str, int]]:
+        """
+        Render `history` so that `template` formatted with `values` fits.
+
+        `values` holds every other field of the template; `reserved_tokens`
+        covers prompt content sent outside the template (tool messages).
+        Returns the rendered history and the per-section token usage.
+        """
+        usage = {"template": template_tokens(template)}
+        for name, occurrences in template_fields(template):
+            if name == "conversation_history" or name not in values:
+                continue
+            counter = count_tokens if name in UNCACHED_FIELDS else cached_tokens
+            usage[name] = counter(str(values[name])) * occurrences
+        if reserved_tokens:
+            usage["tool_messages"] = reserved_tokens
+
+        history_fields = dict(template_fields(template)).get("conversation_history", 0)
+        available = (self.limit - sum(usage.values())) // max(history_fields, 1)
+
+        texts, roles, tokens, trimmed = self._fit_history(history, ai_name, available)
+        usage["conversation_history"] = (
+            sum(tokens) + self._overhead(roles, ai_name)
+        ) * history_fields
+        self._record(usage, trimmed)
+
+        if sum(usage.values()) > self.limit:
+            raise PromptBudgetExceeded(
+                f"Prompt needs {sum(usage.values())} tokens, {self.model} allows "
+                f"{self.limit} with the reply reserved"
+            )
+
+        speakers = ("User", ai_name)
+        rendered = "\n".join(
+            f"{speakers[role]}: {text} {END_OF_TURN}" for role, text in zip(roles, texts)
+        )
+        return rendered, usage
+
+    @staticmethod
+    def _overhead(roles: List[int], ai_name: str) -> int:
+        user_overhead, ai_overhead = _turn_overhead(ai_name)
+        return sum(ai_overhead if role == Role.AI else user_overhead for role in roles)
+
+    def _fit_history(
+        self, history: TurnStore, ai_name: str, available: int
+    ) -> Tuple[List[str], List[int], List[int], bool]:
+        texts = list(history.texts)
+        roles = list(history.roles)
+        tokens = list(history.tokens)
+
+        def size() -> int:
+            return sum(tokens) + self._overhead(roles, ai_name)
+
+        if size() <= available:
+            return texts, roles, tokens, False
+
+        # 1. oldest turns first
+        while size() > available and len(texts) > self.min_history_turns:
+            del texts[0], roles[0], tokens[0]
+
+        # 2. shorten the longest turns, ties broken by position
+        while size() > available and texts:
+            longest = max(range(len(tokens)), key=lambda i: (tokens[i], -i))
+            excess = size() - available
+            target = max(tokens[longest] - excess, tokens[longest] // 2, 0)
+            if target >= tokens[longest] or tokens[longest] <= 32:
+                break
+            text = truncate_tokens(texts[longest], target - TRUNCATION_MARK_TOKENS)
+            shortened = count_tokens(text)
+            if shortened >= tokens[longest]:
+                break
+            texts[longest], tokens[longest] = text, shortened
+
+        # 3. everything but the newest turn
+        while size() > available and len(texts) > 1:
+            del texts[0], roles[0], tokens[0]
+
+        return texts, roles, tokens, True
+
+    def _record(self, usage: Dict[str, int], trimmed: bool) -> None:
+        for section, section_tokens in usage.items():
+            metrics.observe("prompt_tokens", section_tokens, role=self.role, section=section)
+        metrics.observe("prompt_tokens_total", sum(usage.values()), role=self.role)
+        add_to_turn("prompt_tokens", sum(usage.values()))
+        if trimmed:
+            metrics.inc("prompt_trimmed", role=self.role)
@@ -0,0 +1,99 @@
+import asyncio
+import hashlib
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+
+def turn_key(chat_id: str, session_id, human_input: str, idempotency_key: str = None) -> Optional[str]:
+    """
+    Build the coalescing key for a chat turn.
+
+    An explicit idempotency key always wins. Without one, a turn can only be
+    coalesced when it targets an existing session, since a missing session_id
+    means every request creates a new session, and only while it is running:
+    a user may well say the same words again as a new turn.
+    """
+    if idempotency_key:
+        return f"{chat_id}:idem:{idempotency_key}"
+    if session_id is None:
+        return None
+    digest = hashlib.sha256(human_input.encode("utf-8")).hexdigest()
+    return f"{chat_id}:{session_id}:{digest}"
+
+
+class SingleFlight:
+    """
+    Run at most one coroutine per key at a time.
+
+    Concurrent callers with the same key await the in-flight result instead of
+    starting their own. Completed results are kept for `ttl` seconds (or the
+    call's own ttl) so late client retries get the same answer too. Failures
+    are never cached.
+    """
+
+    def __init__(self, ttl: float = 30.0, max_entries: int = 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._done: Dict[str, Tuple[float, Any]] = {}
+
+    def _cached(self, key: str):
+        entry = self._done.get(key)
+        if entry is None:
+            return None
+        expires_at, result = entry
+        if expires_at < time.monotonic():
+            del self._done[key]
+            return None
+        return entry
+
+    def _remember(self, key: str, result: Any, ttl: float):
+        if ttl <= 0:
+            return
+        now = time.monotonic()
+        if len(self._done) >= self.max_entries:
+            for stale in [k for k, (exp, _) in self._done.items() if exp < now]:
+                del self._done[stale]
+            while len(self._done) >= self.max_entries:
+                del self._done[next(iter(self._done))]
+        self._done[key] = (now + ttl, result)
+
+    async def do(
+        self, key: Optional[str], func: Callable[[], Awaitable[Any]], ttl: Optional[float] = None
+    ) -> Any:
+        if key is None:
+            return await func()
+
+        cached = self._cached(key)
+        if cached is not None:
+            return cached[1]
+
+        inflight = self._inflight.get(key)
+        while inflight is not None:
+            try:
+                # shield so a disconnecting duplicate does not cancel the leader
+                return await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                if not inflight.cancelled():
+                    raise
+                # the leader's client went away; this caller is still waiting
+                inflight = self._inflight.get(key)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # mark retrieved so an unawaited failure is not logged
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            self._remember(key, result, self.ttl if ttl is None else ttl)
+            return result
+        finally:
+            self._inflight.pop(key, None)
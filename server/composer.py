@@ -0,0 +1,82 @@
+import os
+import re
+from functools import lru_cache
+from typing import Iterable, List, Optional, Sequence
+
+from langchain.prompts import PromptTemplate
+
+from server.stages import (
+    CONVERSATION_STAGES,
+    DEFAULT_TOOL_STAGES,
+    EXAMPLE_STAGES,
+    STAGE_SUCCESSORS,
+    TOOL_STAGES,
+)
+
+# Build prompts with only the stages the conversation can move to next
+PROMPT_SLIMMING = os.getenv("PROMPT_SLIMMING", "True").lower() in ["true", "1", "t"]
+
+STAGE_LINE = re.compile(r"^(\d+): ")
+EXAMPLE_START = "Example 1:"
+EXAMPLE_END = "End of example 1."
+
+
+def stages_for(stage_id: Optional[str]) -> Optional[Sequence[str]]:
+    """The current stage and its plausible successors; None when unknown."""
+    if stage_id not in CONVERSATION_STAGES:
+        return None
+    return STAGE_SUCCESSORS.get(stage_id, tuple(CONVERSATION_STAGES))
+
+
+@lru_cache(maxsize=128)
+def compose_template(template: str, stage_id: Optional[str]) -> str:
+    """
+    Slim a full prompt template down to what the current stage needs.
+
+    Stage description lines ("N: ...") outside the current stage and its
+    successors are dropped, and the worked example is kept only for the
+    stages in EXAMPLE_STAGES. Everything else is left as written, so an
+    unknown stage id gives back the full template.
+    """
+    keep = stages_for(stage_id)
+    if keep is None:
+        return template
+
+    lines: List[str] = []
+    in_example = after_example = False
+    for line in template.split("\n"):
+        if line.startswith(EXAMPLE_START) and stage_id not in EXAMPLE_STAGES:
+            in_example = True
+        if in_example:
+            if line.startswith(EXAMPLE_END):
+                in_example, after_example = False, True
+            continue
+        if after_example:
+            after_example = False
+            # the example's trailing blank line
+            if not line:
+                continue
+        match = STAGE_LINE.match(line)
+        if match and match.group(1) not in keep:
+            continue
+        lines.append(line)
+    return "\n".join(lines)
+
+
+@lru_cache(maxsize=128)
+def compose_prompt(template: str, input_variables: tuple, stage_id: Optional[str]) -> PromptTemplate:
+    return PromptTemplate(
+        template=compose_template(template, stage_id),
+        input_variables=list(input_variables),
+    )
+
+
+def tool_allowed(tool_name: str, stage_id: Optional[str]) -> bool:
+    if stage_id not in CONVERSATION_STAGES:
+        return True
+    return stage_id in TOOL_STAGES.get(tool_name, DEFAULT_TOOL_STAGES)
+
+
+def tools_for_stage(tools: Iterable, stage_id: Optional[str]) -> list:
+    """Tools offered at this stage; ProductSearch is useless before value proposition."""
+    return [tool for tool in tools if tool_allowed(tool.name, stage_id)]
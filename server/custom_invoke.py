@@ -9,7 +9,15 @@ from langchain_core.load.dump import dumpd
 from langchain_core.outputs import RunInfo
 from langchain_core.runnables import RunnableConfig, ensure_config
 
+from server.deadline import check
+from server.parsers import agent_actions
+
 class CustomAgentExecutor(AgentExecutor):
+    def _should_continue(self, iterations: int, time_elapsed: float) -> bool:
+        # runs before every plan/tool round, so an expired request stops here
+        check("agent_iteration")
+        return super()._should_continue(iterations, time_elapsed)
+
     def invoke(
         self,
         input: Dict[str, Any],
@@ -39,7 +47,8 @@ class CustomAgentExecutor(AgentExecutor):
 
         new_arg_supported = inspect.signature(self._call).parameters.get("run_manager")
         run_manager = callback_manager.on_chain_start(
-            dumpd(self),
+            # serializing the whole executor is only worth it when a handler reads it
+            dumpd(self) if callback_manager.handlers else {},
             inputs,
             name=run_name,
         )
@@ -70,6 +79,9 @@ class CustomAgentExecutor(AgentExecutor):
         if include_run_info:
             final_outputs["run_info"] = RunInfo(run_id=run_manager.run_id)
 
+        final_outputs["agent_actions"] = agent_actions(
+            final_outputs.get("intermediate_steps", [])
+        )
         final_outputs["intermediate_steps"] = intermediate_steps
 
         return final_outputs
@@ -0,0 +1,155 @@
+import asyncio
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Optional
+
+from server.logger import log_event
+from server.metrics import metrics
+
+# Seconds a chat turn may take; also the cap on a client's X-Request-Timeout header
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", "30"))
+# A step is not started with less time than this left; it could not finish anyway
+MIN_STEP_SECONDS = float(os.getenv("MIN_STEP_SECONDS", "0.5"))
+# Chat turns in flight per process before new ones are refused with 503; 0 disables
+MAX_INFLIGHT_TURNS = int(os.getenv("MAX_INFLIGHT_TURNS", "64"))
+DISCONNECT_POLL_INTERVAL = float(os.getenv("DISCONNECT_POLL_INTERVAL", "0.25"))
+
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar(
+    "deadline", default=None
+)
+
+
+class DeadlineExceeded(Exception):
+    """The request ran out of time before `step` could run."""
+
+    def __init__(self, step: str):
+        super().__init__(f"Request deadline exceeded before {step}")
+        self.step = step
+
+
+class Overloaded(Exception):
+    """Too many turns are in flight to start another one."""
+
+
+def start_deadline(seconds: Optional[float]) -> None:
+    """Give the current request (and every task it spawns) `seconds` to finish."""
+    _deadline.set(time.monotonic() + seconds if seconds else None)
+
+
+def parse_timeout(header: Optional[str], default: float = REQUEST_DEADLINE) -> float:
+    """Seconds from an X-Request-Timeout header, falling back to `default`."""
+    try:
+        seconds = float(header) if header else default
+    except ValueError:
+        return default
+    return min(seconds, default) if seconds > 0 else default
+
+
+def remaining() -> Optional[float]:
+    """Seconds left before the deadline, or None when there is no deadline."""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def check(step: str) -> None:
+    """Raise DeadlineExceeded if there is too little time left to start `step`."""
+    left = remaining()
+    if left is not None and left < MIN_STEP_SECONDS:
+        metrics.inc("deadline_exceeded", step=step)
+        log_event("deadline_exceeded", step=step, remaining=round(left, 3))
+        raise DeadlineExceeded(step)
+
+
+def bounded(timeout: float) -> float:
+    """`timeout`, shortened to the time left before the deadline."""
+    left = remaining()
+    return timeout if left is None else max(0.0, min(timeout, left))
+
+
+async def run_within_deadline(step: str, awaitable: Awaitable[Any]) -> Any:
+    """Await `awaitable`, cancelling it and raising DeadlineExceeded at the deadline."""
+    check(step)
+    left = remaining()
+    if left is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, left)
+    except asyncio.TimeoutError:
+        metrics.inc("deadline_exceeded", step=step)
+        log_event("deadline_exceeded", step=step, remaining=0)
+        raise DeadlineExceeded(step) from None
+
+
+async def cancel_on_disconnect(
+    is_disconnected: Callable[[], Awaitable[bool]], awaitable: Awaitable[Any]
+) -> Any:
+    """
+    Await `awaitable` and cancel it if the client goes away first.
+
+    `is_disconnected` is polled, e.g. a Starlette Request.is_disconnected,
+    because the request body has already been consumed by then.
+    """
+    work = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({work}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return work.result()
+            if await is_disconnected():
+                metrics.inc("client_disconnected")
+                log_event("client_disconnected")
+                work.cancel()
+                raise asyncio.CancelledError()
+    finally:
+        if not work.done():
+            work.cancel()
+
+
+class Admission:
+    """
+    Caps the chat turns a process works on at once.
+
+    Turns over the cap are refused immediately instead of queueing behind the
+    ones already running, where they would likely outlive their client.
+    """
+
+    def __init__(self, limit: int = MAX_INFLIGHT_TURNS):
+        self.limit = limit
+        self.inflight = 0
+
+    def acquire(self) -> None:
+        if self.limit and self.inflight >= self.limit:
+            metrics.inc("requests_shed")
+            raise Overloaded(f"{self.inflight} turns in flight")
+        self.inflight += 1
+
+    def release(self) -> None:
+        self.inflight -= 1
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def lease(self) -> Callable[[], None]:
+        """
+        Acquire a slot for work that outlives the handler, e.g. a streamed body.
+
+        Returns the release function; it may be called from several cleanup
+        paths and only the first call frees the slot.
+        """
+        self.acquire()
+        released = False
+
+        def release() -> None:
+            nonlocal released
+            if not released:
+                released = True
+                self.release()
+
+        return release
@@ -0,0 +1,229 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from server.metrics import metrics
+
+# SQLite file shared by every tenant and process; empty disables the cache
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", ".cache/embeddings.sqlite3")
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "200000"))
+# Hits refresh last_used at most this often per row, buffered and written in one transaction
+EMBEDDING_CACHE_TOUCH_SECONDS = float(os.getenv("EMBEDDING_CACHE_TOUCH_SECONDS", "300"))
+# Seconds between recounting the table; in between inserts are added to the last count
+EMBEDDING_CACHE_COUNT_SECONDS = float(os.getenv("EMBEDDING_CACHE_COUNT_SECONDS", "60"))
+
+# SQLite's default limit on bound parameters is 999
+_LOOKUP_BATCH = 500
+# Buffered last_used refreshes that force a write even before the interval
+_TOUCH_BATCH = 1000
+
+
+class EmbeddingCache:
+    """
+    Persistent map from hash(model, text) to an embedding vector.
+
+    Vectors are stored as float32 blobs. Lookups and inserts are batched, and
+    once the table grows past `max_entries` the least recently used tenth is
+    evicted.
+
+    Reads stay off SQLite's write lock: a hit only refreshes last_used when
+    the stored value is older than `touch_seconds`, and those refreshes are
+    buffered and written together with the next insert or once the buffer is
+    old or large. The row count is kept in memory and recounted every
+    `count_seconds`, since other processes insert too, so recency and size
+    are approximate by those intervals.
+    """
+
+    def __init__(
+        self,
+        path: str = EMBEDDING_CACHE_PATH,
+        max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES,
+        touch_seconds: float = EMBEDDING_CACHE_TOUCH_SECONDS,
+        count_seconds: float = EMBEDDING_CACHE_COUNT_SECONDS,
+    ):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_entries = max_entries
+        self.touch_seconds = touch_seconds
+        self.count_seconds = count_seconds
+        self._lock = threading.Lock()
+        self._touched: Dict[bytes, float] = {}
+        self._touched_since = time.monotonic()
+        self._count: Optional[int] = None
+        self._counted_at = 0.0
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key BLOB PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings(last_used)")
+
+    @staticmethod
+    def key(model: str, text: str) -> bytes:
+        return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).digest()
+
+    def get_many(self, keys: Sequence[bytes]) -> Dict[bytes, List[float]]:
+        found: Dict[bytes, List[float]] = {}
+        unique = list(dict.fromkeys(keys))
+        now = time.time()
+        with self._lock:
+            for start in range(0, len(unique), _LOOKUP_BATCH):
+                batch = unique[start : start + _LOOKUP_BATCH]
+                rows = self._db.execute(
+                    "SELECT key, vector, last_used FROM embeddings "
+                    f"WHERE key IN ({','.join('?' * len(batch))})",
+                    batch,
+                ).fetchall()
+                for key, vector, last_used in rows:
+                    found[key] = np.frombuffer(vector, dtype=np.float32).tolist()
+                    if now - last_used >= self.touch_seconds:
+                        self._touched[key] = now
+            if self._touched and (
+                len(self._touched) >= _TOUCH_BATCH
+                or time.monotonic() - self._touched_since >= self.touch_seconds
+            ):
+                self._db.execute("BEGIN")
+                self._flush_touched()
+                self._db.execute("COMMIT")
+        return found
+
+    def _flush_touched(self) -> None:
+        # Caller holds the lock inside a transaction
+        if self._touched:
+            self._db.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                [(last_used, key) for key, last_used in self._touched.items()],
+            )
+            self._touched = {}
+        self._touched_since = time.monotonic()
+
+    def put_many(self, items: Dict[bytes, Sequence[float]]) -> None:
+        if not items:
+            return
+        now = time.time()
+        rows = [
+            (key, np.asarray(vector, dtype=np.float32).tobytes(), now)
+            for key, vector in items.items()
+        ]
+        with self._lock:
+            self._db.execute("BEGIN")
+            self._db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                rows,
+            )
+            for key, _, _ in rows:
+                self._touched.pop(key, None)
+            self._flush_touched()
+            self._db.execute("COMMIT")
+            if self._count is not None:
+                # Replaced rows are counted again; the recount corrects it
+                self._count += len(rows)
+            self._evict()
+
+    def _evict(self) -> None:
+        stale = time.monotonic() - self._counted_at >= self.count_seconds
+        if self._count is not None and self._count <= self.max_entries and not stale:
+            return
+        (self._count,) = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        self._counted_at = time.monotonic()
+        if self._count <= self.max_entries:
+            return
+        excess = self._count - int(self.max_entries * 0.9)
+        self._db.execute(
+            "DELETE FROM embeddings WHERE key IN "
+            "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+            (excess,),
+        )
+        self._count -= excess
+        metrics.inc("embedding_cache_evictions", excess)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that only sends cache misses to the wrapped model.
+
+    Used for catalog chunks and for queries, so shared boilerplate chunks,
+    rebuilt catalogs and repeated prospect questions are embedded once.
+    """
+
+    def __init__(self, embeddings: Any, cache: EmbeddingCache, model: Optional[str] = None):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model = model or getattr(embeddings, "model", type(embeddings).__name__)
+
+    def _lookup(self, texts: List[str], kind: str):
+        keys = [EmbeddingCache.key(self.model, text) for text in texts]
+        found = self.cache.get_many(keys)
+        missing = list(dict.fromkeys(text for text, key in zip(texts, keys) if key not in found))
+        hits = len(texts) - sum(1 for key in keys if key not in found)
+        metrics.inc("embedding_cache_hits", hits, kind=kind)
+        metrics.inc("embedding_cache_misses", len(texts) - hits, kind=kind)
+        return keys, found, missing
+
+    def _complete(self, keys, found, missing, vectors) -> List[List[float]]:
+        new = {EmbeddingCache.key(self.model, text): list(vector) for text, vector in zip(missing, vectors)}
+        self.cache.put_many(new)
+        found.update(new)
+        return [found[key] for key in keys]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, found, missing = self._lookup(texts, "document")
+        vectors = self.embeddings.embed_documents(missing) if missing else []
+        return self._complete(keys, found, missing, vectors)
+
+    def embed_query(self, text: str) -> List[float]:
+        keys, found, missing = self._lookup([text], "query")
+        vectors = [self.embeddings.embed_query(text)] if missing else []
+        return self._complete(keys, found, missing, vectors)[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        loop = asyncio.get_running_loop()
+        keys, found, missing = await loop.run_in_executor(None, self._lookup, texts, "document")
+        vectors = await self.embeddings.aembed_documents(missing) if missing else []
+        return await loop.run_in_executor(None, self._complete, keys, found, missing, vectors)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        loop = asyncio.get_running_loop()
+        keys, found, missing = await loop.run_in_executor(None, self._lookup, [text], "query")
+        vectors = [await self.embeddings.aembed_query(text)] if missing else []
+        result = await loop.run_in_executor(None, self._complete, keys, found, missing, vectors)
+        return result[0]
+
+
+_cache: Optional[EmbeddingCache] = None
+_cache_lock = threading.Lock()
+
+
+def cached_embeddings(embeddings: Any) -> Any:
+    """Wrap `embeddings` with the process-wide cache, unless it is disabled."""
+    global _cache
+    if not EMBEDDING_CACHE_PATH:
+        return embeddings
+    with _cache_lock:
+        if _cache is None:
+            _cache = EmbeddingCache()
+    return CachedEmbeddings(embeddings, _cache)
+
+
+def hit_rate() -> Dict[str, float]:
+    """Share of lookups answered from the cache, per kind."""
+    rates = {}
+    for kind in ("document", "query"):
+        hits = metrics.counter("embedding_cache_hits", kind=kind)
+        misses = metrics.counter("embedding_cache_misses", kind=kind)
+        if hits + misses:
+            rates[kind] = hits / (hits + misses)
+    return rates
@@ -0,0 +1,221 @@
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from server.logger import log_event
+from server.memory import Role, parse_turn
+from server.reads import encode_cursor, paginate
+
+EXPORT_DIR = os.getenv("EXPORT_DIR", "exports")
+# Rows fetched, converted and written per step; bounds the exporter's memory
+EXPORT_BATCH_ROWS = int(os.getenv("EXPORT_BATCH_ROWS", "5000"))
+# Rows younger than this are left for the next run, so late commits are not skipped
+EXPORT_LAG_SECONDS = float(os.getenv("EXPORT_LAG_SECONDS", "120"))
+
+# Stage, tool, latency and token fields are stored with AI turns in conversations.metadata
+# (jsonb); enable once the column exists
+STORE_TURN_METADATA = os.getenv("STORE_TURN_METADATA", "False").lower() in ["true", "1", "t"]
+
+
+def turn_metadata(
+    response: Dict[str, Any], latency: float, usage: Optional[Dict[str, float]] = None
+) -> Dict[str, Any]:
+    """Metadata stored with an AI turn, from a BlackSpaceAPI.do payload."""
+    usage = usage or {}
+    return {
+        "stage_id": response.get("conversation_stage_id"),
+        "next_stage_id": response.get("next_conversation_stage_id"),
+        "tool": response.get("tool") or None,
+        "tool_input": response.get("tool_input") or None,
+        "actions": [
+            {"tool": action["tool"], "tool_input": action["tool_input"]}
+            for action in response.get("actions", [])
+        ],
+        "latency_ms": round(latency * 1000),
+        "prompt_tokens": int(usage["prompt_tokens"]) if "prompt_tokens" in usage else None,
+        "completion_tokens": (
+            int(usage["completion_tokens"]) if "completion_tokens" in usage else None
+        ),
+        "model": response.get("model_name"),
+    }
+
+
+def _schema():
+    import pyarrow as pa
+
+    return pa.schema(
+        [
+            ("conversation_id", pa.int64()),
+            ("session_id", pa.int64()),
+            ("created_at", pa.timestamp("us", tz="UTC")),
+            ("role", pa.string()),
+            ("text", pa.string()),
+            ("stage_id", pa.string()),
+            ("next_stage_id", pa.string()),
+            ("tool", pa.string()),
+            ("tool_input", pa.string()),
+            ("actions", pa.string()),
+            ("action_count", pa.int32()),
+            ("latency_ms", pa.int64()),
+            ("prompt_tokens", pa.int64()),
+            ("completion_tokens", pa.int64()),
+            ("model", pa.string()),
+        ]
+    )
+
+
+def _timestamp(value: str) -> datetime:
+    # in UTC, so partitions and file names do not depend on the exporting host's zone
+    moment = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if moment.tzinfo is None:
+        return moment.replace(tzinfo=timezone.utc)
+    return moment.astimezone(timezone.utc)
+
+
+def export_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    """One conversations row as an analytics record; tenant and day come from its partition."""
+    metadata = row.get("metadata") or {}
+    if isinstance(metadata, str):
+        metadata = json.loads(metadata)
+    turn = parse_turn(row.get("text") or "")
+    role = "user" if row.get("type") == "human" or turn.role is Role.USER else "ai"
+    actions = metadata.get("actions") or []
+    return {
+        "conversation_id": row["id"],
+        "session_id": row["session_id"],
+        "created_at": _timestamp(row["created_at"]),
+        "role": role,
+        "text": turn.text,
+        "stage_id": metadata.get("stage_id"),
+        "next_stage_id": metadata.get("next_stage_id"),
+        "tool": metadata.get("tool"),
+        "tool_input": metadata.get("tool_input"),
+        "actions": json.dumps(actions) if actions else None,
+        "action_count": len(actions),
+        "latency_ms": metadata.get("latency_ms"),
+        "prompt_tokens": metadata.get("prompt_tokens"),
+        "completion_tokens": metadata.get("completion_tokens"),
+        "model": metadata.get("model"),
+    }
+
+
+class ConversationExporter:
+    """
+    Incremental export of the conversations table to Parquet, partitioned as
+    <output>/conversations/tenant=<user id>/day=<YYYY-MM-DD, UTC>/part-<first row>.parquet.
+
+    Rows are read in (created_at, id) order from the last run's watermark, a
+    batch at a time. Each batch is written as one file per partition it
+    touches, each closed before the next, so memory and open files stay
+    bounded by the batch. Files are written under a temporary name, and the
+    watermark advances after each batch's files are renamed into place. The
+    files are named after the batch's first row, so a batch repeated after a
+    crash replaces its own files instead of duplicating them.
+    """
+
+    def __init__(
+        self,
+        supabase_client: Any,
+        output_dir: str = EXPORT_DIR,
+        batch_rows: int = EXPORT_BATCH_ROWS,
+        lag_seconds: float = EXPORT_LAG_SECONDS,
+        with_metadata: bool = STORE_TURN_METADATA,
+    ):
+        self.db = supabase_client
+        self.columns = "id,session_id,text,type,created_at" + (",metadata" if with_metadata else "")
+        self.output_dir = output_dir
+        self.batch_rows = batch_rows
+        self.lag_seconds = lag_seconds
+        self._tenants: Dict[Any, str] = {}
+
+    @property
+    def _watermark_path(self) -> str:
+        return os.path.join(self.output_dir, "conversations", "_watermark.json")
+
+    def watermark(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._watermark_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save_watermark(self, row: Dict[str, Any]) -> None:
+        os.makedirs(os.path.dirname(self._watermark_path), exist_ok=True)
+        staging = f"{self._watermark_path}.tmp"
+        with open(staging, "w") as f:
+            json.dump({"created_at": row["created_at"], "id": row["id"]}, f)
+        os.replace(staging, self._watermark_path)
+
+    def _tenants_for(self, session_ids: List[Any]) -> None:
+        missing = [sid for sid in set(session_ids) if sid not in self._tenants]
+        for start in range(0, len(missing), 500):
+            rows = (
+                self.db.table("sessions")
+                .select("id,user_id")
+                .in_("id", missing[start : start + 500])
+                .execute()
+                .data
+            )
+            for row in rows:
+                self._tenants[row["id"]] = str(row["user_id"])
+
+    def _batches(self, watermark: Optional[Dict[str, Any]], cutoff: str) -> Iterator[List[Dict]]:
+        cursor = encode_cursor(watermark) if watermark else None
+        while True:
+            query = self.db.table("conversations").select(self.columns)
+            rows = paginate(query.lt("created_at", cutoff), cursor, self.batch_rows).execute().data
+            batch = rows[: self.batch_rows]
+            if batch:
+                yield batch
+            if len(rows) <= self.batch_rows:
+                return
+            cursor = encode_cursor(batch[-1])
+
+    @staticmethod
+    def _part_name(first: Dict[str, Any]) -> str:
+        # named after the batch's first row, so re-exporting a batch overwrites its files
+        return f"part-{_timestamp(first['created_at']).strftime('%Y%m%dT%H%M%S%f')}-{first['id']}.parquet"
+
+    def run(self, since: Optional[Dict[str, Any]] = None) -> Tuple[int, int]:
+        """Export rows after the watermark (or `since`); returns (rows, files)."""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = _schema()
+        cutoff = (datetime.now(timezone.utc) - timedelta(seconds=self.lag_seconds)).isoformat()
+        exported = files = 0
+        for batch in self._batches(since or self.watermark(), cutoff):
+            self._tenants_for([row["session_id"] for row in batch])
+            partitions: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+            for row in batch:
+                tenant = self._tenants.get(row["session_id"], "unknown")
+                record = export_row(row)
+                day = record["created_at"].date().isoformat()
+                partitions.setdefault((tenant, day), []).append(record)
+
+            name = self._part_name(batch[0])
+            staged: List[Tuple[str, str]] = []
+            try:
+                for (tenant, day), records in partitions.items():
+                    directory = os.path.join(
+                        self.output_dir, "conversations", f"tenant={tenant}", f"day={day}"
+                    )
+                    os.makedirs(directory, exist_ok=True)
+                    final = os.path.join(directory, name)
+                    staged.append((f"{final}.tmp", final))
+                    pq.write_table(pa.Table.from_pylist(records, schema=schema), staged[-1][0])
+            except BaseException:
+                for staging, _ in staged:
+                    if os.path.exists(staging):
+                        os.remove(staging)
+                raise
+            for staging, final in staged:
+                os.replace(staging, final)
+            # a crash before this line re-exports the batch into the same files
+            self._save_watermark(batch[-1])
+            exported += len(batch)
+            files += len(staged)
+
+        log_event("conversations_exported", rows=exported, files=files)
+        return exported, files
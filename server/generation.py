@@ -0,0 +1,166 @@
+import inspect
+from typing import Any, Dict, List, Tuple
+
+END_OF_TURN = "<END_OF_TURN>"
+END_OF_CALL = "<END_OF_CALL>"
+CONTROL_MARKERS = (END_OF_TURN, END_OF_CALL)
+
+# Stop sequences and output caps for every chain the agent runs. The prompts
+# ask for <END_OF_CALL> before <END_OF_TURN>, so stopping on <END_OF_TURN>
+# never hides the end-of-call signal.
+GENERATION_POLICIES: Dict[str, Dict[str, Any]] = {
+    "stage_analyzer": {"max_tokens": 2, "stop": []},
+    "tool_planner": {"max_tokens": 256, "stop": [END_OF_TURN]},
+    "utterance": {"max_tokens": 200, "stop": [END_OF_TURN]},
+    "kb_qa": {"max_tokens": 256, "stop": []},
+}
+
+
+def strip_control_markers(text: str) -> Tuple[str, bool]:
+    """Remove control markers from a reply and report whether it ended the call."""
+    ended_call = END_OF_CALL in text
+    for marker in CONTROL_MARKERS:
+        text = text.replace(marker, "")
+    return text.strip(), ended_call
+
+
+class ControlMarkerFilter:
+    """
+    Strip control markers from a token stream as it is generated.
+
+    Text that could be the start of a marker is held back until the next token
+    decides it, so markers split across chunks are never leaked. Once
+    <END_OF_CALL> or <END_OF_TURN> is seen `done` is set and everything after
+    it is dropped, letting the caller stop consuming the model stream early.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.end_of_call = False
+        self.done = False
+
+    def feed(self, text: str) -> str:
+        if self.done or not text:
+            return ""
+        self.buffer += text
+
+        cut = len(self.buffer)
+        for marker in CONTROL_MARKERS:
+            index = self.buffer.find(marker)
+            if index == -1:
+                continue
+            cut = min(cut, index)
+            self.end_of_call = self.end_of_call or marker == END_OF_CALL
+            self.done = True
+        if self.done:
+            out, self.buffer = self.buffer[:cut], ""
+            return out
+
+        hold = self.buffer.rfind("<")
+        if hold != -1 and any(m.startswith(self.buffer[hold:]) for m in CONTROL_MARKERS):
+            out, self.buffer = self.buffer[:hold], self.buffer[hold:]
+        else:
+            out, self.buffer = self.buffer, ""
+        return out
+
+    def flush(self) -> str:
+        out, self.buffer = self.buffer, ""
+        return "" if self.done else out
+
+
+async def aclose_stream(stream: Any) -> None:
+    """Best-effort close of a litellm stream so the provider stops generating."""
+    if inspect.isasyncgen(stream):
+        # a wrapper around a litellm stream closes it in its own finally
+        await stream.aclose()
+        return
+    inner = getattr(stream, "completion_stream", None)
+    for target in (inner, getattr(inner, "response", None)):
+        close = getattr(target, "aclose", None) or getattr(target, "close", None)
+        if close is None:
+            continue
+        try:
+            result = close()
+            if hasattr(result, "__await__"):
+                await result
+        except Exception:
+            pass
+        return
+
+
+SENTENCE_ENDINGS = ".!?"
+CLAUSE_ENDINGS = ",;:"
+# Words whose trailing period does not close a sentence
+ABBREVIATIONS = {"mr", "mrs", "ms", "dr", "st", "vs", "etc", "e.g", "i.e", "inc", "ltd", "no"}
+MARKDOWN_TOKENS = ("**", "__", "`", "*", "#")
+
+
+def strip_markdown(text: str) -> str:
+    """Remove the markdown emphasis, code and heading markup a TTS engine would read out."""
+    for token in MARKDOWN_TOKENS:
+        text = text.replace(token, "")
+    lines = [line.lstrip() for line in text.split("\n")]
+    lines = [line[2:] if line.startswith(("- ", "+ ")) else line for line in lines]
+    return " ".join(line for line in lines if line).strip()
+
+
+class SentenceSegmenter:
+    """
+    Turn a token stream into speakable sentence or clause chunks.
+
+    A chunk is emitted as soon as a sentence ending followed by whitespace
+    arrives. Long sentences are also split at clause punctuation once they
+    pass `max_chars`, so speech never waits for a run-on sentence. Control
+    markers and markdown are removed and every chunk gets a sequence number.
+    """
+
+    def __init__(self, min_chars: int = 4, max_chars: int = 160):
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.buffer = ""
+        self.seq = 0
+        self._scanned = 0
+
+    def _boundary(self) -> int:
+        """Index just past the first chunk boundary in the buffer, or -1."""
+        for i in range(self._scanned, len(self.buffer) - 1):
+            char = self.buffer[i]
+            if not self.buffer[i + 1].isspace() or i + 1 < self.min_chars:
+                continue
+            if char in SENTENCE_ENDINGS:
+                words = self.buffer[:i].split()
+                if char == "." and words and words[-1].lower() in ABBREVIATIONS:
+                    continue
+                return i + 1
+            if char in CLAUSE_ENDINGS and i + 1 >= self.max_chars:
+                return i + 1
+        self._scanned = max(len(self.buffer) - 1, 0)
+        return -1
+
+    def _chunk(self, text: str):
+        text, _ = strip_control_markers(text)
+        text = strip_markdown(text)
+        if not text:
+            return None
+        chunk = {"seq": self.seq, "text": text}
+        self.seq += 1
+        return chunk
+
+    def feed(self, text: str) -> List[Dict[str, Any]]:
+        self.buffer += text
+        chunks = []
+        while True:
+            cut = self._boundary()
+            if cut == -1:
+                return chunks
+            chunk = self._chunk(self.buffer[:cut])
+            self.buffer = self.buffer[cut:].lstrip()
+            self._scanned = 0
+            if chunk is not None:
+                chunks.append(chunk)
+
+    def flush(self) -> List[Dict[str, Any]]:
+        chunk = self._chunk(self.buffer)
+        self.buffer = ""
+        self._scanned = 0
+        return [chunk] if chunk is not None else []
@@ -0,0 +1,216 @@
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+from langchain_community.chat_models import ChatLiteLLM
+from langchain_community.chat_models.litellm import acompletion_with_retry
+
+from server.generation import aclose_stream
+from server.logger import log_event
+from server.metrics import metrics
+
+# The hedge fires when the primary has not answered within this latency percentile
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+# Delay used until enough latencies are recorded, and the bounds of the delay
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "3"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.3"))
+HEDGE_MAX_DELAY = float(os.getenv("HEDGE_MAX_DELAY", "15"))
+# Largest share of a role's recent requests that may send a duplicate
+HEDGE_BUDGET = float(os.getenv("HEDGE_BUDGET", "0.1"))
+# Requests (and latencies) remembered per role for the budget and the percentile
+HEDGE_WINDOW = int(os.getenv("HEDGE_WINDOW", "200"))
+HEDGE_MIN_SAMPLES = 20
+
+
+class LatencyTracker:
+    """Rolling window of latencies with a percentile estimate."""
+
+    def __init__(self, size: int = HEDGE_WINDOW):
+        self.samples: Deque[float] = deque(maxlen=size)
+
+    def add(self, seconds: float) -> None:
+        self.samples.append(seconds)
+
+    def percentile(self, p: float) -> Optional[float]:
+        if len(self.samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+class Hedger:
+    """
+    Runs an LLM call against a primary model and, when it is slow, a duplicate
+    against a secondary model; the first success wins and the other is cancelled.
+
+    The hedge delay is the primary's recent latency percentile, so only the
+    tail is duplicated. Each role may hedge at most `budget` of its recent
+    requests, which caps the extra provider load. A primary that fails before
+    the delay fails over to the secondary at once, outside the budget.
+    """
+
+    def __init__(self, percentile: float = HEDGE_PERCENTILE, window: int = HEDGE_WINDOW):
+        self.percentile = percentile
+        self.window = window
+        self._latency: Dict[Tuple[str, str], LatencyTracker] = {}
+        self._hedged: Dict[str, Deque[bool]] = {}
+
+    def tracker(self, role: str, model: str) -> LatencyTracker:
+        key = (role, model)
+        if key not in self._latency:
+            self._latency[key] = LatencyTracker(self.window)
+        return self._latency[key]
+
+    def delay(self, role: str, model: str) -> float:
+        estimate = self.tracker(role, model).percentile(self.percentile)
+        if estimate is None:
+            return HEDGE_DEFAULT_DELAY
+        return min(max(estimate, HEDGE_MIN_DELAY), HEDGE_MAX_DELAY)
+
+    def _record(self, role: str, hedged: bool) -> None:
+        if role not in self._hedged:
+            self._hedged[role] = deque(maxlen=self.window)
+        self._hedged[role].append(hedged)
+
+    def _within_budget(self, role: str, budget: float) -> bool:
+        recent = self._hedged.get(role)
+        if not recent:
+            return budget > 0
+        return sum(recent) < budget * len(recent)
+
+    async def run(
+        self,
+        role: str,
+        primary: str,
+        secondary: Optional[str],
+        call: Callable[[str], Awaitable[Any]],
+        budget: float = HEDGE_BUDGET,
+        discard: Optional[Callable[[Any], Awaitable[None]]] = None,
+    ) -> Any:
+        """
+        Return call(primary), or call(secondary) if that finishes first.
+
+        `discard` releases the result of a loser that finished anyway, e.g.
+        closes its stream.
+        """
+        if not secondary:
+            return await call(primary)
+
+        metrics.inc("hedge_requests", role=role)
+        started = time.monotonic()
+        first = asyncio.ensure_future(call(primary))
+        tasks: Dict[asyncio.Future, str] = {first: primary}
+        hedged = False
+
+        def start_secondary(reason: str) -> None:
+            tasks[asyncio.ensure_future(call(secondary))] = secondary
+            metrics.inc(f"hedge_{reason}", role=role)
+
+        try:
+            done, _ = await asyncio.wait({first}, timeout=self.delay(role, primary))
+            if not done:
+                if self._within_budget(role, budget):
+                    hedged = True
+                    start_secondary("fired")
+                else:
+                    metrics.inc("hedge_budget_exhausted", role=role)
+            self._record(role, hedged)
+
+            pending = set(tasks)
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((task for task in done if task.exception() is None), None)
+                if winner is not None:
+                    if winner is first:
+                        self.tracker(role, primary).add(time.monotonic() - started)
+                    if len(tasks) > 1:
+                        metrics.inc("hedge_wins", role=role, winner=tasks[winner])
+                    for task in done:
+                        if task is not winner and task.exception() is None and discard:
+                            await discard(task.result())
+                    return winner.result()
+                error = next(iter(done)).exception()
+                if len(tasks) == 1:
+                    log_event("hedge_failover", role=role, model=primary, error=str(error))
+                    start_secondary("failover")
+                    pending = set(tasks) - {first}
+            raise error
+        finally:
+            for task, model in tasks.items():
+                if not task.done():
+                    task.cancel()
+                    if model == primary:
+                        # a lower bound, but it keeps the percentile honest about stalls
+                        self.tracker(role, primary).add(time.monotonic() - started)
+
+    async def run_stream(
+        self,
+        role: str,
+        primary: str,
+        secondary: Optional[str],
+        open_stream: Callable[[str], Awaitable[Any]],
+        budget: float = HEDGE_BUDGET,
+    ) -> Any:
+        """Hedge a streaming call on its first chunk instead of its whole response."""
+        if not secondary:
+            return await open_stream(primary)
+
+        async def first_chunk(model: str):
+            stream = await open_stream(model)
+            try:
+                return stream, await stream.__anext__()
+            except StopAsyncIteration:
+                return stream, None
+            except BaseException:
+                await aclose_stream(stream)
+                raise
+
+        async def discard(result):
+            await aclose_stream(result[0])
+
+        stream, chunk = await self.run(role, primary, secondary, first_chunk, budget, discard)
+        return _prepend(chunk, stream)
+
+
+async def _prepend(chunk: Any, stream: Any):
+    try:
+        if chunk is not None:
+            yield chunk
+        async for chunk in stream:
+            yield chunk
+    finally:
+        await aclose_stream(stream)
+
+
+hedger = Hedger()
+
+
+class HedgedChatLiteLLM(ChatLiteLLM):
+    """ChatLiteLLM whose async, non-streaming calls are hedged to `hedge_model`."""
+
+    hedge_role: str = ""
+    hedge_model: Optional[str] = None
+    hedge_budget: float = HEDGE_BUDGET
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, stream=None, **kwargs):
+        should_stream = stream if stream is not None else self.streaming
+        if should_stream or not self.hedge_model:
+            return await super()._agenerate(
+                messages, stop=stop, run_manager=run_manager, stream=stream, **kwargs
+            )
+
+        message_dicts, params = self._create_message_dicts(messages, stop)
+        params = {**params, **kwargs}
+
+        async def call(model: str):
+            return await acompletion_with_retry(
+                self, messages=message_dicts, run_manager=run_manager, **{**params, "model": model}
+            )
+
+        response = await hedger.run(
+            self.hedge_role, self.model, self.hedge_model, call, self.hedge_budget
+        )
+        return self._create_chat_result(response)
@@ -0,0 +1,241 @@
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Any, Dict, Iterator, Optional
+
+from pydantic import BaseModel
+
+from server.embedding_cache import cached_embeddings
+from server.logger import log_event
+from server.metrics import metrics
+from server.retrieval import RETRIEVAL_DIR, catalog_key, split_catalog
+from server.vector_index import VectorIndex
+
+INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", "2"))
+# Chunks sent to the embedding model per call; progress is reported per batch
+INGESTION_BATCH_SIZE = int(os.getenv("INGESTION_BATCH_SIZE", "256"))
+# A queued or running job without progress for this long is taken to have died with its worker
+INGESTION_STALE_SECONDS = float(os.getenv("INGESTION_STALE_SECONDS", "600"))
+
+
+class IngestionJob(BaseModel):
+    """Progress of one catalog upload, as returned by the status endpoint."""
+
+    id: str
+    tenant: str
+    catalog_key: str
+    status: str = "queued"  # queued, running, done, failed or superseded
+    chunks: int = 0
+    embedded: int = 0
+    error: Optional[str] = None
+    created_at: float
+    updated_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+
+def index_path(key: str, data_dir: str = RETRIEVAL_DIR) -> str:
+    # the sidecar stores indexes under the same catalog keys
+    return os.path.join(data_dir, key)
+
+
+def _pointer_path(tenant: str, data_dir: str = RETRIEVAL_DIR) -> str:
+    return os.path.join(data_dir, "tenants", f"{tenant}.json")
+
+
+def current_catalog_key(tenant: Any, data_dir: str = RETRIEVAL_DIR) -> Optional[str]:
+    """Catalog key of the tenant's last successfully built index, if any."""
+    try:
+        with open(_pointer_path(str(tenant), data_dir)) as f:
+            return json.load(f)["catalog_key"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _job_path(tenant: str, data_dir: str = RETRIEVAL_DIR) -> str:
+    return os.path.join(data_dir, "jobs", f"{tenant}.json")
+
+
+def _write_json(path: str, payload: Dict[str, Any]) -> None:
+    """Readers see the old or the new file, never a partial one."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, staging = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, "w") as f:
+        json.dump(payload, f)
+    os.replace(staging, path)
+
+
+def _swap(tenant: str, key: str, data_dir: str = RETRIEVAL_DIR) -> None:
+    """Point the tenant at index `key`."""
+    _write_json(_pointer_path(tenant, data_dir), {"catalog_key": key, "updated_at": time.time()})
+
+
+def ready_catalog_key(
+    product_catalog: str, tenant: Any = None, data_dir: str = RETRIEVAL_DIR
+) -> Optional[str]:
+    """
+    Key of a built index to answer chats for this catalog, without embedding anything.
+
+    The catalog's own index if it exists, otherwise the tenant's last good one
+    while a newer upload is still being ingested.
+    """
+    key = catalog_key(product_catalog)
+    if os.path.isdir(index_path(key, data_dir)):
+        return key
+    if tenant is None:
+        return None
+    key = current_catalog_key(tenant, data_dir)
+    if key is not None and os.path.isdir(index_path(key, data_dir)):
+        return key
+    return None
+
+
+@lru_cache(maxsize=64)
+def load_index(key: str, data_dir: str = RETRIEVAL_DIR) -> VectorIndex:
+    """Memory-mapped index, shared by every chat of every tenant with this catalog."""
+    return VectorIndex.load(index_path(key, data_dir))
+
+
+class IngestionQueue:
+    """
+    Builds catalog indexes in the background when a tenant's catalog is written.
+
+    Each job chunks and embeds the catalog, saves the index under its catalog
+    key and then swaps the tenant's pointer to it, so chats keep using the
+    previous index until the new one is complete. A newer upload for the same
+    tenant supersedes older jobs that have not swapped yet.
+
+    The tenant's latest job is kept next to the pointers, under
+    `data_dir`/jobs, so every worker sharing the directory reports and
+    supersedes it, whichever worker took the upload. Reading and replacing
+    the job, and the check before a swap, hold the tenant's file lock.
+    """
+
+    def __init__(self, workers: int = INGESTION_WORKERS, data_dir: str = RETRIEVAL_DIR):
+        self.data_dir = data_dir
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest")
+        self._embeddings = None
+
+    @property
+    def embeddings(self) -> Any:
+        if self._embeddings is None:
+            from langchain_openai import OpenAIEmbeddings
+
+            self._embeddings = cached_embeddings(OpenAIEmbeddings())
+        return self._embeddings
+
+    def status(self, tenant: Any) -> Optional[IngestionJob]:
+        """The tenant's latest job, as last saved by whichever worker runs it."""
+        try:
+            with open(_job_path(str(tenant), self.data_dir)) as f:
+                return IngestionJob(**json.load(f))
+        except (OSError, ValueError, TypeError):
+            return None
+
+    @contextmanager
+    def _tenant_lock(self, tenant: str) -> Iterator[None]:
+        """Serialize one tenant's job and pointer updates across threads and processes."""
+        path = _job_path(tenant, self.data_dir) + ".lock"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._lock, open(path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _save(self, job: IngestionJob) -> None:
+        job.updated_at = time.time()
+        _write_json(_job_path(job.tenant, self.data_dir), job.dict())
+
+    def submit(self, tenant: Any, product_catalog: str) -> IngestionJob:
+        tenant = str(tenant)
+        key = catalog_key(product_catalog)
+        with self._tenant_lock(tenant):
+            latest = self.status(tenant)
+            if latest is not None and latest.catalog_key == key and not self._abandoned(latest):
+                return latest
+            job = IngestionJob(
+                id=uuid.uuid4().hex, tenant=tenant, catalog_key=key, created_at=time.time()
+            )
+            self._save(job)
+        metrics.inc("ingestion_jobs", status="queued")
+        self._executor.submit(self._run, job, product_catalog)
+        return job
+
+    @staticmethod
+    def _abandoned(job: IngestionJob) -> bool:
+        if job.status == "failed":
+            return True
+        idle = time.time() - (job.updated_at or job.created_at)
+        return job.status in ("queued", "running") and idle > INGESTION_STALE_SECONDS
+
+    def _is_latest(self, job: IngestionJob) -> bool:
+        latest = self.status(job.tenant)
+        return latest is not None and latest.id == job.id
+
+    def _progress(self, job: IngestionJob) -> None:
+        with self._tenant_lock(job.tenant):
+            if self._is_latest(job):
+                self._save(job)
+
+    def _finish(self, job: IngestionJob, status: str, error: Optional[str] = None) -> None:
+        job.status = status
+        job.error = error
+        job.finished_at = time.time()
+        self._progress(job)
+        metrics.inc("ingestion_jobs", status=status)
+        metrics.observe("ingestion_seconds", job.finished_at - job.created_at, status=status)
+        log_event(
+            "ingestion_job",
+            job_id=job.id,
+            tenant=job.tenant,
+            status=status,
+            chunks=job.chunks,
+            error=error,
+        )
+
+    def _run(self, job: IngestionJob, product_catalog: str) -> None:
+        if not self._is_latest(job):
+            self._finish(job, "superseded")
+            return
+        job.status = "running"
+        self._progress(job)
+        try:
+            path = index_path(job.catalog_key, self.data_dir)
+            if not os.path.isdir(path):
+                self._build(job, product_catalog).save(path)
+            with self._tenant_lock(job.tenant):
+                # a newer job cannot be submitted or swap in between
+                swapped = self._is_latest(job)
+                if swapped:
+                    _swap(job.tenant, job.catalog_key, self.data_dir)
+            if not swapped:
+                # the index stays on disk for whoever uploads this catalog again
+                self._finish(job, "superseded")
+                return
+        except Exception as e:
+            self._finish(job, "failed", str(e))
+            return
+        self._finish(job, "done")
+
+    def _build(self, job: IngestionJob, product_catalog: str) -> VectorIndex:
+        chunks = split_catalog(product_catalog)
+        job.chunks = len(chunks)
+        vectors = []
+        for start in range(0, len(chunks), INGESTION_BATCH_SIZE):
+            batch = chunks[start : start + INGESTION_BATCH_SIZE]
+            vectors.extend(self.embeddings.embed_documents(batch))
+            job.embedded += len(batch)
+            self._progress(job)
+        return VectorIndex.from_vectors(chunks, vectors)
+
+
+ingestion = IngestionQueue()
@@ -1,38 +1,145 @@
+import atexit
+import contextvars
+import inspect
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
 import time
 from functools import wraps
+from typing import Any, Optional
 
-logger = logging.getLogger(__name__)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Optional file sink; empty disables it
+LOG_FILE = os.getenv("LOG_FILE", "")
+# Share of requests whose full prompts, histories and LLM logs are logged
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0"))
 
-stream_handler = logging.StreamHandler()
-log_filename = "output.log"
-file_handler = logging.FileHandler(filename=log_filename)
-handlers = [stream_handler, file_handler]
+logger = logging.getLogger("blackspace")
 
+_payload_sampled: contextvars.ContextVar[Optional[bool]] = contextvars.ContextVar(
+    "payload_sampled", default=None
+)
+_request_id: contextvars.ContextVar[str] = contextvars.ContextVar("request_id", default="")
 
-class TimeFilter(logging.Filter):
-    def filter(self, record):
-        return "Running" in record.getMessage()
+_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
 
 
-logger.addFilter(TimeFilter())
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, event and extra fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        event = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_FIELDS:
+                event[key] = value
+        if record.exc_info:
+            event["exc"] = self.formatException(record.exc_info)
+        return json.dumps(event, default=str)
+
+
+def _setup() -> logging.handlers.QueueListener:
+    """
+    Route records through a queue so the request path only enqueues.
+
+    Formatting and the stdout/file writes happen on the listener's thread.
+    """
+    sinks = [logging.StreamHandler(sys.stdout)]
+    if LOG_FILE:
+        sinks.append(logging.FileHandler(filename=LOG_FILE))
+    for sink in sinks:
+        sink.setFormatter(JsonFormatter())
+
+    records: queue.Queue = queue.Queue(-1)
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+
+    listener = logging.handlers.QueueListener(records, *sinks, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+listener = _setup()
+
+
+def start_request(request_id: str = "", sampled: Optional[bool] = None) -> None:
+    """
+    Tag the current request (context) with an id and a payload sampling decision.
+
+    Tasks started afterwards inherit both through their context.
+    """
+    if sampled is None:
+        sampled = random.random() < LOG_PAYLOAD_SAMPLE_RATE
+    _request_id.set(request_id)
+    _payload_sampled.set(sampled)
+
+
+def payload_enabled() -> bool:
+    """Whether full payloads should be logged for the current request."""
+    if logger.isEnabledFor(logging.DEBUG):
+        return True
+    return bool(_payload_sampled.get())
+
+
+def log_event(event: str, level: int = logging.INFO, **fields: Any) -> None:
+    if not logger.isEnabledFor(level):
+        return
+    request_id = _request_id.get()
+    if request_id:
+        fields.setdefault("request_id", request_id)
+    logger.log(level, event, extra=fields)
+
+
+def log_payload(event: str, **fields: Any) -> None:
+    """
+    Log prompts, histories and raw LLM output, for sampled requests only.
+
+    Callers should pass cheap references; anything expensive to build should
+    be guarded with payload_enabled(). The fields are copied to plain JSON
+    data here, since the request keeps mutating them while the record waits
+    for the listener thread.
+    """
+    if payload_enabled():
+        fields = json.loads(json.dumps(fields, default=str))
+        log_event(event, level=logging.INFO, payload=True, **fields)
+
+
+def _log_timing(func, start_time: float) -> None:
+    log_event(
+        "timing", func=func.__name__, seconds=round(time.perf_counter() - start_time, 4)
+    )
 
-# Configure the logging module
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(name)s %(asctime)s - %(levelname)s - %(message)s",
-    handlers=handlers,
-)
 
 def time_logger(func):
 
+    if inspect.iscoroutinefunction(func):
+
+        @wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                _log_timing(func, start_time)
+
+        return async_wrapper
+
     @wraps(func)
     def wrapper(*args, **kwargs):
-        start_time = time.time()  
-        result = func(*args, **kwargs)  
-        end_time = time.time() 
-        execution_time = end_time - start_time  
-        logger.info(f"Running {func.__name__}: --- {execution_time} seconds ---")
-        return result
+        start_time = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _log_timing(func, start_time)
 
     return wrapper
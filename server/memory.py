@@ -0,0 +1,148 @@
+import sys
+import time
+from array import array
+from enum import IntEnum
+from typing import Any, Dict, Iterable, Iterator, List
+
+USER_PREFIX = "User: "
+END_OF_TURN = "<END_OF_TURN>"
+
+_encoding = None
+
+
+def count_tokens(text: str) -> int:
+    """Token count with the cl100k encoding, falling back to a length estimate."""
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            _encoding = False
+    if _encoding is False:
+        return len(text) // 4 + 1
+    return len(_encoding.encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text: str, limit: int, mark: str = " [truncated]") -> str:
+    """Keep the first `limit` tokens of text, marking the cut."""
+    if count_tokens(text) <= limit:
+        return text
+    if _encoding is False:
+        return text[: max(limit, 0) * 4] + mark
+    tokens = _encoding.encode(text, disallowed_special=())
+    return _encoding.decode(tokens[: max(limit, 0)]) + mark
+
+
+class Role(IntEnum):
+    USER = 0
+    AI = 1
+
+
+class Turn:
+    """One conversation turn, without the prompt markup around it."""
+
+    __slots__ = ("role", "text", "tokens", "timestamp")
+
+    def __init__(self, role: Role, text: str, tokens: int = None, timestamp: float = None):
+        self.role = role
+        self.text = text
+        self.tokens = count_tokens(text) if tokens is None else tokens
+        self.timestamp = time.time() if timestamp is None else timestamp
+
+    def render(self, ai_name: str) -> str:
+        speaker = "User" if self.role is Role.USER else ai_name
+        return f"{speaker}: {self.text} {END_OF_TURN}"
+
+    def __repr__(self) -> str:
+        return f"Turn({self.role.name}, {self.text!r})"
+
+
+def parse_turn(line: str, ai_name: str = "") -> Turn:
+    """Convert a stored "Speaker: text <END_OF_TURN>" line into a Turn."""
+    text = line.replace(END_OF_TURN, "").strip()
+    if text.startswith(USER_PREFIX):
+        return Turn(Role.USER, text[len(USER_PREFIX) :].strip())
+    # AI rows are stored both with and without the salesperson prefix
+    if ai_name and text.startswith(f"{ai_name}:"):
+        text = text[len(ai_name) + 1 :].strip()
+    return Turn(Role.AI, text)
+
+
+class TurnStore:
+    """
+    Conversation history kept as parallel arrays instead of prefixed strings.
+
+    Roles, token counts and timestamps live in typed arrays and only the turn
+    text is a Python object, so a turn costs a few bytes on top of its text.
+    The speaker and the "<END_OF_TURN>" markup are only produced by render()
+    when a prompt is assembled, so nothing downstream splits strings to
+    recover them. Indexing returns a Turn view of the stored record.
+    """
+
+    __slots__ = ("texts", "roles", "tokens", "timestamps", "total_tokens")
+
+    def __init__(self, turns: Iterable[Turn] = ()):
+        self.texts: List[str] = []
+        self.roles = bytearray()
+        self.tokens = array("I")
+        self.timestamps = array("d")
+        self.total_tokens = 0
+        for turn in turns:
+            self._add(turn.role, turn.text, turn.tokens, turn.timestamp)
+
+    @classmethod
+    def from_strings(cls, lines: Iterable[str], ai_name: str = "") -> "TurnStore":
+        return cls(parse_turn(line, ai_name) for line in lines)
+
+    def _add(self, role: Role, text: str, tokens: int, timestamp: float) -> None:
+        self.texts.append(text)
+        self.roles.append(role)
+        self.tokens.append(tokens)
+        self.timestamps.append(timestamp)
+        self.total_tokens += tokens
+
+    def append(self, role: Role, text: str) -> Turn:
+        turn = Turn(role, text)
+        self._add(turn.role, turn.text, turn.tokens, turn.timestamp)
+        return turn
+
+    def render(self, ai_name: str) -> str:
+        speakers = ("User", ai_name)
+        return "\n".join(
+            f"{speakers[role]}: {text} {END_OF_TURN}"
+            for role, text in zip(self.roles, self.texts)
+        )
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def __bool__(self) -> bool:
+        return bool(self.texts)
+
+    def __iter__(self) -> Iterator[Turn]:
+        for index in range(len(self.texts)):
+            yield self[index]
+
+    def __getitem__(self, index: int) -> Turn:
+        return Turn(
+            Role(self.roles[index]),
+            self.texts[index],
+            self.tokens[index],
+            self.timestamps[index],
+        )
+
+    def __repr__(self) -> str:
+        return f"TurnStore({len(self.texts)} turns, {self.total_tokens} tokens)"
+
+
+def intern_config(config: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Intern the tenant's string settings so every session of a tenant shares one
+    copy of each, instead of a fresh copy per request from the database row.
+    """
+    return {
+        key: sys.intern(value) if isinstance(value, str) else value
+        for key, value in config.items()
+    }
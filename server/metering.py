@@ -0,0 +1,365 @@
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+from pydantic import BaseModel
+
+from server.logger import log_event
+from server.metrics import add_to_turn, metrics
+
+# Tokens a tenant may use per window before its turns are degraded; 0 disables budgets.
+# A tenant's config can override it with "token_budget".
+TENANT_TOKEN_BUDGET = int(os.getenv("TENANT_TOKEN_BUDGET", "0"))
+TENANT_BUDGET_WINDOW = int(os.getenv("TENANT_BUDGET_WINDOW", "86400"))
+# Model every role is switched to once a tenant is over budget
+BUDGET_DEGRADED_MODEL = os.getenv("BUDGET_DEGRADED_MODEL", "gpt-3.5-turbo")
+# Over-budget tenants also lose tools, which cost a planning call and the KB QA call
+BUDGET_DISABLE_TOOLS = os.getenv("BUDGET_DISABLE_TOOLS", "True").lower() in ["true", "1", "t"]
+METERING_SHARDS = int(os.getenv("METERING_SHARDS", "16"))
+METERING_FLUSH_INTERVAL = float(os.getenv("METERING_FLUSH_INTERVAL", "30"))
+# Rows per insert when flushing usage to storage
+METERING_FLUSH_BATCH = int(os.getenv("METERING_FLUSH_BATCH", "500"))
+
+# calls, prompt tokens, completion tokens, latency seconds
+Counts = List[float]
+
+
+class TenantUsage(BaseModel):
+    """A tenant's token usage in the current budget window, as returned by the usage endpoint."""
+
+    tenant: str
+    window_start: float
+    window_seconds: int
+    budget: int
+    tokens: int
+    degraded: bool
+    roles: Dict[str, Dict[str, Union[int, float]]]
+
+
+def _usage(response: Any) -> Tuple[int, int]:
+    usage = getattr(response, "usage", None)
+    if usage is None and isinstance(response, dict):
+        usage = response.get("usage")
+    if usage is None:
+        return 0, 0
+    if isinstance(usage, dict):
+        return int(usage.get("prompt_tokens") or 0), int(usage.get("completion_tokens") or 0)
+    return int(usage.prompt_tokens or 0), int(usage.completion_tokens or 0)
+
+
+def _seconds(start: Any, end: Any) -> float:
+    try:
+        return max((end - start).total_seconds(), 0.0)
+    except (TypeError, AttributeError):
+        return 0.0
+
+
+class UsageMeter:
+    """
+    Per-tenant, per-role token and latency counters fed by a litellm callback.
+
+    Counters are split into shards by tenant, each with its own lock, so
+    concurrent responses of different tenants rarely contend. Besides the
+    running window totals, every shard keeps the usage not yet written to
+    storage; a background thread drains it every METERING_FLUSH_INTERVAL
+    seconds and writes it in batches.
+
+    With a `loader`, budgets count every worker's usage: a tenant's stored
+    window totals are loaded when it is first seen and reloaded after each
+    flush, and this process's usage is added until storage reflects it.
+    """
+
+    def __init__(
+        self,
+        shards: int = METERING_SHARDS,
+        budget: int = TENANT_TOKEN_BUDGET,
+        window: int = TENANT_BUDGET_WINDOW,
+    ):
+        self.budget = budget
+        self.window = window
+        self._shards = [threading.Lock() for _ in range(shards)]
+        self._pending: List[Dict[Tuple[str, str, str, float], Counts]] = [{} for _ in range(shards)]
+        self._windows: List[Dict[str, Tuple[float, Dict[str, Counts]]]] = [
+            {} for _ in range(shards)
+        ]
+        # tenant -> (window start, role totals) as last loaded from storage
+        self._stored: List[Dict[str, Tuple[float, Dict[str, Counts]]]] = [{} for _ in range(shards)]
+        # rows written since the last load; still counted locally until storage is reloaded
+        self._unreflected: List[Dict[str, Any]] = []
+        self._loader: Optional[Callable[[List[str], str], List[Dict[str, Any]]]] = None
+        self._installed = False
+        self._flusher: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def _shard(self, tenant: str) -> int:
+        return hash(tenant) % len(self._shards)
+
+    def _window_start(self, now: Optional[float] = None) -> float:
+        now = time.time() if now is None else now
+        return now - now % self.window
+
+    def record(
+        self,
+        tenant: Any,
+        role: str,
+        model: str,
+        prompt_tokens: int,
+        completion_tokens: int,
+        latency: float = 0.0,
+    ) -> None:
+        tenant = str(tenant) if tenant is not None else ""
+        window_start = self._window_start()
+        shard = self._shard(tenant)
+        with self._shards[shard]:
+            counts = self._pending[shard].setdefault((tenant, role, model, window_start), [0, 0, 0, 0.0])
+            counts[0] += 1
+            counts[1] += prompt_tokens
+            counts[2] += completion_tokens
+            counts[3] += latency
+
+            start, roles = self._windows[shard].get(tenant, (window_start, {}))
+            if start != window_start:
+                start, roles = window_start, {}
+            totals = roles.setdefault(role, [0, 0, 0, 0.0])
+            totals[0] += 1
+            totals[1] += prompt_tokens
+            totals[2] += completion_tokens
+            totals[3] += latency
+            self._windows[shard][tenant] = (start, roles)
+
+        metrics.inc("llm_tokens", prompt_tokens, role=role, kind="prompt")
+        metrics.inc("llm_tokens", completion_tokens, role=role, kind="completion")
+        metrics.observe("llm_call_seconds", latency, role=role)
+
+    def _period(self, window_start: float) -> str:
+        return datetime.fromtimestamp(window_start, timezone.utc).isoformat()
+
+    def _load(self, tenants: List[str]) -> bool:
+        """Replace the stored totals of `tenants` for the current window; False if storage failed."""
+        if self._loader is None or not tenants:
+            return self._loader is not None
+        window_start = self._window_start()
+        try:
+            rows = self._loader(tenants, self._period(window_start))
+        except Exception as e:
+            log_event("usage_load_failed", tenants=len(tenants), error=str(e))
+            return False
+        loaded: Dict[str, Dict[str, Counts]] = {tenant: {} for tenant in tenants}
+        for row in rows:
+            totals = loaded.setdefault(str(row["tenant"]), {}).setdefault(row["role"], [0, 0, 0, 0.0])
+            totals[0] += row.get("calls") or 0
+            totals[1] += row.get("prompt_tokens") or 0
+            totals[2] += row.get("completion_tokens") or 0
+            totals[3] += (row.get("latency_ms") or 0) / 1000
+        for tenant, roles in loaded.items():
+            shard = self._shard(tenant)
+            with self._shards[shard]:
+                self._stored[shard][tenant] = (window_start, roles)
+        return True
+
+    def _window_roles(self, tenant: str) -> Dict[str, Counts]:
+        """Stored plus local role totals of the tenant's current window."""
+        window_start = self._window_start()
+        shard = self._shard(tenant)
+        with self._shards[shard]:
+            loaded = self._stored[shard].get(tenant, (None, {}))[0] == window_start
+        if not loaded and not self._load([tenant]):
+            with self._shards[shard]:
+                # counted locally until the next flush reloads it, instead of retrying per call
+                self._stored[shard][tenant] = (window_start, {})
+        roles: Dict[str, Counts] = {}
+        with self._shards[shard]:
+            for start, counts_by_role in (
+                self._stored[shard].get(tenant, (None, {})),
+                self._windows[shard].get(tenant, (None, {})),
+            ):
+                if start != window_start:
+                    continue
+                for role, counts in counts_by_role.items():
+                    totals = roles.setdefault(role, [0, 0, 0, 0.0])
+                    for i, value in enumerate(counts):
+                        totals[i] += value
+        return roles
+
+    def tokens(self, tenant: Any) -> int:
+        """Tokens the tenant used in the current window."""
+        roles = self._window_roles(str(tenant))
+        return int(sum(counts[1] + counts[2] for counts in roles.values()))
+
+    def over_budget(self, tenant: Any, budget: Optional[int] = None) -> bool:
+        budget = self.budget if budget is None else budget
+        if tenant is None or budget <= 0:
+            return False
+        return self.tokens(tenant) >= budget
+
+    def usage(self, tenant: Any, budget: Optional[int] = None) -> TenantUsage:
+        tenant = str(tenant)
+        budget = self.budget if budget is None else budget
+        roles = {
+            role: {
+                "calls": int(counts[0]),
+                "prompt_tokens": int(counts[1]),
+                "completion_tokens": int(counts[2]),
+                "latency_seconds": round(counts[3], 3),
+            }
+            for role, counts in self._window_roles(tenant).items()
+        }
+        tokens = int(sum(r["prompt_tokens"] + r["completion_tokens"] for r in roles.values()))
+        return TenantUsage(
+            tenant=tenant,
+            window_start=self._window_start(),
+            window_seconds=self.window,
+            budget=budget,
+            tokens=tokens,
+            degraded=budget > 0 and tokens >= budget,
+            roles=roles,
+        )
+
+    def drain(self) -> List[Dict[str, Any]]:
+        """Take the usage not yet written to storage, as token_usage rows."""
+        rows = []
+        for shard, lock in enumerate(self._shards):
+            with lock:
+                pending, self._pending[shard] = self._pending[shard], {}
+            for (tenant, role, model, window_start), counts in pending.items():
+                rows.append(
+                    {
+                        "tenant": tenant,
+                        "role": role,
+                        "model": model,
+                        "period_start": self._period(window_start),
+                        "calls": int(counts[0]),
+                        "prompt_tokens": int(counts[1]),
+                        "completion_tokens": int(counts[2]),
+                        "latency_ms": round(counts[3] * 1000),
+                    }
+                )
+        return rows
+
+    def _restore(self, rows: List[Dict[str, Any]]) -> None:
+        for row in rows:
+            window_start = datetime.fromisoformat(row["period_start"]).timestamp()
+            shard = self._shard(row["tenant"])
+            with self._shards[shard]:
+                counts = self._pending[shard].setdefault(
+                    (row["tenant"], row["role"], row["model"], window_start), [0, 0, 0, 0.0]
+                )
+                counts[0] += row["calls"]
+                counts[1] += row["prompt_tokens"]
+                counts[2] += row["completion_tokens"]
+                counts[3] += row["latency_ms"] / 1000
+
+    def _reflect(self, rows: List[Dict[str, Any]]) -> None:
+        """Stop counting locally what a reload has brought into the stored totals."""
+        for row in rows:
+            window_start = datetime.fromisoformat(row["period_start"]).timestamp()
+            shard = self._shard(row["tenant"])
+            with self._shards[shard]:
+                start, roles = self._windows[shard].get(row["tenant"], (None, {}))
+                counts = roles.get(row["role"])
+                if start != window_start or counts is None:
+                    continue
+                counts[0] -= row["calls"]
+                counts[1] -= row["prompt_tokens"]
+                counts[2] -= row["completion_tokens"]
+                counts[3] -= row["latency_ms"] / 1000
+
+    def flush(self, sink: Callable[[List[Dict[str, Any]]], Any]) -> int:
+        """Write pending usage with `sink` in batches; rows of a failed batch are kept for the next flush."""
+        rows = self.drain()
+        written = len(rows)
+        for start in range(0, len(rows), METERING_FLUSH_BATCH):
+            batch = rows[start : start + METERING_FLUSH_BATCH]
+            try:
+                sink(batch)
+            except Exception as e:
+                self._restore(rows[start:])
+                log_event("usage_flush_failed", rows=len(rows) - start, error=str(e))
+                written = start
+                break
+        if written:
+            log_event("usage_flushed", rows=written)
+        if self._loader is None:
+            return written
+
+        self._unreflected.extend(rows[:written])
+        window_start = self._window_start()
+        tenants = set()
+        for shard, lock in enumerate(self._shards):
+            with lock:
+                for source in (self._windows[shard], self._stored[shard]):
+                    tenants.update(t for t, (start, _) in source.items() if start == window_start)
+        if self._load(sorted(tenants)):
+            unreflected, self._unreflected = self._unreflected, []
+            self._reflect(unreflected)
+        return written
+
+    def start(
+        self,
+        sink: Callable[[List[Dict[str, Any]]], Any],
+        loader: Optional[Callable[[List[str], str], List[Dict[str, Any]]]] = None,
+        interval: float = METERING_FLUSH_INTERVAL,
+    ) -> None:
+        """
+        Flush to `sink` every `interval` seconds from a background thread.
+
+        `loader(tenants, period_start)` returns the stored token_usage rows of
+        those tenants for the window starting at `period_start`.
+        """
+        if self._flusher is not None:
+            return
+        self._loader = loader
+
+        def run() -> None:
+            while not self._stopped.wait(interval):
+                self.flush(sink)
+            self.flush(sink)
+
+        self._flusher = threading.Thread(target=run, name="usage-flush", daemon=True)
+        self._flusher.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._flusher is not None:
+            self._flusher.join()
+
+    def install(self) -> None:
+        """Register the litellm callback that feeds this meter; safe to call repeatedly."""
+        if self._installed:
+            return
+        import litellm
+        from litellm.integrations.custom_logger import CustomLogger
+
+        meter = self
+
+        class UsageCallback(CustomLogger):
+            def log_success_event(self, kwargs, response_obj, start_time, end_time):
+                # async calls are recorded by async_log_success_event, in the caller's context
+                if not (kwargs.get("litellm_params") or {}).get("acompletion"):
+                    meter._record_response(kwargs, response_obj, start_time, end_time)
+
+            async def async_log_success_event(self, kwargs, response_obj, start_time, end_time):
+                completion_tokens = meter._record_response(kwargs, response_obj, start_time, end_time)
+                add_to_turn("completion_tokens", completion_tokens)
+
+        litellm.callbacks.append(UsageCallback())
+        self._installed = True
+
+    def _record_response(self, kwargs: Dict[str, Any], response: Any, start: Any, end: Any) -> int:
+        response = kwargs.get("complete_streaming_response") or response
+        metadata = (kwargs.get("litellm_params") or {}).get("metadata") or {}
+        prompt_tokens, completion_tokens = _usage(response)
+        self.record(
+            metadata.get("tenant"),
+            metadata.get("role") or "unknown",
+            kwargs.get("model") or "",
+            prompt_tokens,
+            completion_tokens,
+            _seconds(start, end),
+        )
+        return completion_tokens
+
+
+meter = UsageMeter()
@@ -0,0 +1,82 @@
+import contextvars
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class Metrics:
+    """
+    In-process counters and summaries, served as JSON by the /metrics endpoint.
+
+    Series are keyed by name and label values. A summary keeps count, sum, min
+    and max, which is enough for averages and worst cases without keeping
+    samples around.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, Tuple], float] = {}
+        self._summaries: Dict[Tuple[str, Tuple], List[float]] = {}
+
+    @staticmethod
+    def _key(name: str, labels: Dict[str, Any]) -> Tuple[str, Tuple]:
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels: Any) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is None:
+                self._summaries[key] = [1, value, value, value]
+            else:
+                summary[0] += 1
+                summary[1] += value
+                summary[2] = min(summary[2], value)
+                summary[3] = max(summary[3], value)
+
+    def counter(self, name: str, **labels: Any) -> float:
+        with self._lock:
+            return self._counters.get(self._key(name, labels), 0)
+
+    def snapshot(self) -> Dict[str, List[Dict[str, Any]]]:
+        result: Dict[str, List[Dict[str, Any]]] = {}
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                result.setdefault(name, []).append({"labels": dict(labels), "value": value})
+            for (name, labels), (count, total, low, high) in self._summaries.items():
+                result.setdefault(name, []).append(
+                    {
+                        "labels": dict(labels),
+                        "count": count,
+                        "sum": total,
+                        "avg": total / count,
+                        "min": low,
+                        "max": high,
+                    }
+                )
+        return result
+
+
+metrics = Metrics()
+
+
+_turn_totals: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar(
+    "turn_totals", default=None
+)
+
+
+def track_turn() -> Dict[str, float]:
+    """Collect add_to_turn() totals for the turn running in this context."""
+    totals: Dict[str, float] = {}
+    _turn_totals.set(totals)
+    return totals
+
+
+def add_to_turn(name: str, value: float) -> None:
+    totals = _turn_totals.get()
+    if totals is not None:
+        totals[name] = totals.get(name, 0) + value
@@ -1,32 +1,115 @@
-import re
-from typing import Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 from langchain.agents.agent import AgentOutputParser
 from langchain.agents.conversational.prompt import FORMAT_INSTRUCTIONS
 from langchain.schema import AgentAction, AgentFinish  # OutputParserException
 
+from server.logger import log_payload
+
+ACTION_PREFIX = "Action:"
+ACTION_INPUT_PREFIX = "Action Input:"
+
+
+class ToolCallAction(AgentAction):
+    """AgentAction produced from a native function/tool call."""
+
+    tool_call_id: str = ""
+    # tool calls returned by the same model response share a group id
+    group_id: str = ""
+
+
+def parse_agent_text(
+    text: str, ai_prefix: str = "AI", max_actions: int = 1
+) -> Union[AgentAction, List[AgentAction], AgentFinish]:
+    """
+    Single-pass parser for the text tool protocol of SALES_AGENT_TOOLS_PROMPT.
+
+    Each line is inspected once with plain prefix checks. Each "Action:" line
+    followed by an "Action Input:" line selects a tool call, up to
+    `max_actions` of them per planning step. Without actions, the first line
+    starting with "<ai_prefix>:" opens the final answer, which runs to the end
+    of the text, so a reply that mentions the salesperson's name again is
+    kept whole.
+    """
+    answer_prefix = f"{ai_prefix}:"
+    found_actions: List[Tuple[str, str]] = []
+    action: Optional[str] = None
+    answer_start: Optional[int] = None
+    offset = 0
+    for line in text.split("\n"):
+        line_start, offset = offset, offset + len(line) + 1
+        stripped = line.lstrip()
+        if stripped.startswith(ACTION_PREFIX):
+            action, found, action_input = stripped[len(ACTION_PREFIX) :].partition(
+                ACTION_INPUT_PREFIX
+            )
+            action = action.strip()
+            if not found:
+                continue
+        elif action is not None and stripped.startswith(ACTION_INPUT_PREFIX):
+            action_input = stripped[len(ACTION_INPUT_PREFIX) :]
+        else:
+            if not found_actions and action is None and stripped.startswith(answer_prefix):
+                answer_start = line_start + (len(line) - len(stripped)) + len(answer_prefix)
+                break
+            continue
+        found_actions.append((action, action_input.strip(" ").strip('"')))
+        action = None
+        if len(found_actions) >= max_actions:
+            break
+
+    if found_actions:
+        # the shared log is kept once so the scratchpad does not repeat it
+        actions = [
+            AgentAction(tool, tool_input, text if i == 0 else "")
+            for i, (tool, tool_input) in enumerate(found_actions)
+        ]
+        return actions[0] if len(actions) == 1 else actions
+    if answer_start is not None:
+        output = text[answer_start:]
+    else:
+        # no protocol lines at all: the model answered directly
+        output = text
+    return AgentFinish({"output": output.strip()}, text)
+
+
 class SalesConvoOutputParser(AgentOutputParser):
     ai_prefix: str = "AI"
     verbose: bool = False
+    max_actions: int = 1
 
     def get_format_instructions(self) -> str:
         return FORMAT_INSTRUCTIONS
 
-    def parse(self, text: str) -> Union[AgentAction, AgentFinish]:
+    def parse(self, text: str) -> Union[AgentAction, List[AgentAction], AgentFinish]:
         if self.verbose:
-            print("TEXT")
-            print(text)
-            print("-------")
-        regex = r"Action: (.*?)[\n]*Action Input: (.*)"
-        match = re.search(regex, text)
-        if not match:
-            return AgentFinish(
-                {"output": text.split(f"{self.ai_prefix}:")[-1].strip()}, text
-            )
-        action = match.group(1)
-        action_input = match.group(2)
-        return AgentAction(action.strip(), action_input.strip(" ").strip('"'), text)
+            log_payload("agent_output", text=text)
+        return parse_agent_text(text, ai_prefix=self.ai_prefix, max_actions=self.max_actions)
 
     @property
     def _type(self) -> str:
         return "sales-agent"
+
+
+def agent_actions(intermediate_steps: List[Any]) -> List[Dict[str, Any]]:
+    """
+    Flatten executor (AgentAction, observation) steps into plain dicts.
+
+    This is the parse result handed back to the API layer, so nothing
+    downstream has to re-read the raw LLM log.
+    """
+    actions = []
+    for step in intermediate_steps:
+        if not isinstance(step, tuple) or len(step) != 2:
+            continue
+        action, observation = step
+        if not isinstance(action, AgentAction):
+            continue
+        actions.append(
+            {
+                "tool": action.tool,
+                "tool_input": action.tool_input,
+                "observation": observation,
+            }
+        )
+    return actions
@@ -0,0 +1,123 @@
+import asyncio
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Callable, Optional
+
+from server.logger import log_event
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", ".profiles")
+# Seconds between stack samples; 5ms costs well under 1% of a core
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+
+# Orders accepted by profile_report
+PROFILE_SORT_KEYS = sorted(key.value for key in pstats.SortKey)
+
+
+def admin_allowed(token: Optional[str]) -> bool:
+    # ADMIN_TOKEN guards the profiling endpoints and the X-Profile header; unset disables both
+    admin_token = os.getenv("ADMIN_TOKEN", "")
+    return bool(admin_token) and token == admin_token
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler: a background thread records every thread's stack
+    each `interval` seconds.
+
+    Nothing is installed in the profiled threads, so the cost is the sampler
+    thread's own work while it runs and zero otherwise. Output is the
+    collapsed-stack format read by flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, interval: float = PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self._busy = threading.Lock()
+
+    def _sample(self, seconds: float) -> Counter:
+        stacks: Counter = Counter()
+        me = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                stacks[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+        return stacks
+
+    async def collapsed(self, seconds: float) -> str:
+        """Sample for `seconds` and return one "frame;frame;frame count" line per stack."""
+        seconds = min(seconds, PROFILE_MAX_SECONDS)
+        if not self._busy.acquire(blocking=False):
+            raise RuntimeError("A profile is already running")
+        try:
+            log_event("profile_started", seconds=seconds)
+            loop = asyncio.get_running_loop()
+            stacks = await loop.run_in_executor(None, self._sample, seconds)
+        finally:
+            self._busy.release()
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+sampler = SamplingProfiler()
+
+_request_profile = threading.Lock()
+
+
+def start_request_profile(request_id: str) -> Optional[Callable[[], None]]:
+    """
+    Start cProfiling the code run on this thread.
+
+    Returns the function that stops and saves the profile, which may be
+    called more than once, or None if another request is being profiled.
+    On an event loop this includes every coroutine the loop runs meanwhile,
+    not only the profiled request's; thread pool work is not included.
+    """
+    if not _request_profile.acquire(blocking=False):
+        return None
+    profile = cProfile.Profile()
+    stopped = False
+
+    def stop() -> None:
+        nonlocal stopped
+        if stopped:
+            return
+        stopped = True
+        try:
+            profile.disable()
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            profile.dump_stats(os.path.join(PROFILE_DIR, f"{request_id}.prof"))
+            log_event("request_profiled", profile_id=request_id)
+        finally:
+            _request_profile.release()
+
+    profile.enable()
+    return stop
+
+
+def profile_report(profile_id: str, limit: int = 60, sort: str = "cumulative") -> Optional[str]:
+    """pstats text of a saved request profile; `sort` is one of PROFILE_SORT_KEYS."""
+    path = os.path.join(PROFILE_DIR, f"{os.path.basename(profile_id)}.prof")
+    if not os.path.exists(path):
+        return None
+    out = io.StringIO()
+    pstats.Stats(path, stream=out).sort_stats(sort).print_stats(limit)
+    return out.getvalue()
@@ -0,0 +1,197 @@
+import base64
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from fastapi import Request, Response
+
+from server.metrics import metrics
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+READ_PAGE_SIZE = int(os.getenv("READ_PAGE_SIZE", "50"))
+READ_MAX_PAGE_SIZE = int(os.getenv("READ_MAX_PAGE_SIZE", "500"))
+# Seconds a read page is served from memory before the database is asked again
+READ_CACHE_TTL = float(os.getenv("READ_CACHE_TTL", "2"))
+# Smaller bodies are sent uncompressed; the framing would cost more than it saves
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+
+# Keyset pagination orders by these columns, so every page query selects them
+KEYSET = ("created_at", "id")
+
+
+def dumps(payload: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(payload, default=str)
+    return json.dumps(payload, default=str, separators=(",", ":")).encode("utf-8")
+
+
+def projection(
+    fields: Optional[str], allowed: Sequence[str], default: Sequence[str]
+) -> List[str]:
+    """Columns requested with ?fields=a,b, restricted to `allowed`."""
+    if not fields:
+        return list(default)
+    requested = list(dict.fromkeys(f.strip() for f in fields.split(",") if f.strip()))
+    unknown = [field for field in requested if field not in allowed]
+    if unknown:
+        raise ValueError(
+            f"Unknown fields: {', '.join(unknown)}. Expected any of {', '.join(allowed)}"
+        )
+    return requested
+
+
+def encode_cursor(row: Dict[str, Any]) -> str:
+    raw = json.dumps([row["created_at"], row["id"]], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[str, int]:
+    """
+    The (created_at, id) a cursor points after.
+
+    Cursors come from clients and end up inside a PostgREST filter, so
+    anything but a timestamp and an integer id is rejected.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, row_id = json.loads(raw)
+        created_at = datetime.fromisoformat(created_at).isoformat()
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if type(row_id) is not int:
+        raise ValueError("Invalid cursor")
+    return created_at, row_id
+
+
+def page_limit(limit: Optional[int]) -> int:
+    return max(1, min(limit or READ_PAGE_SIZE, READ_MAX_PAGE_SIZE))
+
+
+def paginate(query: Any, cursor: Optional[str], limit: int) -> Any:
+    """
+    Apply (created_at, id) keyset pagination to a PostgREST select.
+
+    One extra row is fetched to tell whether there is a next page.
+    """
+    if cursor:
+        created_at, row_id = decode_cursor(cursor)
+        query = query.or_(
+            f'created_at.gt."{created_at}",'
+            f'and(created_at.eq."{created_at}",id.gt.{row_id})'
+        )
+    return query.order("created_at").order("id").limit(limit + 1)
+
+
+def page(rows: List[Dict[str, Any]], limit: int, fields: Sequence[str]) -> Dict[str, Any]:
+    """Response body for one page, with keyset columns the caller did not ask for removed."""
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    rows = rows[:limit]
+    extra = [column for column in KEYSET if column not in fields]
+    if extra:
+        rows = [{k: v for k, v in row.items() if k not in extra} for row in rows]
+    return {"data": rows, "next_cursor": next_cursor}
+
+
+class ReadCache:
+    """
+    Serialized read responses, kept for `ttl` seconds.
+
+    Entries are keyed by a scope such as ("conversations", session_id) plus the
+    query parameters; writes made by this process invalidate their scope, so
+    only other processes' writes can be up to `ttl` late.
+    """
+
+    def __init__(self, ttl: float = READ_CACHE_TTL, max_entries: int = 2048):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: Dict[Tuple, Tuple[float, str, bytes]] = {}
+
+    def get(self, scope: Tuple, params: Tuple) -> Optional[Tuple[str, bytes]]:
+        with self._lock:
+            entry = self._entries.get((scope, params))
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1], entry[2]
+
+    def put(self, scope: Tuple, params: Tuple, etag: str, body: bytes) -> None:
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                now = time.monotonic()
+                for key in [k for k, entry in self._entries.items() if entry[0] < now]:
+                    del self._entries[key]
+                while len(self._entries) >= self.max_entries:
+                    del self._entries[next(iter(self._entries))]
+            self._entries[(scope, params)] = (time.monotonic() + self.ttl, etag, body)
+
+    def invalidate(self, scope: Tuple) -> None:
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == scope]:
+                del self._entries[key]
+
+
+read_cache = ReadCache()
+
+
+def etag_for(body: bytes) -> str:
+    return f'W/"{hashlib.blake2b(body, digest_size=12).hexdigest()}"'
+
+
+def _not_modified(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match", "")
+    return etag in (tag.strip() for tag in header.split(",")) or header.strip() == "*"
+
+
+def _encode(request: Request, body: bytes) -> Tuple[bytes, Optional[str]]:
+    if len(body) < COMPRESS_MIN_BYTES:
+        return body, None
+    accepted = request.headers.get("accept-encoding", "")
+    if brotli is not None and "br" in accepted:
+        return brotli.compress(body, quality=4), "br"
+    if "gzip" in accepted:
+        return gzip.compress(body, compresslevel=5), "gzip"
+    return body, None
+
+
+def cached_read(request: Request, scope: Tuple, params: Tuple, load) -> Response:
+    """
+    Serve a read endpoint with ETag revalidation and compression.
+
+    `load()` queries the database and returns the JSON payload; it only runs
+    when the page is not in the read cache. A client whose If-None-Match
+    matches gets an empty 304.
+    """
+    cached = read_cache.get(scope, params)
+    if cached is None:
+        metrics.inc("read_cache", outcome="miss", resource=scope[0])
+        body = dumps(load())
+        etag = etag_for(body)
+        read_cache.put(scope, params, etag, body)
+    else:
+        metrics.inc("read_cache", outcome="hit", resource=scope[0])
+        etag, body = cached
+
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if _not_modified(request, etag):
+        metrics.inc("read_not_modified", resource=scope[0])
+        return Response(status_code=304, headers=headers)
+    body, encoding = _encode(request, body)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type="application/json", headers=headers)
@@ -0,0 +1,462 @@
+import asyncio
+import hashlib
+import os
+import socket
+import struct
+import threading
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from server.embedding_cache import cached_embeddings
+from server.logger import log_event
+from server.vector_index import VectorIndex, normalize
+
+# Unix socket of the retrieval sidecar; empty keeps indexes in each worker
+RETRIEVAL_SOCKET = os.getenv("RETRIEVAL_SOCKET", "")
+# Where the sidecar persists catalog indexes
+RETRIEVAL_DIR = os.getenv("RETRIEVAL_DIR", ".retrieval")
+# How long the sidecar waits to gather queries into one embedding call
+RETRIEVAL_BATCH_WINDOW = float(os.getenv("RETRIEVAL_BATCH_WINDOW", "0.002"))
+RETRIEVAL_MAX_BATCH = int(os.getenv("RETRIEVAL_MAX_BATCH", "64"))
+RETRIEVAL_TIMEOUT = float(os.getenv("RETRIEVAL_TIMEOUT", "10"))
+
+# Wire format. Every frame is a uint32 body length followed by the body; all
+# integers are big-endian, strings are utf-8 with a uint16/uint32 length.
+#
+# request body:   op u8, request id u32, then
+#   SEARCH        tenant str16, k u16, count u16, count x query str32
+#   BUILD         tenant str16, catalog str32
+#   PING          -
+# response body:  status u8, request id u32, then
+#   SEARCH ok     count u16, per query: hits u16, per hit: score f32, chunk u32, text str32
+#   BUILD ok      chunks u32
+#   error         message str32
+OP_SEARCH, OP_BUILD, OP_PING = 1, 2, 3
+STATUS_OK, STATUS_ERROR, STATUS_UNKNOWN_INDEX = 0, 1, 2
+
+_LENGTH = struct.Struct("!I")
+_HEAD = struct.Struct("!BI")
+_HIT = struct.Struct("!fI")
+
+
+class RetrievalError(RuntimeError):
+    pass
+
+
+class UnknownIndex(RetrievalError):
+    """The sidecar has no index for the tenant yet; send BUILD first."""
+
+
+def catalog_key(product_catalog: str) -> str:
+    """Indexes are keyed by catalog content, so an edited catalog is a new index."""
+    return hashlib.sha256((product_catalog or "").encode("utf-8")).hexdigest()[:32]
+
+
+def split_catalog(product_catalog: str) -> List[str]:
+    from langchain.text_splitter import CharacterTextSplitter
+
+    # same chunking as the in-process knowledge base
+    return CharacterTextSplitter(chunk_size=10, chunk_overlap=0).split_text(
+        product_catalog or ""
+    )
+
+
+def _str(value: str, width: str = "I") -> bytes:
+    data = value.encode("utf-8")
+    return struct.pack(f"!{width}", len(data)) + data
+
+
+class _Reader:
+    def __init__(self, body: bytes):
+        self.body = body
+        self.offset = 0
+
+    def unpack(self, fmt: struct.Struct) -> Tuple:
+        values = fmt.unpack_from(self.body, self.offset)
+        self.offset += fmt.size
+        return values
+
+    def int(self, width: str) -> int:
+        return self.unpack(struct.Struct(f"!{width}"))[0]
+
+    def str(self, width: str = "I") -> str:
+        length = self.int(width)
+        value = self.body[self.offset : self.offset + length].decode("utf-8")
+        self.offset += length
+        return value
+
+
+def _frame(body: bytes) -> bytes:
+    return _LENGTH.pack(len(body)) + body
+
+
+def encode_search(request_id: int, tenant: str, queries: Sequence[str], k: int) -> bytes:
+    body = _HEAD.pack(OP_SEARCH, request_id) + _str(tenant, "H")
+    body += struct.pack("!HH", k, len(queries)) + b"".join(_str(query) for query in queries)
+    return _frame(body)
+
+
+def encode_build(request_id: int, tenant: str, product_catalog: str) -> bytes:
+    return _frame(_HEAD.pack(OP_BUILD, request_id) + _str(tenant, "H") + _str(product_catalog))
+
+
+def decode_response(body: bytes, op: int) -> Any:
+    reader = _Reader(body)
+    status, _ = reader.unpack(_HEAD)
+    if status == STATUS_UNKNOWN_INDEX:
+        raise UnknownIndex(reader.str())
+    if status != STATUS_OK:
+        raise RetrievalError(reader.str())
+    if op == OP_BUILD:
+        return reader.int("I")
+    if op == OP_PING:
+        return True
+    results = []
+    for _ in range(reader.int("H")):
+        hits = []
+        for _ in range(reader.int("H")):
+            score, chunk = reader.unpack(_HIT)
+            hits.append((score, chunk, reader.str()))
+        results.append(hits)
+    return results
+
+
+class QueryBatcher:
+    """
+    Gathers query texts from concurrent requests into one embedding call.
+
+    A batch is sent after RETRIEVAL_BATCH_WINDOW or once it holds
+    RETRIEVAL_MAX_BATCH texts, whichever comes first.
+    """
+
+    def __init__(
+        self,
+        embed: Callable[[List[str]], List[List[float]]],
+        window: float = RETRIEVAL_BATCH_WINDOW,
+        max_batch: int = RETRIEVAL_MAX_BATCH,
+    ):
+        self.embed_texts = embed
+        self.window = window
+        self.max_batch = max_batch
+        self._pending: List[Tuple[List[str], asyncio.Future]] = []
+        self._size = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((texts, future))
+        self._size += len(texts)
+        if self._size >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending, self._size = self._pending, [], 0
+        if pending:
+            asyncio.ensure_future(self._run(pending))
+
+    async def _run(self, pending: List[Tuple[List[str], asyncio.Future]]) -> None:
+        texts = [text for batch, _ in pending for text in batch]
+        try:
+            vectors = await asyncio.get_running_loop().run_in_executor(
+                None, self.embed_texts, texts
+            )
+            vectors = normalize(vectors)
+        except Exception as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        start = 0
+        for batch, future in pending:
+            if not future.done():
+                future.set_result(vectors[start : start + len(batch)])
+            start += len(batch)
+
+
+class RetrievalServer:
+    """
+    The sidecar: owns every tenant's catalog index and answers workers.
+
+    Indexes are built once per catalog, persisted under `data_dir` and
+    memory-mapped on load, so memory grows with tenants and not with
+    workers. Query embeddings from all workers are batched.
+    """
+
+    def __init__(self, data_dir: str = RETRIEVAL_DIR, embeddings: Any = None):
+        if embeddings is None:
+            from langchain_openai import OpenAIEmbeddings
+
+            embeddings = cached_embeddings(OpenAIEmbeddings())
+        self.data_dir = data_dir
+        self.embeddings = embeddings
+        self.indexes: Dict[str, VectorIndex] = {}
+        self._builds: Dict[str, asyncio.Task] = {}
+        self.batcher = QueryBatcher(embeddings.embed_documents)
+
+    def _path(self, tenant: str) -> str:
+        return os.path.join(self.data_dir, tenant)
+
+    def index(self, tenant: str) -> Optional[VectorIndex]:
+        index = self.indexes.get(tenant)
+        if index is None and os.path.isdir(self._path(tenant)):
+            index = self.indexes[tenant] = VectorIndex.load(self._path(tenant))
+        return index
+
+    async def build(self, tenant: str, product_catalog: str) -> VectorIndex:
+        index = self.index(tenant)
+        if index is not None:
+            return index
+        # concurrent BUILDs of the same catalog share one embedding run
+        task = self._builds.get(tenant)
+        if task is None:
+            task = asyncio.ensure_future(self._build(tenant, product_catalog))
+            self._builds[tenant] = task
+            task.add_done_callback(lambda _: self._builds.pop(tenant, None))
+        return await task
+
+    async def _build(self, tenant: str, product_catalog: str) -> VectorIndex:
+        loop = asyncio.get_running_loop()
+        chunks = split_catalog(product_catalog)
+        index = await loop.run_in_executor(
+            None, VectorIndex.from_texts, chunks, self.embeddings
+        )
+        await loop.run_in_executor(None, index.save, self._path(tenant))
+        self.indexes[tenant] = VectorIndex.load(self._path(tenant))
+        log_event("retrieval_index_built", tenant=tenant, chunks=len(chunks))
+        return self.indexes[tenant]
+
+    async def search(self, tenant: str, queries: List[str], k: int) -> List[List[Tuple]]:
+        index = self.index(tenant)
+        if index is None:
+            raise UnknownIndex(f"No index for {tenant}")
+        vectors = await self.batcher.embed(queries)
+        return [
+            [(score, chunk, index.texts[chunk]) for score, chunk in hits]
+            for hits in index.search(vectors, k)
+        ]
+
+    async def handle(self, body: bytes) -> bytes:
+        reader = _Reader(body)
+        op, request_id = reader.unpack(_HEAD)
+        try:
+            if op == OP_PING:
+                return _frame(_HEAD.pack(STATUS_OK, request_id))
+            tenant = reader.str("H")
+            if op == OP_BUILD:
+                index = await self.build(tenant, reader.str())
+                return _frame(_HEAD.pack(STATUS_OK, request_id) + struct.pack("!I", len(index)))
+            if op == OP_SEARCH:
+                k, count = reader.unpack(struct.Struct("!HH"))
+                queries = [reader.str() for _ in range(count)]
+                results = await self.search(tenant, queries, k)
+                out = [_HEAD.pack(STATUS_OK, request_id), struct.pack("!H", len(results))]
+                for hits in results:
+                    out.append(struct.pack("!H", len(hits)))
+                    for score, chunk, text in hits:
+                        out.append(_HIT.pack(score, chunk) + _str(text))
+                return _frame(b"".join(out))
+            raise RetrievalError(f"Unknown op {op}")
+        except UnknownIndex as e:
+            return _frame(_HEAD.pack(STATUS_UNKNOWN_INDEX, request_id) + _str(str(e)))
+        except Exception as e:
+            return _frame(_HEAD.pack(STATUS_ERROR, request_id) + _str(f"{type(e).__name__}: {e}"))
+
+    async def _connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    (length,) = _LENGTH.unpack(await reader.readexactly(_LENGTH.size))
+                except asyncio.IncompleteReadError:
+                    return
+                writer.write(await self.handle(await reader.readexactly(length)))
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, socket_path: str = RETRIEVAL_SOCKET) -> None:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = await asyncio.start_unix_server(self._connection, path=socket_path)
+        log_event("retrieval_sidecar_started", socket=socket_path, data_dir=self.data_dir)
+        async with server:
+            await server.serve_forever()
+
+
+class RetrievalClient:
+    """
+    Worker side of the sidecar protocol.
+
+    Sync calls keep one blocking connection per thread; async calls open a
+    connection per request, which over a Unix socket costs microseconds.
+    """
+
+    def __init__(self, socket_path: str = RETRIEVAL_SOCKET, timeout: float = RETRIEVAL_TIMEOUT):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._request_id = 0
+
+    def _next_id(self) -> int:
+        self._request_id = (self._request_id + 1) % 2**32
+        return self._request_id
+
+    def _socket(self) -> socket.socket:
+        sock = getattr(self._local, "sock", None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            self._local.sock = sock
+        return sock
+
+    def _recv_exactly(self, sock: socket.socket, size: int) -> bytes:
+        data = bytearray()
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise RetrievalError("Retrieval sidecar closed the connection")
+            data += chunk
+        return bytes(data)
+
+    def _call(self, frame: bytes, op: int) -> Any:
+        try:
+            sock = self._socket()
+            sock.sendall(frame)
+            (length,) = _LENGTH.unpack(self._recv_exactly(sock, _LENGTH.size))
+            body = self._recv_exactly(sock, length)
+        except (OSError, RetrievalError):
+            # drop the connection so the next call reconnects
+            sock = getattr(self._local, "sock", None)
+            if sock is not None:
+                sock.close()
+            self._local.sock = None
+            raise
+        return decode_response(body, op)
+
+    async def _acall(self, frame: bytes, op: int) -> Any:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_unix_connection(self.socket_path), self.timeout
+        )
+        try:
+            writer.write(frame)
+            await writer.drain()
+            (length,) = _LENGTH.unpack(
+                await asyncio.wait_for(reader.readexactly(_LENGTH.size), self.timeout)
+            )
+            body = await asyncio.wait_for(reader.readexactly(length), self.timeout)
+        finally:
+            writer.close()
+        return decode_response(body, op)
+
+    def build(self, tenant: str, product_catalog: str) -> int:
+        return self._call(encode_build(self._next_id(), tenant, product_catalog), OP_BUILD)
+
+    async def abuild(self, tenant: str, product_catalog: str) -> int:
+        return await self._acall(encode_build(self._next_id(), tenant, product_catalog), OP_BUILD)
+
+    def search(self, tenant: str, queries: Sequence[str], k: int = 4) -> List[List[Tuple]]:
+        return self._call(encode_search(self._next_id(), tenant, queries, k), OP_SEARCH)
+
+    async def asearch(self, tenant: str, queries: Sequence[str], k: int = 4) -> List[List[Tuple]]:
+        return await self._acall(encode_search(self._next_id(), tenant, queries, k), OP_SEARCH)
+
+
+class SidecarRetriever(BaseRetriever):
+    """Retriever for RetrievalQA that searches the tenant's index in the sidecar."""
+
+    client: Any
+    tenant: str
+    product_catalog: str
+    k: int = 4
+
+    @staticmethod
+    def _documents(hits: List[Tuple]) -> List[Document]:
+        return [
+            Document(page_content=text, metadata={"score": score, "chunk": chunk})
+            for score, chunk, text in hits
+        ]
+
+    def _check_rebuildable(self) -> None:
+        if catalog_key(self.product_catalog) != self.tenant:
+            # a previous catalog's index; rebuilding it from this catalog would mislabel it
+            raise UnknownIndex(f"No index for {self.tenant}")
+
+    def _get_relevant_documents(self, query: str, *, run_manager: Any = None) -> List[Document]:
+        try:
+            hits = self.client.search(self.tenant, [query], self.k)[0]
+        except UnknownIndex:
+            # the sidecar lost its data directory; rebuild once
+            self._check_rebuildable()
+            self.client.build(self.tenant, self.product_catalog)
+            hits = self.client.search(self.tenant, [query], self.k)[0]
+        return self._documents(hits)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: Any = None
+    ) -> List[Document]:
+        try:
+            hits = (await self.client.asearch(self.tenant, [query], self.k))[0]
+        except UnknownIndex:
+            self._check_rebuildable()
+            await self.client.abuild(self.tenant, self.product_catalog)
+            hits = (await self.client.asearch(self.tenant, [query], self.k))[0]
+        return self._documents(hits)
+
+
+_clients: Dict[str, RetrievalClient] = {}
+# catalog keys this process has asked the sidecar to build, with the pending requests
+_warmed: Set[str] = set()
+_warming: Set[asyncio.Future] = set()
+
+
+def shared_client(socket_path: str = RETRIEVAL_SOCKET) -> RetrievalClient:
+    """One client per sidecar socket, so its per-thread connections are reused across requests."""
+    client = _clients.get(socket_path)
+    if client is None:
+        client = _clients.setdefault(socket_path, RetrievalClient(socket_path))
+    return client
+
+
+async def _warm(client: RetrievalClient, key: str, product_catalog: str) -> None:
+    try:
+        await client.abuild(key, product_catalog)
+    except (OSError, asyncio.TimeoutError, RetrievalError) as e:
+        # the first search builds it instead
+        _warmed.discard(key)
+        log_event("retrieval_warm_failed", tenant=key, error=str(e))
+
+
+def sidecar_retriever(
+    product_catalog: str, socket_path: str = RETRIEVAL_SOCKET, key: Optional[str] = None
+) -> SidecarRetriever:
+    """
+    Retriever for the catalog's index in the sidecar, without waiting for it.
+
+    `key` names an index already built on disk, e.g. by the ingestion worker.
+    Otherwise the first call for a catalog asks the sidecar to build it in the
+    background when an event loop is running; a search that still finds no
+    index builds it itself.
+    """
+    client = shared_client(socket_path)
+    tenant = key or catalog_key(product_catalog)
+    if tenant == catalog_key(product_catalog) and tenant not in _warmed:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is not None:
+            _warmed.add(tenant)
+            task = loop.create_task(_warm(client, tenant, product_catalog))
+            _warming.add(task)
+            task.add_done_callback(_warming.discard)
+    return SidecarRetriever(client=client, tenant=tenant, product_catalog=product_catalog)
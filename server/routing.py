@@ -0,0 +1,139 @@
+import os
+from typing import Any, Dict, List, Optional
+
+from langchain_community.chat_models import ChatLiteLLM
+from pydantic import BaseModel
+
+from server.generation import GENERATION_POLICIES
+from server.hedging import HEDGE_BUDGET, HedgedChatLiteLLM
+
+ROLES = ("stage_analyzer", "tool_planner", "utterance", "kb_qa")
+
+
+class ModelRoute(BaseModel):
+    """Model and generation settings used for one role of the sales agent."""
+
+    model: str
+    temperature: float = 0.2
+    max_tokens: Optional[int] = None
+    stop: List[str] = []
+    # secondary model raced against `model` on slow or failed calls
+    hedge_model: Optional[str] = None
+    hedge_budget: float = HEDGE_BUDGET
+
+
+def default_routes(default_model: str) -> Dict[str, Dict[str, Any]]:
+    """
+    Server-wide defaults, overridable per role with <ROLE>_MODEL env variables.
+
+    Token caps and stop sequences come from the role's generation policy.
+    <ROLE>_HEDGE_MODEL names a secondary model to hedge the role's calls to.
+    """
+    models = {
+        "stage_analyzer": {
+            "model": os.getenv("STAGE_ANALYZER_MODEL", default_model),
+            "temperature": 0.0,
+        },
+        "tool_planner": {
+            "model": os.getenv("TOOL_PLANNER_MODEL", default_model),
+            "temperature": 0.2,
+        },
+        "utterance": {
+            "model": os.getenv("UTTERANCE_MODEL", default_model),
+            "temperature": 0.2,
+        },
+        "kb_qa": {
+            "model": os.getenv("KB_QA_MODEL", "gpt-4-0125-preview"),
+            "temperature": 0.0,
+        },
+    }
+    for role, settings in models.items():
+        settings["hedge_model"] = os.getenv(f"{role.upper()}_HEDGE_MODEL") or None
+    return {
+        role: {**GENERATION_POLICIES[role], **settings}
+        for role, settings in models.items()
+    }
+
+
+class ModelRouter:
+    """Resolves which model, token cap and stop sequences each role uses."""
+
+    def __init__(self, routes: Dict[str, ModelRoute], tenant: Any = None):
+        self.routes = routes
+        self.tenant = tenant
+
+    @classmethod
+    def from_config(
+        cls,
+        routing_config: Optional[Dict[str, Any]] = None,
+        default_model: str = "gpt-3.5-turbo",
+        tenant: Any = None,
+    ) -> "ModelRouter":
+        """
+        Build a router from the tenant's `model_routing` config section.
+
+        Each role in the section is merged over the server defaults, e.g.
+        {"stage_analyzer": {"model": "gpt-3.5-turbo"}, "utterance": {"max_tokens": 200}}.
+        """
+        routing_config = routing_config or {}
+        unknown = set(routing_config) - set(ROLES)
+        if unknown:
+            raise ValueError(
+                f"Unknown model_routing roles: {', '.join(sorted(unknown))}. Expected one of {', '.join(ROLES)}"
+            )
+
+        routes = {}
+        for role, defaults in default_routes(default_model).items():
+            settings = dict(defaults)
+            settings.update(routing_config.get(role) or {})
+            routes[role] = ModelRoute(**settings)
+        return cls(routes, tenant=tenant)
+
+    def degraded(self, model: str) -> "ModelRouter":
+        """Copy of this router sending every role to `model`, without hedging."""
+        routes = {
+            role: route.copy(update={"model": model, "hedge_model": None})
+            for role, route in self.routes.items()
+        }
+        return ModelRouter(routes, tenant=self.tenant)
+
+    def route(self, role: str) -> ModelRoute:
+        return self.routes[role]
+
+    def metadata(self, role: str) -> Dict[str, Any]:
+        """litellm metadata attributing a call's token usage to the tenant and role."""
+        return {"tenant": self.tenant, "role": role}
+
+    def llm(self, role: str, with_stop: bool = True) -> ChatLiteLLM:
+        """
+        Create the chat model for a role.
+
+        Pass with_stop=False when the caller supplies its own stop sequences
+        (e.g. the tools agent), since litellm rejects stop in both places.
+        """
+        route = self.route(role)
+        params: Dict[str, Any] = {"model": route.model, "temperature": route.temperature}
+        if route.max_tokens is not None:
+            params["max_tokens"] = route.max_tokens
+        params["model_kwargs"] = {"metadata": self.metadata(role)}
+        if with_stop and route.stop:
+            params["model_kwargs"]["stop"] = route.stop
+        if route.hedge_model:
+            return HedgedChatLiteLLM(
+                hedge_role=role,
+                hedge_model=route.hedge_model,
+                hedge_budget=route.hedge_budget,
+                **params,
+            )
+        return ChatLiteLLM(**params)
+
+    def describe(self) -> Dict[str, Dict[str, Any]]:
+        """Routing summary returned in response metadata."""
+        return {
+            role: {
+                "model": route.model,
+                "max_tokens": route.max_tokens,
+                "hedge_model": route.hedge_model,
+            }
+            for role, route in self.routes.items()
+        }
@@ -0,0 +1,130 @@
+import asyncio
+import contextvars
+import os
+import re
+from typing import Any, List, Optional
+
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from server.logger import log_event
+from server.metrics import metrics
+
+SPECULATIVE_RETRIEVAL = os.getenv("SPECULATIVE_RETRIEVAL", "True").lower() in ["true", "1", "t"]
+# Share of the tool query's words that must appear in the prefetched query to reuse it
+SPECULATIVE_QUERY_OVERLAP = float(os.getenv("SPECULATIVE_QUERY_OVERLAP", "0.6"))
+# Top chunk score above which an unused prefetch is offered to later planning rounds
+SPECULATIVE_CONTEXT_SCORE = float(os.getenv("SPECULATIVE_CONTEXT_SCORE", "0.8"))
+
+STOP_WORDS = {
+    "a", "an", "and", "any", "are", "about", "can", "do", "does", "for", "have", "i",
+    "is", "it", "me", "my", "of", "on", "or", "the", "to", "what", "with", "you", "your",
+}
+
+_prefetch: contextvars.ContextVar[Optional["Prefetch"]] = contextvars.ContextVar(
+    "prefetch", default=None
+)
+
+
+def query_words(text: str) -> set:
+    return {word for word in re.findall(r"[a-z0-9]+", text.lower()) if word not in STOP_WORDS}
+
+
+def query_overlap(tool_query: str, prefetched_query: str) -> float:
+    """Share of the tool query's content words that the prefetched query contains."""
+    wanted = query_words(tool_query)
+    if not wanted:
+        return 0.0
+    return len(wanted & query_words(prefetched_query)) / len(wanted)
+
+
+class Prefetch:
+    """Catalog retrieval started from the raw user input, before the planner picks a query."""
+
+    def __init__(self, retriever: "SpeculativeRetriever", query: str):
+        self.retriever = retriever
+        self.query = query
+        self.used = False
+        self.task = asyncio.ensure_future(retriever.retriever.aget_relevant_documents(query))
+
+    def matches(self, retriever: "SpeculativeRetriever", query: str) -> bool:
+        return retriever is self.retriever and (
+            query_overlap(query, self.query) >= SPECULATIVE_QUERY_OVERLAP
+        )
+
+    def documents(self) -> Optional[List[Document]]:
+        """The prefetched documents if retrieval already finished cleanly."""
+        if not self.task.done() or self.task.cancelled() or self.task.exception():
+            return None
+        return self.task.result()
+
+
+def start_prefetch(retriever: "SpeculativeRetriever", query: str) -> Prefetch:
+    """Start retrieving for `query` and make it visible to this turn's tool calls."""
+    prefetch = Prefetch(retriever, query)
+    _prefetch.set(prefetch)
+    return prefetch
+
+
+def finish_prefetch(prefetch: Optional[Prefetch]) -> None:
+    """End the turn's speculation, cancelling a retrieval nobody used."""
+    if prefetch is None:
+        return
+    _prefetch.set(None)
+    if not prefetch.used:
+        metrics.inc("speculative_retrieval", outcome="unused")
+        prefetch.task.cancel()
+    if prefetch.task.done() and not prefetch.task.cancelled():
+        # mark a failed prefetch's error as retrieved
+        prefetch.task.exception()
+
+
+def speculative_context(max_documents: int = 2) -> Optional[str]:
+    """
+    Prefetched chunks worth showing a later planning round, if any.
+
+    Only chunks from a finished prefetch that no tool call consumed and whose
+    retriever scores them above SPECULATIVE_CONTEXT_SCORE qualify. Both the
+    text and the structured agents ask for it after a tool step. Retrievers
+    that set no score, e.g. the Chroma one used for oversized catalogs,
+    never qualify.
+    """
+    prefetch = _prefetch.get()
+    if prefetch is None or prefetch.used:
+        return None
+    documents = prefetch.documents() or []
+    relevant = [
+        document.page_content
+        for document in documents[:max_documents]
+        if document.metadata.get("score", 0.0) >= SPECULATIVE_CONTEXT_SCORE
+    ]
+    if not relevant:
+        return None
+    metrics.inc("speculative_retrieval", outcome="injected")
+    return "\n".join(relevant)
+
+
+class SpeculativeRetriever(BaseRetriever):
+    """Catalog retriever that answers from the turn's prefetch when the query is close enough."""
+
+    retriever: Any
+
+    def _get_relevant_documents(self, query: str, *, run_manager: Any = None) -> List[Document]:
+        return self.retriever.get_relevant_documents(query)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: Any = None
+    ) -> List[Document]:
+        prefetch = _prefetch.get()
+        if prefetch is not None and prefetch.matches(self, query):
+            try:
+                documents = await asyncio.shield(prefetch.task)
+            except Exception as e:
+                log_event("speculative_retrieval_failed", error=str(e))
+            else:
+                prefetch.used = True
+                metrics.inc("speculative_retrieval", outcome="hit")
+                return documents
+        if prefetch is not None:
+            metrics.inc("speculative_retrieval", outcome="miss")
+        return await self.retriever.aget_relevant_documents(query)
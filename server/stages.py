@@ -8,3 +8,26 @@ CONVERSATION_STAGES = {
     "7": "Close: Ask for the sale by proposing a next step. This could be a demo, a trial or a meeting with decision-makers. Ensure to summarize what has been discussed and reiterate the benefits.",
     "8": "End conversation: It's time to end the call as there is nothing else to be said.",
 }
+
+# Stages the conversation can plausibly move to from each stage; ending the
+# call is always possible, so its guidance is kept everywhere
+STAGE_SUCCESSORS = {
+    "1": ("1", "2", "8"),
+    "2": ("2", "3", "8"),
+    "3": ("3", "4", "8"),
+    "4": ("4", "5", "8"),
+    "5": ("5", "6", "7", "8"),
+    "6": ("5", "6", "7", "8"),
+    "7": ("6", "7", "8"),
+    "8": ("8",),
+}
+
+# Stages whose prompt keeps the worked example
+EXAMPLE_STAGES = ("1", "2")
+
+# Stages at which each tool is offered; the tools section is left out of
+# the prompt entirely when no tool is allowed
+TOOL_STAGES = {
+    "ProductSearch": ("3", "4", "5", "6", "7"),
+}
+DEFAULT_TOOL_STAGES = ("2", "3", "4", "5", "6", "7")
@@ -0,0 +1,238 @@
+import json
+from typing import Any, Dict, List, Sequence, Tuple, Union
+
+from langchain.agents import BaseMultiActionAgent
+from langchain.schema import AgentAction, AgentFinish
+from langchain.tools import BaseTool
+from langchain_community.chat_models import ChatLiteLLM
+from langchain_core.language_models.llms import create_base_retry_decorator
+from litellm import acompletion
+
+from server.budget import OBSERVATION_TOKEN_LIMIT, cached_tokens
+from server.composer import tools_for_stage
+from server.hedging import HEDGE_BUDGET, hedger
+from server.memory import count_tokens, truncate_tokens
+from server.parsers import ToolCallAction
+from server.speculation import speculative_context
+from server.templates import CustomPromptTemplateForTools
+
+
+def supports_tool_calls(model: str) -> bool:
+    """Whether the model can be driven with native function/tool calls."""
+    import litellm
+
+    check = getattr(litellm, "supports_function_calling", None)
+    if check is None:
+        return model.startswith(("gpt-3.5-turbo", "gpt-4"))
+    try:
+        return check(model)
+    except Exception:
+        return False
+
+
+def tool_schema(tool: BaseTool) -> Dict[str, Any]:
+    """OpenAI tool definition for a single-string-input langchain Tool."""
+    return {
+        "type": "function",
+        "function": {
+            "name": tool.name,
+            "description": tool.description,
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "query": {
+                        "type": "string",
+                        "description": "the input to the tool, always a simple string",
+                    }
+                },
+                "required": ["query"],
+            },
+        },
+    }
+
+
+class StructuredToolsAgent(BaseMultiActionAgent):
+    """
+    Sales agent that picks tools through native tool calls instead of text.
+
+    The model either returns tool_calls, which become the step's list of
+    ToolCallActions, or plain content, which is the final answer. Nothing is
+    parsed out of free text, so misformatted "Action:" lines can no longer
+    send the agent round again.
+    """
+
+    llm: ChatLiteLLM
+    prompt: CustomPromptTemplateForTools
+    tools: Sequence[BaseTool]
+    ai_prefix: str = ""
+    stop: List[str] = []
+    # tool calls accepted from one planning step; the executor runs them concurrently
+    max_actions: int = 1
+
+    @property
+    def input_keys(self) -> List[str]:
+        return [key for key in self.prompt.input_variables if key != "intermediate_steps"]
+
+    def get_allowed_tools(self) -> List[str]:
+        return [tool.name for tool in self.tools]
+
+    def _messages(
+        self, intermediate_steps: List[Tuple[AgentAction, str]], **kwargs: Any
+    ) -> List[Dict[str, Any]]:
+        messages = []
+        # calls from one model response go back as one assistant message
+        groups: List[List[Tuple[AgentAction, str]]] = []
+        previous_group_id = None
+        for action, observation in intermediate_steps:
+            group_id = getattr(action, "group_id", "")
+            if groups and group_id and group_id == previous_group_id:
+                groups[-1].append((action, observation))
+            else:
+                groups.append([(action, observation)])
+            previous_group_id = group_id
+
+        for steps in groups:
+            tool_calls, results = [], []
+            for action, observation in steps:
+                tool_call_id = (
+                    getattr(action, "tool_call_id", "")
+                    or f"call_{len(messages)}_{len(tool_calls)}"
+                )
+                tool_calls.append(
+                    {
+                        "id": tool_call_id,
+                        "type": "function",
+                        "function": {
+                            "name": action.tool,
+                            "arguments": json.dumps({"query": action.tool_input}),
+                        },
+                    }
+                )
+                results.append(
+                    {
+                        "role": "tool",
+                        "tool_call_id": tool_call_id,
+                        "content": truncate_tokens(str(observation), OBSERVATION_TOKEN_LIMIT),
+                    }
+                )
+            messages.append({"role": "assistant", "content": None, "tool_calls": tool_calls})
+            messages.extend(results)
+
+        context = speculative_context() if intermediate_steps else None
+        if context:
+            # the turn's catalog prefetch went unused but looks relevant
+            messages.append(
+                {
+                    "role": "system",
+                    "content": "Product information that may help:\n"
+                    + truncate_tokens(context, OBSERVATION_TOKEN_LIMIT),
+                }
+            )
+
+        # the system prompt's history is fitted around the tool messages
+        reserved_tokens = cached_tokens(
+            json.dumps([tool_schema(tool) for tool in self._tools(kwargs)])
+        ) + sum(
+            count_tokens(message["content"] or json.dumps(message.get("tool_calls")))
+            for message in messages
+        )
+        system = self.prompt.format(
+            intermediate_steps=[], reserved_tokens=reserved_tokens, **kwargs
+        )
+        return [{"role": "system", "content": system}] + messages
+
+    def _tools(self, inputs: Dict[str, Any]) -> Sequence[BaseTool]:
+        if not self.prompt.stage_aware:
+            return self.tools
+        return tools_for_stage(self.tools, inputs.get("conversation_stage_id"))
+
+    def _params(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        tools = self._tools(inputs)
+        params = {
+            "model": self.llm.model,
+            "temperature": self.llm.temperature,
+            "max_tokens": self.llm.max_tokens,
+            **self.llm.model_kwargs,
+        }
+        if tools:
+            params["tools"] = [tool_schema(tool) for tool in tools]
+            params["tool_choice"] = "auto"
+        if self.stop:
+            params["stop"] = self.stop
+        return params
+
+    def _parse(self, response: Any) -> Union[List[AgentAction], AgentFinish]:
+        message = response.choices[0].message
+        tool_calls = (getattr(message, "tool_calls", None) or [])[: self.max_actions]
+        actions = []
+        for tool_call in tool_calls:
+            try:
+                arguments = json.loads(tool_call.function.arguments or "{}")
+            except ValueError:
+                arguments = {"query": tool_call.function.arguments}
+            query = arguments.get("query", "") if isinstance(arguments, dict) else str(arguments)
+            actions.append(
+                ToolCallAction(
+                    tool=tool_call.function.name,
+                    tool_input=query,
+                    log=f"Action: {tool_call.function.name}\nAction Input: {query}",
+                    tool_call_id=tool_call.id,
+                    group_id=getattr(response, "id", "") or "",
+                )
+            )
+        if actions:
+            return actions
+
+        content = (message.content or "").strip()
+        # the model sometimes echoes the speaker label despite the instructions
+        if self.ai_prefix and content.startswith(f"{self.ai_prefix}:"):
+            content = content[len(self.ai_prefix) + 1 :].strip()
+        return AgentFinish({"output": content}, content)
+
+    def plan(
+        self,
+        intermediate_steps: List[Tuple[AgentAction, str]],
+        callbacks: Any = None,
+        **kwargs: Any,
+    ) -> Union[List[AgentAction], AgentFinish]:
+        response = self.llm.completion_with_retry(
+            messages=self._messages(intermediate_steps, **kwargs), **self._params(kwargs)
+        )
+        return self._parse(response)
+
+    async def aplan(
+        self,
+        intermediate_steps: List[Tuple[AgentAction, str]],
+        callbacks: Any = None,
+        **kwargs: Any,
+    ) -> Union[List[AgentAction], AgentFinish]:
+        import litellm
+
+        retry_decorator = create_base_retry_decorator(
+            error_types=[
+                litellm.Timeout,
+                litellm.APIError,
+                litellm.APIConnectionError,
+                litellm.RateLimitError,
+            ],
+            max_retries=self.llm.max_retries,
+        )
+
+        @retry_decorator
+        async def _completion_with_retry(**params: Any) -> Any:
+            return await acompletion(**params)
+
+        messages = self._messages(intermediate_steps, **kwargs)
+        params = self._params(kwargs)
+
+        async def call(model: str) -> Any:
+            return await _completion_with_retry(messages=messages, **{**params, "model": model})
+
+        response = await hedger.run(
+            getattr(self.llm, "hedge_role", "") or "tool_planner",
+            params["model"],
+            getattr(self.llm, "hedge_model", None),
+            call,
+            getattr(self.llm, "hedge_budget", HEDGE_BUDGET),
+        )
+        return self._parse(response)
@@ -1,30 +1,78 @@
-from typing import Callable
+from typing import Any, Callable, Optional
 
 from langchain.prompts.base import StringPromptTemplate
 
+from server.budget import OBSERVATION_TOKEN_LIMIT
+from server.composer import compose_template, tools_for_stage
+from server.memory import TurnStore, truncate_tokens
+from server.speculation import speculative_context
+
 class CustomPromptTemplateForTools(StringPromptTemplate):
     # The template to use
     template: str
     ############## NEW ######################
     # The list of tools available
     tools_getter: Callable
+    # PromptBudget that fits conversation_history when it is passed as a TurnStore
+    budget: Optional[Any] = None
+    # when set, the template and tools are slimmed to the conversation stage
+    stage_aware: bool = False
 
     def format(self, **kwargs) -> str:
         # Get the intermediate steps (AgentAction, Observation tuples)
         # Format them in a particular way
         intermediate_steps = kwargs.pop("intermediate_steps")
+        # prompt content sent next to this template, e.g. native tool messages
+        reserved_tokens = kwargs.pop("reserved_tokens", 0)
+        stage_id = kwargs.pop("conversation_stage_id", None)
+        template = (
+            compose_template(self.template, stage_id) if self.stage_aware else self.template
+        )
         thoughts = ""
-        for action, observation in intermediate_steps:
+        for i, (action, observation) in enumerate(intermediate_steps):
+            observation = truncate_tokens(str(observation), OBSERVATION_TOKEN_LIMIT)
+            # actions planned together share one log, carried by the first
+            last_in_step = (
+                i + 1 == len(intermediate_steps) or intermediate_steps[i + 1][0].log
+            )
             thoughts += action.log
-            thoughts += f"\nObservation: {observation}\nThought: "
+            if action.log and last_in_step:
+                thoughts += f"\nObservation: {observation}"
+            else:
+                thoughts += f"\nObservation ({action.tool}): {observation}"
+            if last_in_step:
+                thoughts += "\nThought: "
+        context = speculative_context() if intermediate_steps else None
+        if context:
+            # the turn's catalog prefetch went unused but looks relevant
+            thoughts = thoughts[: -len("Thought: ")] + (
+                "Product information that may help:\n"
+                + truncate_tokens(context, OBSERVATION_TOKEN_LIMIT)
+                + "\nThought: "
+            )
         # Set the agent_scratchpad variable to that value
         kwargs["agent_scratchpad"] = thoughts
         ############## NEW ######################
         tools = self.tools_getter(kwargs["input"])
+        if self.stage_aware:
+            tools = tools_for_stage(tools, stage_id)
         # Create a tools variable from the list of tools provided
         kwargs["tools"] = "\n".join(
             [f"{tool.name}: {tool.description}" for tool in tools]
         )
         # Create a list of tool names for the tools provided
         kwargs["tool_names"] = ", ".join([tool.name for tool in tools])
-        return self.template.format(**kwargs)
+
+        history = kwargs.get("conversation_history")
+        if isinstance(history, TurnStore):
+            if self.budget is not None:
+                kwargs["conversation_history"], _ = self.budget.fit(
+                    template,
+                    kwargs,
+                    history,
+                    kwargs["salesperson_name"],
+                    reserved_tokens=reserved_tokens,
+                )
+            else:
+                kwargs["conversation_history"] = history.render(kwargs["salesperson_name"])
+        return template.format(**kwargs)
@@ -1,43 +1,378 @@
-__import__('pysqlite3')
+import asyncio
+import contextvars
+import fnmatch
+import ipaddress
+import json
+import os
+import socket
 import sys
-sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import quote, urlsplit, urlunsplit
 
+import httpx
 from langchain.agents import Tool
 from langchain.chains import RetrievalQA
 from langchain.text_splitter import CharacterTextSplitter
-from langchain_community.vectorstores import Chroma
 from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 
+from server.deadline import bounded, check
+from server.embedding_cache import cached_embeddings
+from server.ingestion import load_index, ready_catalog_key
+from server.logger import log_event
+from server.retrieval import RETRIEVAL_SOCKET, catalog_key, sidecar_retriever
+from server.speculation import SpeculativeRetriever
+from server.vector_index import VECTOR_INDEX_MAX_CHUNKS, VectorIndex
+
+
+def chroma_retriever(texts, embeddings):
+    # chromadb needs a newer sqlite than some images ship; only large catalogs pay for it
+    if getattr(sys.modules.get("sqlite3"), "__name__", "") != "pysqlite3":
+        __import__("pysqlite3")
+        sys.modules["sqlite3"] = sys.modules.pop("pysqlite3")
+    from langchain_community.vectorstores import Chroma
+
+    docsearch = Chroma.from_texts(
+        texts, embeddings, collection_name="product-knowledge-base"
+    )
+    return docsearch.as_retriever()
+
+
 def setup_knowledge_base(
-    product_catalog: str = None, model_name: str = "gpt-3.5-turbo"
+    product_catalog: str = None, model_name: str = "gpt-4-0125-preview", llm=None, tenant=None
 ):
     """
     We assume that the product catalog is simply a text string.
-    """
 
-    text_splitter = CharacterTextSplitter(chunk_size=10, chunk_overlap=0)
-    texts = text_splitter.split_text(product_catalog)
+    An index built by the ingestion worker for this catalog, or the tenant's
+    last good one while a new upload is ingested, is used without embedding.
+    """
 
-    llm = ChatOpenAI(model_name="gpt-4-0125-preview", temperature=0)
+    if llm is None:
+        llm = ChatOpenAI(model_name=model_name, temperature=0)
 
-    embeddings = OpenAIEmbeddings()
-    docsearch = Chroma.from_texts(
-        texts, embeddings, collection_name="product-knowledge-base"
-    )
+    key = ready_catalog_key(product_catalog, tenant)
+    if RETRIEVAL_SOCKET:
+        # the sidecar owns the index; this worker keeps no vectors
+        retriever = sidecar_retriever(product_catalog, key=key)
+    elif key is not None:
+        embeddings = cached_embeddings(OpenAIEmbeddings())
+        retriever = load_index(key).as_retriever(embeddings)
+    else:
+        text_splitter = CharacterTextSplitter(chunk_size=10, chunk_overlap=0)
+        texts = text_splitter.split_text(product_catalog)
+        embeddings = cached_embeddings(OpenAIEmbeddings())
+        if len(texts) <= VECTOR_INDEX_MAX_CHUNKS:
+            retriever = VectorIndex.from_texts(texts, embeddings).as_retriever(embeddings)
+        else:
+            retriever = chroma_retriever(texts, embeddings)
 
     knowledge_base = RetrievalQA.from_chain_type(
-        llm=llm, chain_type="stuff", retriever=docsearch.as_retriever()
+        llm=llm, chain_type="stuff", retriever=SpeculativeRetriever(retriever=retriever)
     )
     return knowledge_base
 
-def get_tools(product_catalog):
-    knowledge_base = setup_knowledge_base(product_catalog)
-    tools = [
-        Tool(
-            name="ProductSearch",
-            func=knowledge_base.run,
-            description="useful for when you need to answer questions about product information or services offered, availability and their costs.",
+# Sync tools run here so several of them can be in flight for one agent step
+TOOL_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.getenv("TOOL_THREADS", "8")), thread_name_prefix="tool"
+)
+TOOL_TIMEOUT = float(os.getenv("TOOL_TIMEOUT", "10"))
+TOOL_CACHE_TTL = float(os.getenv("TOOL_CACHE_TTL", "300"))
+# Tool observations cached per process, across requests and tenants' agents
+TOOL_CACHE_ENTRIES = int(os.getenv("TOOL_CACHE_ENTRIES", "4096"))
+# Host patterns http_lookup tools may call, e.g. "api.example.com,*.crm.example.com";
+# empty disables http_lookup
+HTTP_TOOL_ALLOWED_HOSTS = [
+    pattern.strip().lower()
+    for pattern in os.getenv("HTTP_TOOL_ALLOWED_HOSTS", "").split(",")
+    if pattern.strip()
+]
+
+TOOL_REGISTRY: Dict[str, Callable[..., Tool]] = {}
+
+DEFAULT_TOOLS = [{"type": "ProductSearch"}]
+
+
+def register_tool(tool_type: str):
+    """Register a tool factory that tenants can reference in their `tools` config."""
+
+    def decorator(factory: Callable[..., Tool]) -> Callable[..., Tool]:
+        TOOL_REGISTRY[tool_type] = factory
+        return factory
+
+    return decorator
+
+
+@register_tool("ProductSearch")
+def product_search_tool(product_catalog: str = None, llm=None, **kwargs) -> Tool:
+    knowledge_base = setup_knowledge_base(product_catalog, llm=llm, tenant=kwargs.get("tenant"))
+    return Tool(
+        name=kwargs.get("name", "ProductSearch"),
+        func=knowledge_base.run,
+        coroutine=knowledge_base.arun,
+        # lets the agent prefetch from the catalog before the planner asks
+        metadata={"retriever": knowledge_base.retriever},
+        description=kwargs.get(
+            "description",
+            "useful for when you need to answer questions about product information or services offered, availability and their costs.",
         ),
+    )
+
+
+@register_tool("http_lookup")
+def http_lookup_tool(
+    name: str,
+    description: str,
+    url: str,
+    method: str = "GET",
+    headers: Dict[str, str] = None,
+    max_chars: int = 2000,
+    **kwargs,
+) -> Tool:
+    """
+    Tool backed by a tenant HTTP endpoint, e.g. pricing, inventory or CRM lookups.
+
+    GET requests send the query as the `q` parameter (or fill `{query}` in the
+    url), other methods send it as a JSON body. The url's host must match
+    HTTP_TOOL_ALLOWED_HOSTS, and is refused at call time if it resolves to a
+    private, loopback or link-local address. The request then connects to
+    the address that was checked, so the host cannot be re-resolved elsewhere.
+    """
+    allowed_url(url)
+
+    def request_args(query: str) -> Dict[str, Any]:
+        args = {"method": method, "url": url, "headers": headers or {}}
+        if "{query}" in url:
+            args["url"] = url.replace("{query}", quote(query))
+        elif method.upper() == "GET":
+            args["params"] = {"q": query}
+        else:
+            args["json"] = {"query": query}
+        return args
+
+    def refused(args: Dict[str, Any], error: ValueError) -> str:
+        log_event("http_tool_refused", tool=name, url=args["url"], error=str(error))
+        return f"Sorry, {name} cannot reach that address."
+
+    def lookup(query: str) -> str:
+        args = request_args(query)
+        try:
+            host, port = allowed_url(args["url"])
+            address = check_public_address(host, port, socket.getaddrinfo)
+        except (ValueError, OSError) as e:
+            return refused(args, ValueError(str(e)))
+        with httpx.Client(follow_redirects=False) as client:
+            response = client.request(**pin_address(args, address))
+        response.raise_for_status()
+        return response.text[:max_chars]
+
+    async def alookup(query: str) -> str:
+        args = request_args(query)
+        try:
+            host, port = allowed_url(args["url"])
+            addresses = await asyncio.get_running_loop().getaddrinfo(
+                host, port, type=socket.SOCK_STREAM
+            )
+            address = check_public_address(host, port, lambda *_: addresses)
+        except (ValueError, OSError) as e:
+            return refused(args, ValueError(str(e)))
+        async with httpx.AsyncClient(follow_redirects=False) as client:
+            response = await client.request(**pin_address(args, address))
+        response.raise_for_status()
+        return response.text[:max_chars]
+
+    return Tool(name=name, func=lookup, coroutine=alookup, description=description)
+
+
+def allowed_url(url: str) -> Tuple[str, int]:
+    """Host and port of an http(s) url whose host matches HTTP_TOOL_ALLOWED_HOSTS."""
+    parts = urlsplit(url)
+    host = (parts.hostname or "").lower()
+    if parts.scheme not in ("http", "https") or not host:
+        raise ValueError(f"Only http(s) urls can be looked up, got {url!r}")
+    if not any(fnmatch.fnmatchcase(host, pattern) for pattern in HTTP_TOOL_ALLOWED_HOSTS):
+        raise ValueError(f"Host {host!r} is not in HTTP_TOOL_ALLOWED_HOSTS")
+    return host, parts.port or (443 if parts.scheme == "https" else 80)
+
+
+def check_public_address(host: str, port: int, resolve: Callable[..., list]) -> str:
+    """
+    An address `host` resolves to, refusing hosts that resolve to internal
+    addresses, e.g. cloud metadata or localhost.
+    """
+    addresses = [
+        ipaddress.ip_address(sockaddr[0])
+        for *_, sockaddr in resolve(host, port, type=socket.SOCK_STREAM)
     ]
+    if not addresses:
+        raise ValueError(f"{host} does not resolve")
+    for address in addresses:
+        if not address.is_global or address.is_multicast:
+            raise ValueError(f"{host} resolves to non-public address {address}")
+    return str(addresses[0])
+
+
+def pin_address(args: Dict[str, Any], address: str) -> Dict[str, Any]:
+    """
+    Request args that connect to `address` instead of resolving the url's
+    host again, still sending its Host header and TLS server name.
+    """
+    parts = urlsplit(args["url"])
+    pinned = f"[{address}]" if ":" in address else address
+    if parts.port is not None:
+        pinned += f":{parts.port}"
+    host = parts.hostname if parts.port is None else f"{parts.hostname}:{parts.port}"
+    return {
+        **args,
+        "url": urlunsplit(parts._replace(netloc=pinned)),
+        "headers": {**args["headers"], "Host": host},
+        "extensions": {"sni_hostname": parts.hostname},
+    }
+
+
+class ToolCache:
+    """
+    Observations of tool calls, shared by every agent the process builds.
+
+    Keyed by tool name, tenant and normalized query; entries expire after
+    their tool's TTL and the least recently used are dropped past
+    `max_entries`.
+    """
+
+    def __init__(self, max_entries: int = TOOL_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple, Tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key: Tuple) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: Tuple, observation: Any, ttl: float) -> None:
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, observation)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+tool_cache = ToolCache()
+
+
+def with_timeout_and_cache(
+    tool: Tool, timeout: float, cache_ttl: float, cache_scope: Any = None
+) -> Tool:
+    """
+    Wrap a tool with a per-call timeout and a TTL cache keyed by its input.
+
+    Async tools are awaited natively, sync tools run in TOOL_EXECUTOR, so the
+    agent executor can gather several tool calls from one planning step.
+    Observations go to the process-wide tool_cache under `cache_scope`, so
+    they outlive the per-request agent.
+
+    A sync tool cannot be interrupted: after a timeout the caller gets an
+    answer, but the call keeps its TOOL_EXECUTOR thread until it returns.
+    Tools that may hang should provide a coroutine.
+    """
+
+    def key(query: str) -> Tuple:
+        return (tool.name, cache_scope, query.strip().lower())
+
+    def cached(query: str):
+        return tool_cache.get(key(query))
+
+    def remember(query: str, observation: str):
+        tool_cache.put(key(query), observation, cache_ttl)
+
+    def timed_out() -> str:
+        return f"Sorry, {tool.name} did not answer in time."
+
+    def run(query: str) -> str:
+        observation = cached(query)
+        if observation is not None:
+            return observation
+        check(f"tool:{tool.name}")
+        future = TOOL_EXECUTOR.submit(contextvars.copy_context().run, tool.func, query)
+        try:
+            observation = future.result(timeout=bounded(timeout))
+        except FutureTimeoutError:
+            # only stops a call that has not started; a running one keeps its thread
+            future.cancel()
+            return timed_out()
+        remember(query, observation)
+        return observation
+
+    async def arun(query: str) -> str:
+        observation = cached(query)
+        if observation is not None:
+            return observation
+        check(f"tool:{tool.name}")
+        if tool.coroutine is not None:
+            call = tool.coroutine(query)
+        else:
+            # like run(), keep the request id, deadline and turn metrics in the thread
+            call = asyncio.get_running_loop().run_in_executor(
+                TOOL_EXECUTOR, contextvars.copy_context().run, tool.func, query
+            )
+        try:
+            observation = await asyncio.wait_for(call, bounded(timeout))
+        except asyncio.TimeoutError:
+            return timed_out()
+        remember(query, observation)
+        return observation
+
+    return Tool(
+        name=tool.name,
+        func=run,
+        coroutine=arun,
+        description=tool.description,
+        return_direct=tool.return_direct,
+        metadata=tool.metadata,
+    )
+
+
+def get_tools(
+    product_catalog, llm=None, tool_configs: List[Dict[str, Any]] = None, tenant=None
+):
+    """
+    Build the tools declared in the tenant's `tools` config.
+
+    Each entry names a registered tool `type` plus its settings, and may set
+    `timeout` and `cache_ttl`. Without a config only ProductSearch is built.
+    `tenant` lets catalog tools use the tenant's ingested index.
+    """
+    tools = []
+    for tool_config in tool_configs or DEFAULT_TOOLS:
+        tool_config = dict(tool_config)
+        tool_type = tool_config.pop("type", tool_config.get("name"))
+        if tool_type not in TOOL_REGISTRY:
+            raise ValueError(
+                f"Unknown tool type {tool_type!r}. Expected one of {', '.join(TOOL_REGISTRY)}"
+            )
+        timeout = float(tool_config.pop("timeout", TOOL_TIMEOUT))
+        cache_ttl = float(tool_config.pop("cache_ttl", TOOL_CACHE_TTL))
+        tool = TOOL_REGISTRY[tool_type](
+            product_catalog=product_catalog, llm=llm, tenant=tenant, **tool_config
+        )
+        # the same tool answers differently per tenant, catalog and settings
+        cache_scope = (
+            tenant,
+            catalog_key(product_catalog) if product_catalog else None,
+            json.dumps(tool_config, sort_keys=True, default=str),
+        )
+        tools.append(with_timeout_and_cache(tool, timeout, cache_ttl, cache_scope))
 
     return tools
@@ -0,0 +1,114 @@
+import json
+import os
+import shutil
+import tempfile
+from typing import Any, List, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+# Catalogs up to this many chunks are searched with VectorIndex instead of Chroma
+VECTOR_INDEX_MAX_CHUNKS = int(os.getenv("VECTOR_INDEX_MAX_CHUNKS", "5000"))
+
+
+def normalize(vectors: Any) -> np.ndarray:
+    """Row-normalized, contiguous float32 copy of `vectors`."""
+    vectors = np.array(vectors, dtype=np.float32, ndmin=2)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors /= np.where(norms == 0, 1, norms)
+    return np.ascontiguousarray(vectors)
+
+
+class VectorIndex:
+    """
+    Exact cosine search over a contiguous float32 matrix of normalized embeddings.
+
+    For a catalog of a few hundred chunks, one matrix product answers a whole
+    batch of queries in well under a millisecond, with nothing to manage: no
+    SQLite, no collections, no HNSW graph. save() writes the matrix as a .npy
+    file next to the texts and load() memory-maps it, so processes that load
+    the same index share its pages.
+    """
+
+    def __init__(self, texts: List[str], vectors: np.ndarray):
+        if len(texts) != len(vectors):
+            raise ValueError(f"{len(texts)} texts but {len(vectors)} vectors")
+        self.texts = texts
+        self.vectors = vectors
+
+    @classmethod
+    def from_vectors(cls, texts: List[str], vectors: Any) -> "VectorIndex":
+        if not texts:
+            return cls([], np.zeros((0, 0), dtype=np.float32))
+        return cls(list(texts), normalize(vectors))
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embeddings: Any) -> "VectorIndex":
+        return cls.from_vectors(texts, embeddings.embed_documents(list(texts)) if texts else [])
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def search(self, queries: Any, k: int = 4) -> List[List[Tuple[float, int]]]:
+        """Top-k (score, position) pairs for each query vector, best first."""
+        queries = normalize(queries)
+        if not self.texts:
+            return [[] for _ in range(len(queries))]
+        scores = queries @ self.vectors.T
+        k = min(k, len(self.texts))
+        if k < len(self.texts):
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            top = np.broadcast_to(np.arange(k), (len(queries), k))
+        results = []
+        for row, candidates in zip(scores, top):
+            order = candidates[np.argsort(-row[candidates], kind="stable")]
+            results.append([(float(row[i]), int(i)) for i in order])
+        return results
+
+    def save(self, path: str) -> None:
+        """Write the index to directory `path`, which appears atomically."""
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        staging = tempfile.mkdtemp(dir=parent)
+        np.save(os.path.join(staging, "vectors.npy"), self.vectors)
+        with open(os.path.join(staging, "texts.json"), "w") as f:
+            json.dump(self.texts, f)
+        try:
+            os.rename(staging, path)
+        except OSError:
+            # another writer got there first with the same content
+            shutil.rmtree(staging, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "VectorIndex":
+        with open(os.path.join(path, "texts.json")) as f:
+            texts = json.load(f)
+        vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r" if mmap else None)
+        return cls(texts, vectors)
+
+    def as_retriever(self, embeddings: Any, k: int = 4) -> "VectorIndexRetriever":
+        return VectorIndexRetriever(index=self, embeddings=embeddings, k=k)
+
+
+class VectorIndexRetriever(BaseRetriever):
+    """RetrievalQA retriever over an in-process VectorIndex."""
+
+    index: Any
+    embeddings: Any
+    k: int = 4
+
+    def _documents(self, query_vector: Sequence[float]) -> List[Document]:
+        return [
+            Document(page_content=self.index.texts[i], metadata={"score": score, "chunk": i})
+            for score, i in self.index.search([query_vector], self.k)[0]
+        ]
+
+    def _get_relevant_documents(self, query: str, *, run_manager: Any = None) -> List[Document]:
+        return self._documents(self.embeddings.embed_query(query))
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: Any = None
+    ) -> List[Document]:
+        return self._documents(await self.embeddings.aembed_query(query))